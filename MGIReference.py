@@ -9,6 +9,7 @@
 #
 import sys
 import os.path
+import unittest
 import string
 import re
 from copy import copy
@@ -74,6 +75,25 @@ class MGIReference (BaseSample):
             'abstract'      ,
             'extractedText' ,
             ]
+    # fields w/ long text, vs. short metadata fields
+    textFieldNames = ['title', 'abstract', 'extractedText']
+
+    # metadata fields w/ few distinct values (statuses, vocab terms, etc.)
+    vocabFieldNames = [ \
+            'createdBy'     ,
+            'refType'       ,
+            'isReview'      ,
+            'relevance'     ,
+            'relevanceBy'   ,
+            'suppStatus'    ,
+            'apStatus'      ,
+            'gxdStatus'     ,
+            'goStatus'      ,
+            'tumorStatus'   ,
+            'qtlStatus'     ,
+            'proStatus'     ,
+            'journal'       ,
+            ]
     fieldSep  = FIELDSEP
     recordEnd = RECORDEND
     #----------------------
@@ -166,5 +186,124 @@ class MGIReference (BaseSample):
     # ---------------------------
 # end class MGIReference ------------------------
 
+class CompactSample (object):
+    """
+    IS:     a compact sample record: the same fields and getField/setField
+            API as a sample python class (its sampleObjType), for holding
+            many samples in memory (e.g., samples being built and written)
+    HAS:    a fixed __slots__ attribute per field instead of a values dict.
+            vocab field values (statuses, relevance, journal, ...) are
+            interned, so all records share one str per distinct value.
+    DOES:   get/set fields, convert to/from sampleObjType.
+            Does not do sampleObjType's preprocessors or reject handling,
+            use toSample() for those.
+            Subclasses set sampleObjType, the field names, vocabFields,
+            and __slots__ = fieldNames.
+    """
+    __slots__ = ()
+    sampleObjType   = None
+    fieldNames      = []
+    textFieldNames  = []
+    vocabFieldNames = []
+    vocabFields     = frozenset()
+    fieldSep        = FIELDSEP
+    recordEnd       = RECORDEND
+
+    @classmethod
+    def getFieldNames(cls): return cls.fieldNames
+    @classmethod
+    def getFieldSep(cls): return cls.fieldSep
+    @classmethod
+    def getRecordEnd(cls): return cls.recordEnd
+
+    def setField(self, fieldName, value):
+        if fieldName in self.vocabFields: value = sys.intern(value)
+        setattr(self, fieldName, value)
+        return self
+
+    def getField(self, fieldName): return getattr(self, fieldName)
+
+    def setFields(self, values,     # {field name: value}
+        ):
+        for fieldName, value in values.items():
+            self.setField(fieldName, value)
+        return self
+
+    def getFields(self):
+        return { fn: getattr(self, fn) for fn in self.fieldNames }
+
+    def getID(self): return self.ID
+
+    def toSample(self):
+        """ Return this record as a sampleObjType """
+        return self.sampleObjType().setFields(self.getFields())
+
+    @classmethod
+    def fromSample(cls, sample):
+        """ Return a compact record w/ the fields of a sampleObjType """
+        return cls().setFields({ fn: sample.getField(fn) \
+                                                    for fn in cls.fieldNames })
+    # ---------------------------
+# end class CompactSample ------------------------
+
+class CompactMGIReference (CompactSample):
+    """
+    IS:     a CompactSample of an MGIReference
+    """
+    sampleObjType   = MGIReference
+    fieldNames      = MGIReference.fieldNames
+    textFieldNames  = MGIReference.textFieldNames
+    vocabFieldNames = MGIReference.vocabFieldNames
+    vocabFields     = frozenset(vocabFieldNames)
+
+    __slots__ = fieldNames
+
+    def getExtractedText(self): return self.extractedText
+    def getAbstract(self): return self.abstract
+    def getTitle(self): return self.title
+    # ---------------------------
+# end class CompactMGIReference ------------------------
+
+def doAutomatedTests():
+
+    sys.stdout.write("Running automated unit tests...\n")
+    unittest.main(argv=[sys.argv[0], '-v'],)
+
+class MyTests(unittest.TestCase):
+    def getFields(self, i):
+        fields = { fn: '%s %d' % (fn, i) for fn in MGIReference.fieldNames }
+        fields['apStatus'] = ''.join(['Ind', 'exed'])   # not a literal, so
+        fields['journal']  = ' '.join(['J', 'Biol'])    #  not already interned
+        return fields
+
+    def test_CompactMGIReference(self):
+        fields = self.getFields(1)
+        r = CompactMGIReference().setFields(fields)
+        self.assertEqual(r.getFields(), fields)
+        self.assertEqual(r.getID(), 'ID 1')
+        self.assertEqual(r.getExtractedText(), 'extractedText 1')
+        self.assertFalse(hasattr(r, '__dict__'))        # just the slots
+
+        r.setField('title', 'new title')
+        self.assertEqual(r.getField('title'), 'new title')
+        self.assertEqual(CompactMGIReference.getFieldSep(), FIELDSEP)
+        self.assertEqual(CompactMGIReference.getRecordEnd(), RECORDEND)
+
+    def test_CompactMGIReference_vocab(self):
+        r1 = CompactMGIReference().setFields(self.getFields(1))
+        r2 = CompactMGIReference().setFields(self.getFields(2))
+        self.assertIs(r1.getField('apStatus'), r2.getField('apStatus'))
+        self.assertIs(r1.getField('journal'), r2.getField('journal'))
+        self.assertIsNot(r1.getField('title'), r2.getField('title'))
+
+    def test_CompactMGIReference_convert(self):
+        fields = self.getFields(3)
+        sample = CompactMGIReference().setFields(fields).toSample()
+        self.assertIsInstance(sample, MGIReference)
+        self.assertEqual(sample.getExtractedText(), 'extractedText 3')
+        r = CompactMGIReference.fromSample(sample)
+        self.assertEqual(r.getFields(), fields)
+# end class MyTests ------------------------
+
 if __name__ == "__main__":
-    pass
+    doAutomatedTests()
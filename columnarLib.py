@@ -0,0 +1,337 @@
+#!/usr/bin/env python3
+#
+# Library to write/read sample sets as columnar (Parquet) datasets,
+#  so jobs that only need a few metadata columns (e.g., gxdStatus, relevance,
+#  pubYear) do not have to parse the whole sample file.
+#
+# A dataset is two Parquet files w/ the same rows in the same order:
+#   fileName            - the metadata fields (all but the text fields)
+#   <base>.text.parquet - the key fields (_refs_key, ID) and text fields
+#                           (title, abstract, extractedText)
+#  so reading metadata never touches the text, and the text is only read
+#  when asked for.
+# The sample object type's vocabFieldNames (statuses, journal, ...) are
+#  dictionary encoded. All fields are stored as strings, just as they are in
+#  sample files.
+# Sample set meta items (host, db, time, ...) are stored in the Parquet
+#  schema metadata of both files.
+#
+# Needs pyarrow.
+#
+# To convert a sample file:
+#   python columnarLib.py sampleFile parquetFile
+# To run the automated unit tests (skipped if pyarrow is not installed):
+#   python columnarLib.py --test
+#
+import sys
+import os.path
+import json
+import shutil
+import tempfile
+import unittest
+import sampleFileLib
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+#-----------------------------------
+
+ROW_GROUP_SIZE  = 5000      # num of samples per Parquet row group
+TEXT_FILE_EXT   = '.text.parquet'
+KEY_FIELDNAMES  = ['_refs_key', 'ID']   # in both files, if the sample has them
+META_KEY        = b'sampleSetMeta'      # schema metadata key for meta items
+
+def getTextFileName(fileName):
+    """ Return the name of the text file for the dataset in fileName """
+    base, ext = os.path.splitext(fileName)
+    return base + TEXT_FILE_EXT
+#-----------------------------------
+
+def checkPyarrow(fileName):
+    if pa is None:
+        raise ImportError("pyarrow is needed to read/write '%s'" % fileName)
+#-----------------------------------
+
+class ColumnarWriter (object):
+    """
+    IS:     a writer of samples to a columnar dataset (two Parquet files)
+    HAS:    the sample object type's fields, buffered column values
+    DOES:   buffers samples and writes them a row group at a time, so only
+            one row group of samples is in memory at once.
+    """
+    def __init__(self, fileName,    # metadata Parquet file pathname
+                sampleObjType,      # sample python class, has fieldNames, etc.
+                metaItems={},       # {meta item: value} sample set meta data
+                rowGroupSize=ROW_GROUP_SIZE,
+                ):
+        checkPyarrow(fileName)
+        self.fileName = fileName
+        self.textFileName = getTextFileName(fileName)
+        self.rowGroupSize = rowGroupSize
+        self.numSamples = 0
+
+        self.fieldNames = sampleObjType.fieldNames
+        textFieldNames  = getattr(sampleObjType, 'textFieldNames', [])
+        vocabFieldNames = getattr(sampleObjType, 'vocabFieldNames', [])
+
+        self.metaFieldNames = [ fn for fn in self.fieldNames \
+                                                if fn not in textFieldNames ]
+        self.textFileFieldNames = [ fn for fn in KEY_FIELDNAMES \
+                                                if fn in self.fieldNames ] + \
+                                  [ fn for fn in self.fieldNames \
+                                                if fn in textFieldNames ]
+        self.vocabFieldNames = set(vocabFieldNames)
+
+        metadata = { META_KEY: json.dumps(metaItems).encode('utf-8') }
+        self.metaSchema = self.buildSchema(self.metaFieldNames, metadata)
+        self.textSchema = self.buildSchema(self.textFileFieldNames, metadata)
+        self.metaWriter = pq.ParquetWriter(fileName, self.metaSchema)
+        self.textWriter = pq.ParquetWriter(self.textFileName, self.textSchema,
+                                            compression='zstd')
+        self.columns = { fn: [] for fn in self.fieldNames }
+    #----------------------
+
+    def buildSchema(self, fieldNames, metadata):
+        fields = []
+        for fn in fieldNames:
+            if fn in self.vocabFieldNames:
+                fields.append(pa.field(fn, pa.dictionary(pa.int32(),
+                                                                pa.string())))
+            else:
+                fields.append(pa.field(fn, pa.string()))
+        return pa.schema(fields, metadata=metadata)
+    #----------------------
+
+    def writeSample(self, sample):
+        return self.writeFields([ sample.getField(fn) \
+                                                for fn in self.fieldNames ])
+    #----------------------
+
+    def writeFields(self, values,   # list of field values, in fieldNames order
+        ):
+        for fn, value in zip(self.fieldNames, values):
+            self.columns[fn].append(value)
+        self.numSamples += 1
+        if len(self.columns[self.fieldNames[0]]) >= self.rowGroupSize:
+            self.flush()
+        return self
+    #----------------------
+
+    def flush(self):
+        """ Write the buffered samples as a row group """
+        if not self.columns[self.fieldNames[0]]: return
+        for writer, schema in [ (self.metaWriter, self.metaSchema),
+                                (self.textWriter, self.textSchema) ]:
+            arrays = []
+            for field in schema:
+                array = pa.array(self.columns[field.name], type=pa.string())
+                if field.name in self.vocabFieldNames:
+                    array = array.dictionary_encode()
+                arrays.append(array)
+            writer.write_table(pa.Table.from_arrays(arrays, schema=schema))
+        self.columns = { fn: [] for fn in self.fieldNames }
+    #----------------------
+
+    def getNumSamples(self): return self.numSamples
+
+    def close(self):
+        self.flush()
+        self.metaWriter.close()
+        self.textWriter.close()
+    #----------------------
+# end class ColumnarWriter ------------------------
+
+class ColumnarReader (object):
+    """
+    IS:     a reader of a columnar dataset written by ColumnarWriter
+    HAS:    the metadata and text Parquet files
+    DOES:   reads just the columns asked for. The text file is only opened
+            if text columns are asked for.
+    """
+    def __init__(self, fileName,    # metadata Parquet file pathname
+                ):
+        checkPyarrow(fileName)
+        self.fileName = fileName
+        self.textFileName = getTextFileName(fileName)
+        self.metaFile = pq.ParquetFile(fileName)
+        self.textFile = None            # opened on demand
+
+        schema = self.metaFile.schema_arrow
+        self.metaItems = json.loads(schema.metadata[META_KEY].decode('utf-8'))
+        self.metaFieldNames = schema.names
+    #----------------------
+
+    def getMetaItem(self, key): return self.metaItems.get(key)
+
+    def getNumSamples(self): return self.metaFile.metadata.num_rows
+
+    def getTextFile(self):
+        if self.textFile is None:
+            self.textFile = pq.ParquetFile(self.textFileName)
+        return self.textFile
+    #----------------------
+
+    def read(self, columns=None,    # list of field names, None for metadata
+        ):
+        """ Return a pyarrow Table of the columns for all the samples """
+        if columns is None: columns = self.metaFieldNames
+        metaCols = [ c for c in columns if c in self.metaFieldNames ]
+        textCols = [ c for c in columns if c not in self.metaFieldNames ]
+
+        table = self.metaFile.read(columns=metaCols)
+        if textCols:
+            textTable = self.getTextFile().read(columns=textCols)
+            for c in textCols:
+                table = table.append_column(c, textTable.column(c))
+        return table.select(columns)
+    #----------------------
+
+    def iterTextBatches(self, columns,  # list of text file field names
+                        batchSize=ROW_GROUP_SIZE,
+        ):
+        """ Generator: yield pyarrow RecordBatches of the text file columns,
+            so the text for all the samples is never in memory at once.
+        """
+        return self.getTextFile().iter_batches(batch_size=batchSize,
+                                                            columns=columns)
+    #----------------------
+# end class ColumnarReader ------------------------
+
+def convertSampleFile(sampleFileName,   # sample file pathname, may be compressed
+                    fileName,           # metadata Parquet file pathname
+                    sampleObjType,      # sample python class of the samples
+                    ):
+    """ Write the samples in a sample file to a columnar dataset.
+        The sample file is read lazily, so only a row group of samples is
+        in memory at once.
+        Return the num of samples written.
+    """
+    lazyFile = sampleFileLib.LazySampleFile(sampleFileName, sampleObjType)
+    try:
+        metaItems = { key: lazyFile.getMetaItem(key) \
+                                    for key in ['host', 'db', 'time'] }
+        writer = ColumnarWriter(fileName, sampleObjType, metaItems)
+        for lazySample in lazyFile:
+            writer.writeSample(lazySample)
+        writer.close()
+    finally:
+        lazyFile.close()
+    return writer.getNumSamples()
+#-----------------------------------
+
+def doAutomatedTests():
+
+    sys.stdout.write("Running automated unit tests...\n")
+    unittest.main(argv=[sys.argv[0], '-v'],)
+
+@unittest.skipIf(pa is None, "pyarrow is not installed")
+class MyTests(unittest.TestCase):
+    class TestSample (object):
+        fieldNames = ['_refs_key', 'ID', 'journal', 'pubYear', 'title',
+                                                            'extractedText']
+        textFieldNames  = ['title', 'extractedText']
+        vocabFieldNames = ['journal']
+
+        @staticmethod
+        def getRecordEnd(): return ';;\n'
+        @staticmethod
+        def getFieldSep(): return '|'
+
+    metaItems = {'host': 'dev', 'db': 'mgd', 'time': '2024/01/02-03:04:05'}
+
+    def getRows(self, num):
+        return [ [ str(i), 'MGI:%d' % i, ['Cell', 'Nature'][i % 2],
+                    str(2000 + i), 'title %d' % i, 'caf\u00e9 text %d' % i ]
+                                                    for i in range(num) ]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.tmpDir, 'samples.parquet')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeDataset(self, rows, **kwargs):
+        writer = ColumnarWriter(self.fileName, self.TestSample,
+                                                    self.metaItems, **kwargs)
+        for row in rows:
+            writer.writeFields(row)
+        writer.close()
+        return writer
+
+    def getColumns(self, table):
+        """ Return {field name: list of values} of a pyarrow Table """
+        return { fn: table.column(fn).to_pylist() \
+                                                for fn in table.column_names }
+
+    def test_roundTrip(self):
+        rows = self.getRows(7)
+        writer = self.writeDataset(rows, rowGroupSize=3)    # 3 row groups
+        self.assertEqual(writer.getNumSamples(), 7)
+        fieldNames = self.TestSample.fieldNames
+        expected = { fn: [ row[i] for row in rows ] \
+                                        for i, fn in enumerate(fieldNames) }
+
+        reader = ColumnarReader(self.fileName)
+        self.assertEqual(reader.getNumSamples(), 7)
+        self.assertEqual(reader.getMetaItem('host'), 'dev')
+        self.assertEqual(reader.metaFieldNames,
+                                    ['_refs_key', 'ID', 'journal', 'pubYear'])
+        self.assertEqual(reader.metaFile.metadata.num_row_groups, 3)
+
+        table = reader.read()                       # just the metadata
+        self.assertIsNone(reader.textFile)          #  does not open the text
+        self.assertTrue(pa.types.is_dictionary(table.schema.field(
+                                                            'journal').type))
+        self.assertEqual(self.getColumns(table), { fn: expected[fn] \
+                                        for fn in reader.metaFieldNames })
+
+        table = reader.read(fieldNames)
+        self.assertEqual(table.column_names, fieldNames)
+        self.assertEqual(self.getColumns(table), expected)
+
+        titles = []
+        for batch in reader.iterTextBatches(['title'], batchSize=2):
+            self.assertLessEqual(batch.num_rows, 2)
+            titles += batch.column(0).to_pylist()
+        self.assertEqual(titles, expected['title'])
+
+    def test_empty(self):
+        self.writeDataset([])
+        reader = ColumnarReader(self.fileName)
+        self.assertEqual(reader.getNumSamples(), 0)
+        self.assertEqual(reader.read(['ID', 'title']).num_rows, 0)
+
+    def test_convertSampleFile(self):
+        rows = self.getRows(4)
+        sampleFileName = os.path.join(self.tmpDir, 'samples.txt.gz')
+        with sampleFileLib.openSampleFile(sampleFileName, 'w') as fp:
+            fp.write('#meta %s\n' % ' '.join([ '%s=%s' % item \
+                                        for item in self.metaItems.items() ]))
+            fp.write('|'.join(self.TestSample.fieldNames) + ';;\n')
+            for row in rows:
+                fp.write('|'.join(row) + ';;\n')
+
+        numSamples = convertSampleFile(sampleFileName, self.fileName,
+                                                            self.TestSample)
+        self.assertEqual(numSamples, 4)
+        reader = ColumnarReader(self.fileName)
+        self.assertEqual(reader.getMetaItem('time'), self.metaItems['time'])
+        table = reader.read(self.TestSample.fieldNames)
+        self.assertEqual([ list(r.values()) for r in table.to_pylist() ], rows)
+# end class MyTests ------------------------
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--test':
+        doAutomatedTests()
+    elif len(sys.argv) != 3:
+        sys.stderr.write("usage: %s sampleFile parquetFile\n" % sys.argv[0])
+        sys.exit(5)
+    else:
+        import MGIReference
+        parquetFile = sys.argv[2]
+        numSamples = convertSampleFile(sys.argv[1], parquetFile,
+                                                MGIReference.MGIReference)
+        sys.stderr.write("wrote %d samples to '%s' and '%s'\n" % \
+                    (numSamples, parquetFile, getTextFileName(parquetFile)))
@@ -0,0 +1,747 @@
+#!/usr/bin/env python3
+#
+# Library of db helpers shared by the sample data extraction scripts
+#  (sdGetMGIRefs.py, sdGetRawPrimTriage.py, ...)
+#
+# Functions here take the db module (or an object with a compatible sql()
+#  method) as a parameter, the same way ExtractedTextSet does, so they run on
+#  whatever connection already holds the script's tmp tables.
+#
+import sys
+import re
+import time
+import hashlib
+import json
+import queue
+import struct
+import threading
+import unittest
+import ExtractedTextSet
+try:
+    import psycopg2         # only needed for PgConnection
+except ImportError:
+    psycopg2 = None
+#-----------------------------------
+
+DB_USER     = "mgd_public"  # db login for the scripts and PgConnections
+DB_PASSWORD = "mgdpub"
+
+BATCH_SIZE  = 1000          # default num of rcds per fetch from a cursor
+CURSOR_NAME = 'sd_cursor'   # default name for server-side cursors
+PAGE_SIZE   = 500           # default num of refs per page of extracted text
+TEXT_PAGE_TMP_TBL = 'tmp_textpage'  # tmp tbl of _refs_keys for a text page
+TEXT_MISS_TMP_TBL = 'tmp_textmiss'  # tmp tbl of _refs_keys not in text cache
+COPYKEYS_TMP_TBL  = 'tmp_copykeys'  # tmp tbl of _refs_keys to copy text for
+
+CACHE_SECTION = 'ets'   # text cache section key for the text
+                        #  ExtractedTextSet assembles from all sections
+
+# SQL to get a text cache change token for each ref w/ extracted text rows.
+#  Built from each section's key, length, and modification date, so it
+#  changes if any section does. Uses octet_length() which does not need to
+#  read (detoast) the text itself.
+TEXT_TOKEN_SQL = '''
+    select d._refs_key,
+        string_agg(d._extractedtext_key || ':' ||
+                    coalesce(octet_length(d.extractedtext), 0) || ':' ||
+                    to_char(d.modification_date, 'YYYYMMDDHH24MISS'),
+                    ',' order by d._extractedtext_key) as token
+    from bib_workflow_data d
+    where d._refs_key in (%s)
+    %s
+    group by d._refs_key
+'''
+
+# Tmp table mapping each reference (_refs_key) to its MGI ID, PubMed ID, and
+#  DOI ID, pivoted out of acc_accession in one pass (one group by) instead of
+#  joining acc_accession once per ID type, which kills query performance.
+#  Subset queries join this table instead of acc_accession.
+#  IDs are null if the ref has no (preferred) ID of that type.
+REFIDS_TMP_TBL = 'tmp_refids'
+BUILD_REFIDS_TABLE = [ \
+'''
+    create temporary table %s
+    as
+    select a._object_key as _refs_key,
+        max(case when a._logicaldb_key = 1 and a.prefixpart = 'MGI:'
+                                    then a.accid end) as mgiid,  -- MGI ID
+        max(case when a._logicaldb_key = 29 then a.accid end) as pmid,
+        max(case when a._logicaldb_key = 65 then a.accid end) as doid
+    from acc_accession a
+    where a._mgitype_key = 1                    -- reference
+    and a._logicaldb_key in (1, 29, 65)         -- MGI, pubmed, DOI
+    and a.preferred = 1
+    group by a._object_key
+''' % REFIDS_TMP_TBL,
+'''create index tmp_idx_%s on %s(_refs_key)''' % \
+                                            (REFIDS_TMP_TBL, REFIDS_TMP_TBL),
+'''analyze %s''' % REFIDS_TMP_TBL,
+]
+#-----------------------------------
+
+def iterCursorBatches(db,
+    query,                  # select stmt to run
+    batchSize=BATCH_SIZE,   # num of rcds to fetch per batch
+    cursorName=CURSOR_NAME, # name of the server-side cursor
+    ):
+    """
+    Generator: run query through a named server-side cursor and yield its
+        result records a batch (list of records) at a time.
+    Only one batch is ever held on the client, regardless of the size of the
+        whole result set.
+    The cursor is declared "with hold" so it survives any commits db.sql()
+        does between fetches. It is closed when the generator finishes or is
+        closed.
+    """
+    db.sql('declare %s no scroll cursor with hold for\n%s' % \
+                                                (cursorName, query), 'auto')
+    try:
+        while True:
+            rcds = db.sql('fetch forward %d from %s' % \
+                                                (batchSize, cursorName), 'auto')
+            if not rcds: break
+            yield rcds
+    finally:
+        db.sql('close %s' % cursorName, 'auto')
+#-----------------------------------
+
+def buildKeyTable(db,
+    tmpTableName,           # name of the tmp table to (re)create
+    refKeys,                # list of _refs_keys to put in it
+    ):
+    """
+    (Re)create tmpTableName as a tmp table holding just the refKeys.
+    Handy for running ExtractedTextSet.getExtractedTextSetForTable() on a
+        batch of references.
+    """
+    values = ','.join([ '(%d)' % int(k) for k in refKeys ])
+    sqlList = [ 'drop table if exists %s' % tmpTableName,
+                'create temporary table %s (_refs_key int)' % tmpTableName,
+              ]
+    if values:
+        sqlList.append('insert into %s values %s' % (tmpTableName, values))
+    sqlList.append('create index tmp_idx_%s on %s(_refs_key)' % \
+                                                (tmpTableName, tmpTableName))
+    db.sql(sqlList, 'auto')
+#-----------------------------------
+
+def iterExtractedText(db,
+    tmpTableName,           # tmp table w/ _refs_key of refs to get text for
+    pageSize=PAGE_SIZE,     # num of refs to get text for at a time
+    allowNoText=True,       # passed to ExtractedTextSet.joinRefs2ExtText()
+    cache=None,             # textCacheLib.TextCache or None
+    ):
+    """
+    Generator: yield (_refs_key, extracted text) for the refs in tmpTableName
+        in _refs_key order.
+    Walks tmpTableName a page at a time by _refs_key (keyset pagination:
+        each page starts after the last key of the previous page), so only
+        one page of text is ever in memory, and the db never has to build
+        a result set with the text for the whole table.
+    The text for each page comes from ExtractedTextSet so it is assembled
+        exactly as getExtractedTextSetForTable() does for the whole table.
+    If cache is given, text is only fetched for refs not in the cache or
+        whose text has changed since it was cached.
+    """
+    lastKey = -1
+    while True:
+        db.sql(['drop table if exists %s' % TEXT_PAGE_TMP_TBL,
+                '''create temporary table %s
+                   as select distinct _refs_key from %s
+                   where _refs_key > %d order by _refs_key limit %d
+                ''' % (TEXT_PAGE_TMP_TBL, tmpTableName, lastKey, pageSize),
+                ], 'auto')
+        pageRcds = db.sql('select _refs_key from %s order by _refs_key' % \
+                                                    TEXT_PAGE_TMP_TBL, 'auto')
+        if not pageRcds: break
+
+        if cache is None:
+            extTextSet = ExtractedTextSet.getExtractedTextSetForTable(db,
+                                                            TEXT_PAGE_TMP_TBL)
+            extTextSet.joinRefs2ExtText(pageRcds, allowNoText=allowNoText)
+        else:
+            joinCachedExtText(db, pageRcds, cache, allowNoText)
+        for r in pageRcds:
+            yield r['_refs_key'], r['ext_text']
+        lastKey = pageRcds[-1]['_refs_key']
+#-----------------------------------
+
+# COPY stmt to get the extracted text sections for the refs in a tmp table,
+#  for iterCopyExtractedText(). Refs w/o any sections get one row w/ null
+#  text_type. Column names are the ones ExtractedTextSet expects.
+COPY_TEXT_SQL = '''
+    copy (
+        select t._refs_key, vt.term as text_type, d.extractedtext as text_part
+        from (select distinct _refs_key from %s) t
+            left join bib_workflow_data d on (d._refs_key = t._refs_key
+                                            and d.extractedtext is not null)
+            left join voc_term vt on (d._extractedtext_key = vt._term_key)
+        order by t._refs_key, d._extractedtext_key
+    ) to stdout (format binary)
+'''
+COPY_TEXT_CONVERTERS = [ lambda b: int.from_bytes(b, 'big', signed=True),
+                         lambda b: b.decode('utf-8'),
+                         lambda b: b.decode('utf-8'),
+                       ]
+
+def iterCopyExtractedText(conn,
+    tmpTableName,           # tmp table on conn w/ _refs_key of refs
+    pageSize=PAGE_SIZE,     # num of refs to assemble text for at a time
+    allowNoText=True,       # passed to ExtractedTextSet.joinRefs2ExtText()
+    ):
+    """
+    Generator: yield (_refs_key, extracted text) for the refs in tmpTableName
+        in _refs_key order, like iterExtractedText().
+    But instead of a db.sql() query (and a result record per row) per page,
+        all the text sections are streamed in one binary
+        "copy ... to stdout" on conn (a PgConnection) and decoded as they
+        arrive.
+    The text is still assembled by ExtractedTextSet from the decoded rows,
+        a page of refs at a time. The rows are built to look like the ones
+        ExtractedTextSet queries for itself; checkCopyExtractedText()
+        verifies we get the same text.
+    """
+    rows = iterBinaryCopyRows(conn.iterCopyOut(COPY_TEXT_SQL % tmpTableName),
+                                                        COPY_TEXT_CONVERTERS)
+    pageKeys  = []          # _refs_keys in the page
+    pageParts = []          # text section rcds for the page
+    for refKey, textType, textPart in rows:
+        if not pageKeys or pageKeys[-1] != refKey:      # next ref
+            if len(pageKeys) >= pageSize:
+                for pair in joinCopiedText(pageKeys, pageParts, allowNoText):
+                    yield pair
+                pageKeys, pageParts = [], []
+            pageKeys.append(refKey)
+        if textType is not None:
+            pageParts.append(Record(_refs_key=refKey, text_type=textType,
+                                                        text_part=textPart))
+    if pageKeys:
+        for pair in joinCopiedText(pageKeys, pageParts, allowNoText):
+            yield pair
+#-----------------------------------
+
+def joinCopiedText(pageKeys,    # list of _refs_keys
+    pageParts,                  # list of text section rcds for the refs
+    allowNoText,                # passed to ExtractedTextSet.joinRefs2ExtText()
+    ):
+    """ Return list of (_refs_key, extracted text) for pageKeys """
+    pageRcds = [ Record(_refs_key=k) for k in pageKeys ]
+    extTextSet = ExtractedTextSet.ExtractedTextSet(pageParts)
+    extTextSet.joinRefs2ExtText(pageRcds, allowNoText=allowNoText)
+    return [ (r['_refs_key'], r['ext_text']) for r in pageRcds ]
+#-----------------------------------
+
+def checkCopyExtractedText(conn,
+    tmpTableName,           # tmp table on conn w/ _refs_key of refs
+    pageSize=PAGE_SIZE,     # num of refs to assemble text for at a time
+    allowNoText=True,       # passed to ExtractedTextSet.joinRefs2ExtText()
+    ):
+    """
+    Check iterCopyExtractedText() gets the same text as iterExtractedText()
+        for the refs in tmpTableName. Raise ValueError if not.
+    (the COPY occupies conn while it streams, so we get the query text
+        first and just keep a digest of each ref's text)
+    """
+    digests = {}
+    for refKey, text in iterExtractedText(conn, tmpTableName, pageSize,
+                                                    allowNoText=allowNoText):
+        digests[refKey] = hashlib.md5(text.encode('utf-8')).digest()
+
+    diffKeys = []
+    for refKey, text in iterCopyExtractedText(conn, tmpTableName, pageSize,
+                                                    allowNoText=allowNoText):
+        if digests.pop(refKey, None) != \
+                                hashlib.md5(text.encode('utf-8')).digest():
+            diffKeys.append(refKey)
+    diffKeys.extend(digests.keys())         # refs the COPY did not return
+    if diffKeys:
+        raise ValueError("COPY text differs from query text for %d refs: %s" \
+                    % (len(diffKeys), ','.join(map(str, sorted(diffKeys)[:20]))))
+#-----------------------------------
+
+def iterCopiedText(host, db, user, password, # db to open a new connection to
+    refKeys,                # list of _refs_keys to get text for
+    pageSize=PAGE_SIZE,     # num of refs to assemble text for at a time
+    allowNoText=True,       # passed to ExtractedTextSet.joinRefs2ExtText()
+    checkText=False,        # T/F checkCopyExtractedText() first
+    ):
+    """
+    Generator: yield (_refs_key, extracted text) for refKeys in key order,
+        streamed by iterCopyExtractedText() on a new PgConnection.
+    (the caller's tmp tables are on its own connection, so we put the keys
+        in a tmp table of the new connection's own)
+    """
+    conn = PgConnection(host, db, user, password)
+    try:
+        buildKeyTable(conn, COPYKEYS_TMP_TBL, refKeys)
+        if checkText:
+            checkCopyExtractedText(conn, COPYKEYS_TMP_TBL, pageSize,
+                                                                allowNoText)
+        for pair in iterCopyExtractedText(conn, COPYKEYS_TMP_TBL, pageSize,
+                                                                allowNoText):
+            yield pair
+    finally:
+        conn.close()
+#-----------------------------------
+
+COPY_SIGNATURE = b'PGCOPY\n\xff\r\n\x00'   # binary COPY data header start
+COPY_HEADER_LEN = len(COPY_SIGNATURE) + 8   # + flags, header extension len
+
+def iterBinaryCopyRows(chunks,  # iterable of bytes of binary COPY data
+    converters,                 # function(bytes) -> value for each column
+    ):
+    """
+    Generator: decode PostgreSQL binary COPY data as it arrives, a chunk at
+        a time. Yield each row as a list of values (None for nulls).
+    Only the current (partial) row is buffered, and a row's fields are only
+        decoded once the whole row has arrived.
+    """
+    buf = bytearray()
+    pos = None              # offset of the next row in buf, None until
+                            #  we have read the header
+    unpackFrom = struct.unpack_from
+    for chunk in chunks:
+        buf += chunk
+        if pos is None:
+            if len(buf) < COPY_HEADER_LEN: continue
+            if bytes(buf[:len(COPY_SIGNATURE)]) != COPY_SIGNATURE:
+                raise ValueError("not binary COPY data")
+            extLen = unpackFrom('!i', buf, COPY_HEADER_LEN - 4)[0]
+            if len(buf) < COPY_HEADER_LEN + extLen: continue
+            pos = COPY_HEADER_LEN + extLen
+        while len(buf) >= pos + 2:
+            numFields = unpackFrom('!h', buf, pos)[0]
+            if numFields == -1: return              # trailer
+            # find the fields, stop if the row has not all arrived
+            fields = []
+            end = pos + 2
+            for i in range(numFields):
+                if len(buf) < end + 4: break
+                length = unpackFrom('!i', buf, end)[0]
+                end += 4
+                if length == -1:
+                    fields.append(None)
+                    continue
+                if len(buf) < end + length: break
+                fields.append( (end, length) )
+                end += length
+            if len(fields) < numFields: break       # wait for more data
+            yield [ None if f is None else \
+                        converters[i](buf[f[0]:f[0]+f[1]]) \
+                                            for i, f in enumerate(fields) ]
+            pos = end
+        del buf[:pos]
+        pos = 0
+#-----------------------------------
+
+def joinCachedExtText(db,
+    pageRcds,           # rcds for the refs in TEXT_PAGE_TMP_TBL
+    cache,              # textCacheLib.TextCache
+    allowNoText,        # passed to ExtractedTextSet.joinRefs2ExtText()
+    ):
+    """
+    Set rcd['ext_text'] for each of the pageRcds from the cache, fetching
+        text from the db (and caching it) only for cache misses and stale
+        cache entries.
+    """
+    tokens = getTextTokens(db, 'select _refs_key from %s' % TEXT_PAGE_TMP_TBL)
+    missRcds = []
+    for r in pageRcds:
+        text = cache.get(r['_refs_key'], CACHE_SECTION,
+                                            tokens.get(r['_refs_key'], ''))
+        if text is None: missRcds.append(r)
+        else:            r['ext_text'] = text
+
+    if missRcds:
+        buildKeyTable(db, TEXT_MISS_TMP_TBL,
+                                        [ r['_refs_key'] for r in missRcds ])
+        extTextSet = ExtractedTextSet.getExtractedTextSetForTable(db,
+                                                            TEXT_MISS_TMP_TBL)
+        extTextSet.joinRefs2ExtText(missRcds, allowNoText=allowNoText)
+        for r in missRcds:
+            cache.put(r['_refs_key'], CACHE_SECTION,
+                                tokens.get(r['_refs_key'], ''), r['ext_text'])
+    cache.commit()
+#-----------------------------------
+
+def getTextTokens(db,
+    refKeysSQL,         # SQL for the _refs_keys: a select or a list of keys
+    sectionWhere='',    # additional where clause to restrict the sections
+    ):
+    """
+    Return {_refs_key: text cache change token} for the refs.
+    Refs w/ no extracted text rows are not in the dict.
+    """
+    results = db.sql(TEXT_TOKEN_SQL % (refKeysSQL, sectionWhere), 'auto')
+    return { r['_refs_key'] : r['token'] for r in results }
+#-----------------------------------
+
+def mergeRefs2ExtText(refRcds,  # iterable of ref rcds in _refs_key order
+    textPairs,          # iterable of (_refs_key, text) in _refs_key order
+                        #  e.g., from iterExtractedText()
+    needsText=None,     # function(rcd) -> T/F does rcd need text.
+                        #  Default: all rcds need text
+    ):
+    """
+    Generator: sorted merge join of textPairs onto refRcds.
+    Sets rcd['ext_text'] for each rcd that needs text and yields the rcds in
+        order. Neither side is ever held in memory as a whole.
+    Raises ValueError if a rcd that needs text has no text pair.
+    Text pairs for keys that are not in refRcds are skipped.
+    Closes textPairs (if it is a generator) when it is closed.
+    """
+    textPairs = iter(textPairs)
+    try:
+        textKey, text = next(textPairs, (None, None))
+
+        for r in refRcds:
+            if needsText is None or needsText(r):
+                refKey = r['_refs_key']
+                while textKey is not None and textKey < refKey:
+                    textKey, text = next(textPairs, (None, None))
+                if textKey != refKey:
+                    raise ValueError("No extracted text for _refs_key %s" \
+                                                                    % refKey)
+                r['ext_text'] = text
+            yield r
+    finally:            # e.g., release a COPY connection
+        close = getattr(textPairs, 'close', None)
+        if close: close()
+#-----------------------------------
+
+class Record (dict):
+    """
+    A result record from PgConnection.sql().
+    Like the db module's records, it has a has_key() method.
+    """
+    def has_key(self, key): return key in self
+# end class Record ------------------------
+
+COPY_QUEUE_CHUNKS = 16  # max num of COPY data chunks waiting to be decoded
+_COPY_DONE = object()   # end of COPY data marker
+
+class _CopyWriter (object):
+    """
+    IS:     the file copy_expert() writes COPY data to
+    DOES:   puts each chunk on a queue, waiting if the queue is full.
+            Raises if the reader has stopped, to abort the COPY.
+    """
+    def __init__(self, chunks, stop):
+        self.chunks = chunks
+        self.stop = stop
+    #----------------------
+
+    def write(self, data):
+        while True:
+            if self.stop.is_set(): raise IOError("COPY reader stopped")
+            try:
+                self.chunks.put(data, timeout=0.1)
+                return len(data)
+            except queue.Full:
+                pass
+    #----------------------
+# end class _CopyWriter ------------------------
+
+class PgConnection (object):
+    """
+    IS:     a db connection of our own, separate from the db module's
+            connection (e.g., one per worker process)
+    HAS:    a psycopg2 connection
+    DOES:   sql() is compatible w/ db.sql() so a PgConnection can be passed
+            to the functions here and to ExtractedTextSet in place of the
+            db module.
+            Exports/imports transaction snapshots so several connections
+            can read exactly the same data.
+            All sql() statements run in one transaction that is not
+            committed, so an imported snapshot holds until close().
+    """
+    def __init__(self, host, database, user, password):
+        if psycopg2 is None:
+            raise ImportError("PgConnection needs the psycopg2 module")
+        self.conn = psycopg2.connect(host=host, dbname=database,
+                                            user=user, password=password)
+    #----------------------
+
+    def sql(self, cmds,         # sql stmt (string) or list of stmts
+            parser='auto',      # ignored, for compatibility w/ db.sql()
+            ):
+        """ Run cmds and return their result records like db.sql():
+            a list of records for a single stmt,
+            a list of lists of records for a list of stmts.
+            (None for a stmt that returns no rows)
+        """
+        single = type(cmds) == type('')
+        if single: cmds = [cmds]
+
+        results = []
+        cursor = self.conn.cursor()
+        for cmd in cmds:
+            cursor.execute(cmd)
+            if cursor.description is None:
+                results.append(None)
+            else:
+                cols = [ d[0] for d in cursor.description ]
+                results.append([ Record(zip(cols, row)) \
+                                            for row in cursor.fetchall() ])
+        cursor.close()
+
+        if single: return results[0]
+        return results
+    #----------------------
+
+    def exportSnapshot(self):
+        """ Start a repeatable read transaction and return its snapshot id
+            for other connections to useSnapshot().
+            The snapshot is only valid while this transaction is open.
+        """
+        self.conn.set_session(isolation_level='REPEATABLE READ')
+        return self.sql('select pg_export_snapshot() as snapshot')[0]['snapshot']
+    #----------------------
+
+    def useSnapshot(self, snapshotId):
+        """ Start a repeatable read transaction that sees the same data as
+            the exporting transaction. Must be called before any other sql().
+        """
+        self.conn.set_session(isolation_level='REPEATABLE READ')
+        self.sql("set transaction snapshot '%s'" % snapshotId)
+    #----------------------
+
+    def iterCopyOut(self, copySQL,  # "copy ... to stdout" stmt
+                    maxChunks=COPY_QUEUE_CHUNKS,
+                    ):
+        """ Generator: run copySQL and yield the COPY data a chunk (bytes)
+            at a time as it arrives.
+            psycopg2's copy_expert() only writes to a file, so it runs in a
+            thread writing to a bounded queue (when we fall behind, the
+            thread blocks and the db waits for us).
+        """
+        chunks = queue.Queue(maxChunks)
+        stop = threading.Event()
+
+        def copyOut():
+            cursor = self.conn.cursor()
+            try:
+                cursor.copy_expert(copySQL, _CopyWriter(chunks, stop))
+                result = _COPY_DONE
+            except BaseException as e:
+                result = e
+            finally:
+                cursor.close()
+            while not stop.is_set():
+                try:
+                    chunks.put(result, timeout=0.1)
+                    return
+                except queue.Full:
+                    pass
+
+        thread = threading.Thread(target=copyOut, daemon=True)
+        thread.start()
+        try:
+            while True:
+                chunk = chunks.get()
+                if chunk is _COPY_DONE: break
+                if isinstance(chunk, BaseException): raise chunk
+                yield chunk
+        finally:
+            stop.set()
+            thread.join()
+    #----------------------
+
+    def close(self):
+        self.conn.rollback()
+        self.conn.close()
+    #----------------------
+# end class PgConnection ------------------------
+
+
+def partitionRcds(rcds,         # list of ref rcds in _refs_key order
+    numParts,                   # num of partitions to make
+    ):
+    """
+    Split rcds into up to numParts contiguous _refs_key ranges of (nearly)
+        equal size. Return list of lists of rcds, in key order.
+    """
+    partSize = max((len(rcds) + numParts - 1) // max(numParts, 1), 1)
+    return [ rcds[i:i+partSize] for i in range(0, len(rcds), partSize) ]
+#-----------------------------------
+
+# matches "create temporary table x as ..." (after any leading comments)
+TMP_TABLE_BUILD_RE = re.compile( \
+            r'^\s*(?:--[^\n]*\n\s*)*create\s+temporary\s+table\s+\w+\s+as\b',
+            re.IGNORECASE)
+
+class SqlProfiler (object):
+    """
+    IS:     a wrapper around a db module's sql() that profiles every stmt
+    HAS:    the wrapped sql() function, list of stmt profiles
+    DOES:   install() replaces db.sql so every db.sql() call (from the
+            script, from here, from ExtractedTextSet) is profiled.
+            Each stmt is run (and timed) on its own, recording its wall
+            time, num of rows and approx num of bytes returned.
+            If explain is True, each tmp table build is run as
+            "explain (analyze, buffers, format json) create ..." which builds
+            the table and returns its query plan w/ actual timings and
+            buffer counts, and the plan is saved w/ the stmt's profile.
+            writeReport() writes all of it as a JSON file.
+    """
+    def __init__(self, db, explain=False):
+        self.db = db
+        self.dbSql = db.sql
+        self.explain = explain
+        self.profiles = []
+        self.startTime = time.time()
+    #----------------------
+
+    def install(self):
+        self.db.sql = self.sql
+        return self
+    #----------------------
+
+    def uninstall(self):
+        self.db.sql = self.dbSql
+        return self
+    #----------------------
+
+    def sql(self, cmds, parser='auto', **kw):
+        single = type(cmds) == type('')
+        if single: cmds = [cmds]
+
+        results = []
+        for cmd in cmds:
+            profile = { 'stmt': len(self.profiles) + 1,
+                        'sql' : ' '.join(cmd.split()),
+                      }
+            startTime = time.time()
+            if self.explain and TMP_TABLE_BUILD_RE.match(cmd):
+                planRcds = self.dbSql( \
+                        'explain (analyze, buffers, format json)\n' + cmd,
+                        parser, **kw)
+                profile['plan'] = [ r['QUERY PLAN'] for r in planRcds ]
+                result = None
+            else:
+                result = self.dbSql(cmd, parser, **kw)
+            profile['seconds'] = round(time.time() - startTime, 6)
+
+            if type(result) == type([]):
+                profile['rows'] = len(result)
+                profile['bytes'] = sum([ getRcdBytes(r) for r in result ])
+            else:
+                profile['rows'] = 0
+                profile['bytes'] = 0
+            self.profiles.append(profile)
+            results.append(result)
+
+        if single: return results[0]
+        return results
+    #----------------------
+
+    def writeReport(self, fileName,
+                    meta={},        # dict of info about the run to include
+                    ):
+        report = dict(meta)
+        report['totalSeconds'] = round(time.time() - self.startTime, 3)
+        report['sqlSeconds'] = round(sum([ p['seconds'] \
+                                            for p in self.profiles ]), 3)
+        report['numStmts'] = len(self.profiles)
+        report['statements'] = self.profiles
+        with open(fileName, 'w') as fp:
+            json.dump(report, fp, indent=2, default=str)
+    #----------------------
+# end class SqlProfiler ------------------------
+
+def getRcdBytes(rcd):
+    """ Return approx num of bytes in a result rcd: the length of each
+        (non-null) value as a string.
+    """
+    try:
+        values = rcd.values()
+    except AttributeError:
+        values = rcd
+    return sum([ len(str(v)) for v in values if v is not None ])
+#-----------------------------------
+
+def doAutomatedTests():
+
+    sys.stdout.write("Running automated unit tests...\n")
+    unittest.main(argv=[sys.argv[0], '-v'],)
+
+class MyTests(unittest.TestCase):
+    converters = COPY_TEXT_CONVERTERS
+
+    def copyData(self, rows, extension=b''):
+        """ Return binary COPY data for rows of (int, str, str) """
+        data = COPY_SIGNATURE + struct.pack('!ii', 0, len(extension)) \
+                                                                + extension
+        for row in rows:
+            data += struct.pack('!h', len(row))
+            for i, v in enumerate(row):
+                if v is None:
+                    data += struct.pack('!i', -1)
+                    continue
+                if i == 0: b = struct.pack('!i', v)
+                else:      b = v.encode('utf-8')
+                data += struct.pack('!i', len(b)) + b
+        return data + struct.pack('!h', -1)
+
+    def byteChunks(self, data):
+        return [ data[i:i+1] for i in range(len(data)) ]
+
+    def test_iterBinaryCopyRows(self):
+        rows = [ [1, 'body', 'some text'],
+                 [1, 'references', ''],
+                 [2, None, None],
+                 [300000, 'supp', 'caf\u00e9 \u00b5m\n;;|'],
+               ]
+        data = self.copyData(rows)
+        got = list(iterBinaryCopyRows([data], self.converters))
+        self.assertEqual(got, rows)
+
+        # fields split across chunks
+        got = list(iterBinaryCopyRows(self.byteChunks(data), self.converters))
+        self.assertEqual(got, rows)
+
+    def test_iterBinaryCopyRows_header(self):
+        rows = [ [5, 'body', 'text'] ]
+        data = self.copyData(rows, extension=b'ext data')
+        got = list(iterBinaryCopyRows(self.byteChunks(data), self.converters))
+        self.assertEqual(got, rows)
+
+        with self.assertRaises(ValueError):
+            list(iterBinaryCopyRows([b'x' + data[1:]], self.converters))
+
+    def test_iterBinaryCopyRows_trailer(self):
+        data = self.copyData([])
+        self.assertEqual(list(iterBinaryCopyRows([data], self.converters)), [])
+
+        # nothing after the trailer is decoded
+        data = self.copyData([ [7, 'body', 'a'] ]) + b'junk'
+        got = list(iterBinaryCopyRows(self.byteChunks(data), self.converters))
+        self.assertEqual(got, [ [7, 'body', 'a'] ])
+
+    def test_mergeRefs2ExtText(self):
+        closed = []
+        def textPairs():
+            try:
+                for k in [1, 2, 3, 5]: yield k, 'text %d' % k
+            finally:
+                closed.append(True)
+        rcds = [ Record(_refs_key=k) for k in [2, 3, 4, 5] ]
+        merged = mergeRefs2ExtText(rcds, textPairs(),
+                                        needsText=lambda r: r['_refs_key'] != 4)
+        self.assertEqual([ r.get('ext_text') for r in merged ],
+                                        ['text 2', 'text 3', None, 'text 5'])
+        self.assertEqual(closed, [True])
+
+        # closing the merge early closes the text pairs
+        closed = []
+        merged = mergeRefs2ExtText(rcds, textPairs())
+        self.assertEqual(next(merged)['ext_text'], 'text 2')
+        merged.close()
+        self.assertEqual(closed, [True])
+
+        with self.assertRaises(ValueError):       # ref 4 has no text
+            list(mergeRefs2ExtText(rcds, textPairs()))
+# end class MyTests ------------------------
+
+if __name__ == "__main__":
+    doAutomatedTests()
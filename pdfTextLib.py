@@ -0,0 +1,471 @@
+#!/usr/bin/env python3
+#
+# Library to extract text from the archived reference PDFs
+#  (used by sdGetExtText.py and sdGetGXD2ary.py --frompdf)
+#
+# Text is extracted by litparser's pdfGetFullText.sh (pdftotext), one
+#  subprocess per PDF. An extraction can be given a timeout: the script runs
+#  in its own process group (session) so that when it times out, the whole
+#  group (the shell script and the pdftotext it started) is killed.
+# PdfTextCache keeps the extracted text on disk, so rerunning an extraction
+#  for a PDF that has not changed (w/ the same extractor) is just a file stat.
+# iterOrderedExtractions() runs several extractions at once and hands back
+#  their results in the order they were asked for. Each extraction is its own
+#  process, so the pool is just threads waiting on the processes.
+# ExtractionMetrics collects per-PDF telemetry (PDF size, pages, chars,
+#  wall time, status), optionally writing it to a CSV or JSON sidecar file,
+#  and summarises it: latency percentiles, throughput, the slowest PDFs.
+#
+import os
+import sys
+import csv
+import json
+import time
+import heapq
+import random
+import shutil
+import signal
+import hashlib
+import tempfile
+import threading
+import collections
+import unittest
+import subprocess
+import concurrent.futures
+import Pdfpath
+import textCacheLib
+#-----------------------------------
+
+PDF_STORAGE_BASE_PATH = '/data/littriage'
+LITPARSER  = '/usr/local/mgi/live/mgiutils/litparser'
+EXTRACTOR  = os.path.join(LITPARSER, 'pdfGetFullText.sh')
+
+MAX_PENDING = 1000      # max num of items waiting to be handed back in order
+
+def getPdfPathName(mgiID):
+    """ Return the pathname of the archived PDF for an MGI ID """
+    prefix, numeric = mgiID.split(':')
+    return os.path.join(Pdfpath.getPdfpath(PDF_STORAGE_BASE_PATH, mgiID),
+                                                            numeric + '.pdf')
+#-----------------------------------
+
+class PdfTimeoutError (Exception):
+    """ An extraction took longer than its timeout and was killed """
+    pass
+#-----------------------------------
+
+def extractTextFromPdf(pdfPathName,
+    timeout=None,           # max num of seconds to wait, None = no max
+    info=None,              # dict to set 'exitCode' in, or None
+    ):
+    """ Return (text, error)
+        text = the extracted text from the PDF,
+        error = None or an error message if the text could not be extracted.
+        Raise PdfTimeoutError if the extraction takes longer than timeout
+        (its process group is killed).
+    """
+    cmd = [EXTRACTOR, pdfPathName]
+    cmdText = ' '.join(cmd)
+
+    process = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE, text=True, start_new_session=True)
+    try:
+        stdout, stderr = process.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        killProcessGroup(process)
+        process.communicate()                   # reap it
+        raise PdfTimeoutError("pdftotext timed out after %d seconds\n%s\n" \
+                                                        % (timeout, cmdText))
+    except BaseException:                       # e.g., KeyboardInterrupt
+        killProcessGroup(process)
+        raise
+
+    if info is not None: info['exitCode'] = process.returncode
+    if process.returncode != 0:
+        text = ''
+        error = "pdftotext error: %d\n%s\n%s\n%s\n" % \
+                        (process.returncode, cmdText, stderr, stdout)
+    else:
+        text = stdout
+        error = None
+
+    return text, error
+#-----------------------------------
+
+def killProcessGroup(process):
+    """ Kill process and everything it started (its process group) """
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:                  # already gone
+        pass
+#-----------------------------------
+
+def getPdfText(mgiID,
+    timeout=None,           # max num of seconds to wait, None = no max
+    cache=None,             # PdfTextCache or None
+    info=None,              # dict to fill in w/ 'pdfBytes', 'cached',
+                            #  'exitCode' (None if cached/timed out), or None
+    ):
+    """ Return (text, error) for the MGI ID's PDF, like extractTextFromPdf(),
+        from the cache if it has the text for the PDF as it is now.
+        Raise PdfTimeoutError if the extraction takes longer than timeout.
+    """
+    pdfPathName = getPdfPathName(mgiID)
+    if info is not None:
+        try:
+            info['pdfBytes'] = os.path.getsize(pdfPathName)
+        except OSError:
+            info['pdfBytes'] = None
+        info['cached'] = False
+        info['exitCode'] = None
+    if cache:
+        text = cache.get(mgiID, pdfPathName)
+        if text is not None:
+            if info is not None: info['cached'] = True
+            return text, None
+
+    text, error = extractTextFromPdf(pdfPathName, timeout, info)
+
+    if cache and not error:
+        cache.put(mgiID, pdfPathName, text)
+    return text, error
+#-----------------------------------
+
+CACHE_SECTION = 'pdftext'   # text cache section key for PDF text
+
+def getExtractorVersion():
+    """ Return a digest of the extractor script, changes if it does """
+    try:
+        with open(EXTRACTOR, 'rb') as fp:
+            return hashlib.sha256(fp.read()).hexdigest()[:16]
+    except OSError:
+        return 'unknown'
+#-----------------------------------
+
+class PdfTextCache (object):
+    """
+    IS:     an on-disk cache of the text extracted from PDFs
+    HAS:    a textCacheLib.TextCache, the extractor version
+    DOES:   get()/put() the text for an MGI ID's PDF.
+            Entries are keyed by the MGI ID's number. Their change token is
+            the PDF's size and modification time and the extractor version
+            (a digest of pdfGetFullText.sh), so cached text is only used if
+            neither the PDF nor the extractor has changed.
+            The raw extracted text is cached, so scripts that clean it up
+            differently can share a cache.
+            Thread safe (a lock around the TextCache).
+    """
+    def __init__(self, fileName,    # sqlite db file (created if needed)
+                maxMBytes=textCacheLib.DEFAULT_MAX_MBYTES,
+                ):
+        self.textCache = textCacheLib.TextCache(fileName, maxMBytes)
+        self.version = getExtractorVersion()
+        self.lock = threading.Lock()
+    #----------------------
+
+    def getToken(self, pdfPathName):
+        """ Return the change token for the PDF, None if we cannot stat it """
+        try:
+            stat = os.stat(pdfPathName)
+        except OSError:
+            return None
+        return '%d:%d:%s' % (stat.st_size, stat.st_mtime_ns, self.version)
+    #----------------------
+
+    def get(self, mgiID, pdfPathName):
+        """ Return the cached text or None if not cached or stale """
+        token = self.getToken(pdfPathName)
+        if token is None: return None
+        with self.lock:
+            return self.textCache.get(getCacheKey(mgiID), CACHE_SECTION, token)
+    #----------------------
+
+    def put(self, mgiID, pdfPathName, text):
+        token = self.getToken(pdfPathName)
+        if token is None: return
+        with self.lock:
+            self.textCache.put(getCacheKey(mgiID), CACHE_SECTION, token, text)
+            self.textCache.commit()
+    #----------------------
+
+    def getStats(self):
+        with self.lock:
+            return "PDF " + self.textCache.getStats()
+    #----------------------
+
+    def close(self):
+        with self.lock:
+            self.textCache.close()
+    #----------------------
+# end class PdfTextCache ------------------------
+
+def getCacheKey(mgiID):
+    """ Return the cache key for an MGI ID: its number """
+    return int(mgiID.split(':')[1])
+#-----------------------------------
+
+METRICS_FIELDNAMES = ['mgiID', 'journal', 'attempt', 'status', 'exitCode',
+                        'pdfBytes', 'numPages', 'numChars', 'wallTime']
+STATUSES  = ['ok', 'error', 'timeout', 'cached']
+SLOWEST_N = 10          # default num of slowest extractions to report
+MBYTE     = 1024 * 1024
+
+def countPages(text):
+    """ Return the num of pages in text from pdftotext (it ends each page
+        w/ a form feed)
+    """
+    return text.count('\f')
+#-----------------------------------
+
+def getPercentile(values,   # sorted list of numbers
+    percent,                # 0 - 100
+    ):
+    """ Return the (nearest rank) percentile of values, None if no values """
+    if not values: return None
+    rank = max(int(-(-percent * len(values) // 100)), 1)   # ceiling
+    return values[rank - 1]
+#-----------------------------------
+
+class ExtractionMetrics (object):
+    """
+    IS:     telemetry for a run of PDF text extractions
+    HAS:    optional sidecar file, the wall time of every extraction,
+            totals, counts by status, the slowest extractions
+    DOES:   add(metrics) records an extraction's metrics:
+                {fieldname: value} for the METRICS_FIELDNAMES,
+                status is one of STATUSES
+              and writes it to the sidecar file (if any) as it goes:
+                CSV w/ a header line, or if the file name ends in .json or
+                .jsonl, one JSON object per line.
+                W/ append (e.g., resuming a run), adds to the file instead
+                of replacing it (and only writes the header to a new file).
+            getSummary() returns a report of the extractions (cached text
+              is counted but left out of the latency and throughput):
+                p50/p95/p99 wall time, pages/s and MB/s (over the run's
+                elapsed time and per extraction), the slowest N.
+            Only the wall times and the slowest N are kept in memory.
+    """
+    def __init__(self, fileName=None,   # sidecar file pathname, or None
+                slowestN=SLOWEST_N,     # num of slowest extractions to keep
+                append=False,           # T/F append to the sidecar file
+                ):
+        self.fileName = fileName
+        self.slowestN = slowestN
+        self.fp = None
+        self.csvWriter = None
+        if fileName:
+            self.fp = open(fileName, 'a' if append else 'w', newline='')
+            if not fileName.endswith(('.json', '.jsonl')):
+                self.csvWriter = csv.DictWriter(self.fp, METRICS_FIELDNAMES)
+                if self.fp.tell() == 0: self.csvWriter.writeheader()
+
+        self.startTime = time.time()
+        self.statusCounts = collections.Counter()
+        self.wallTimes  = []        # of the (uncached) extractions
+        self.slowest    = []        # heap of (wallTime, num, metrics)
+        self.numAdded   = 0
+        self.totalBytes = 0
+        self.totalPages = 0
+        self.totalChars = 0
+    #----------------------
+
+    def add(self, metrics,          # {fieldname: value}
+        ):
+        if self.csvWriter:
+            self.csvWriter.writerow(metrics)
+        elif self.fp:
+            self.fp.write(json.dumps(metrics) + '\n')
+
+        self.numAdded += 1
+        self.statusCounts[metrics['status']] += 1
+        if metrics['status'] == 'cached':
+            return self
+
+        self.wallTimes.append(metrics['wallTime'])
+        self.totalBytes += metrics['pdfBytes'] or 0
+        self.totalPages += metrics['numPages'] or 0
+        self.totalChars += metrics['numChars'] or 0
+
+        item = (metrics['wallTime'], self.numAdded, metrics)
+        if len(self.slowest) < self.slowestN:
+            heapq.heappush(self.slowest, item)
+        elif self.slowestN:
+            heapq.heappushpop(self.slowest, item)
+        return self
+    #----------------------
+
+    def getSummary(self):
+        """ Return the report of the extractions so far """
+        elapsed = time.time() - self.startTime
+        totalWall = sum(self.wallTimes)
+        mBytes = self.totalBytes / MBYTE
+        wallTimes = sorted(self.wallTimes)
+
+        lines = []
+        lines.append("PDF extraction metrics: %d extractions (%s)" % \
+                    (self.numAdded, ', '.join([ "%d %s" % \
+                    (self.statusCounts[s], s) for s in STATUSES ])))
+        if wallTimes:
+            lines.append("  wall time p50 %8.3f  p95 %8.3f  p99 %8.3f  " % \
+                        tuple([ getPercentile(wallTimes, p) \
+                                        for p in (50, 95, 99) ]) +
+                        "max %8.3f seconds" % wallTimes[-1])
+            lines.append("  %d pages, %.1f MB of PDFs, %d chars of text" % \
+                        (self.totalPages, mBytes, self.totalChars))
+            for label, seconds in [('overall', elapsed),
+                                    ('per extraction', totalWall)]:
+                seconds = max(seconds, 1e-6)
+                lines.append("  %-15s %8.1f pages/s %8.2f MB/s" % \
+                    (label + ':', self.totalPages / seconds, mBytes / seconds))
+        if self.slowest:
+            lines.append("  slowest %d:" % len(self.slowest))
+            for wallTime, num, m in sorted(self.slowest, reverse=True):
+                lines.append("    %-12s %8.3f seconds  %-7s %5s pages " % \
+                    (m['mgiID'], wallTime, m['status'], m['numPages']) +
+                    "%7.2f MB  %s" % ((m['pdfBytes'] or 0) / MBYTE,
+                                                        m['journal'] or ''))
+        if self.fileName:
+            lines.append("  metrics written to '%s'" % self.fileName)
+        return '\n'.join(lines) + '\n'
+    #----------------------
+
+    def close(self):
+        if self.fp:
+            self.fp.close()
+            self.fp = None
+    #----------------------
+# end class ExtractionMetrics ------------------------
+
+def iterOrderedExtractions(items,   # iterable of (item, arg), arg is None
+                                    #  if the item needs no extraction
+    extractFunc,                    # function(arg) -> result, thread safe
+    numJobs=1,                      # max num of extractFunc calls at once
+    maxPending=MAX_PENDING,         # max num of items waiting
+    ):
+    """
+    Generator: yield (item, extractFunc(arg)) for each of the items in order,
+        (item, None) for items w/ arg None.
+    Up to numJobs extractFunc calls run concurrently. We only read ahead in
+        items while fewer than 2*numJobs calls are outstanding and fewer than
+        maxPending items are waiting for the item at the head of the line,
+        so memory stays bounded.
+    """
+    maxInFlight = max(numJobs, 1) * 2
+    pending = collections.deque()   # (item, future or None) in order
+    inFlight = 0                    # num of futures in pending
+
+    with concurrent.futures.ThreadPoolExecutor(max(numJobs, 1)) as pool:
+        for item, arg in items:
+            future = None
+            if arg is not None:
+                future = pool.submit(extractFunc, arg)
+                inFlight += 1
+            pending.append( (item, future) )
+
+            # hand back items from the head of the line that are done,
+            #  wait for the head if we have read ahead far enough
+            while pending:
+                headFuture = pending[0][1]
+                if headFuture is not None and not headFuture.done() \
+                        and inFlight < maxInFlight \
+                        and len(pending) < maxPending:
+                    break
+                item, future = pending.popleft()
+                if future is None:
+                    yield item, None
+                else:
+                    inFlight -= 1
+                    yield item, future.result()
+
+        while pending:
+            item, future = pending.popleft()
+            yield item, (future.result() if future is not None else None)
+#-----------------------------------
+
+def doAutomatedTests():
+
+    sys.stdout.write("Running automated unit tests...\n")
+    unittest.main(argv=[sys.argv[0], '-v'],)
+
+class MyTests(unittest.TestCase):
+    def test_iterOrderedExtractions(self):
+        lock = threading.Lock()
+        running = [0, 0]                # [num running now, max num running]
+        def extract(arg):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(random.random() / 100)
+            with lock: running[0] -= 1
+            return arg.upper()
+
+        items = [ ('id%d' % i, None if i % 3 == 0 else 'text%d' % i) \
+                                                            for i in range(60) ]
+        got = list(iterOrderedExtractions(items, extract, numJobs=4))
+        expected = [ (item, None if arg is None else arg.upper()) \
+                                                        for item, arg in items ]
+        self.assertEqual(got, expected)
+        self.assertLessEqual(running[1], 4)
+
+        got = list(iterOrderedExtractions(items, extract, numJobs=1))
+        self.assertEqual(got, expected)
+        self.assertEqual(list(iterOrderedExtractions([], extract)), [])
+
+    def test_iterOrderedExtractions_readAhead(self):
+        read = []
+        def items():
+            for i in range(100):
+                read.append(i)
+                yield i, i
+        headDone = threading.Event()
+        def extract(arg):
+            if arg == 0:                # the head of the line is slow
+                headDone.wait(1)
+            return arg
+        results = iterOrderedExtractions(items(), extract, numJobs=2,
+                                                                maxPending=10)
+        self.assertEqual(next(results), (0, 0))
+        # read ahead stops at 2*numJobs extractions in flight
+        self.assertLessEqual(len(read), 2 * 2 + 1)
+        headDone.set()
+        self.assertEqual([ x for x, y in results ], list(range(1, 100)))
+
+    def test_iterOrderedExtractions_error(self):
+        def extract(arg):
+            if arg == 5: raise RuntimeError('extractor died')
+            return arg
+        results = iterOrderedExtractions([ (i, i) for i in range(10) ],
+                                                            extract, numJobs=3)
+        got = []
+        with self.assertRaises(RuntimeError):
+            for item, result in results: got.append(item)
+        self.assertEqual(got, [0, 1, 2, 3, 4])
+
+    def test_ExtractionMetrics_append(self):
+        tmpDir = tempfile.mkdtemp()
+        try:
+            for baseName in ['m.csv', 'm.jsonl']:
+                fileName = os.path.join(tmpDir, baseName)
+                for mgiID, append in [('MGI:1', False), ('MGI:2', True),
+                                                        ('MGI:3', True)]:
+                    metrics = ExtractionMetrics(fileName, append=append)
+                    metrics.add({'mgiID': mgiID, 'status': 'ok',
+                                            'wallTime': 1.0, 'pdfBytes': 10,
+                                            'numPages': 1, 'numChars': 5})
+                    metrics.close()
+                with open(fileName, 'r') as fp: lines = fp.readlines()
+                self.assertEqual(len(lines), 4 if baseName == 'm.csv' else 3)
+                self.assertIn('MGI:1', lines[-3])
+                self.assertIn('MGI:3', lines[-1])
+
+                metrics = ExtractionMetrics(fileName)   # starts over
+                metrics.close()
+                self.assertEqual(os.path.getsize(fileName),
+                                    0 if baseName == 'm.jsonl' else \
+                                    len(','.join(METRICS_FIELDNAMES)) + 2)
+        finally:
+            shutil.rmtree(tmpDir)
+# end class MyTests ------------------------
+
+if __name__ == "__main__":
+    doAutomatedTests()
@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+#
+# Library to overlap the stages of building a sample file, shared by the
+#  sample data extraction scripts (sdGetMGIRefs.py, sdGetRawPrimTriage.py)
+#
+# Building samples is three stages:
+#   fetch   - pull ref records and their extracted text from the db
+#               (mostly waiting on the network)
+#   build   - clean up the text and build sample records (CPU)
+#   write   - serialise the samples to the output files (disk)
+# Run one after another, the db sits idle while we build and write and the
+#  reverse. A Pipeline runs them concurrently:
+#   a fetch thread iterates the record batches (so the db calls all happen
+#       in that one thread) and queues each batch,
+#   a pool of build threads turns queued batches into results,
+#   the caller iterates the Pipeline to get the results, in the original
+#       order, and writes them.
+# At most maxBatches batches are in flight (fetched but not yet handed to
+#  the caller), so when the writer falls behind, fetching stops
+#  (backpressure) and memory stays bounded.
+# If the caller stops early, the batches iterable is closed (in the fetch
+#  thread) if it is a generator, so whatever it holds (e.g., a server-side
+#  cursor) is released right away.
+#
+# Note the build threads share the GIL: the gain is from overlapping db
+#  waits and file I/O w/ the building, not from building in parallel.
+#
+import sys
+import time
+import queue
+import random
+import threading
+import unittest
+#-----------------------------------
+
+NUM_THREADS   = 2       # default num of build threads
+QUEUE_BATCHES = 4       # default max num of batches in flight
+
+def iterBatches(items,      # iterable
+    batchSize,              # max num of items per batch
+    ):
+    """ Generator: yield lists of up to batchSize items from items.
+        Closes items (if it is a generator) when it is closed.
+    """
+    batch = []
+    try:
+        for item in items:
+            batch.append(item)
+            if len(batch) >= batchSize:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+    finally:
+        closeIterator(items)
+#-----------------------------------
+
+def closeIterator(items):
+    """ Close items if it is a generator (or anything else w/ close()) """
+    close = getattr(items, 'close', None)
+    if close: close()
+#-----------------------------------
+
+_DONE = object()        # end of queue marker for the build threads
+
+class Pipeline (object):
+    """
+    IS:     a fetch -> build -> write pipeline
+    HAS:    an iterable of batches to fetch, a function to build results,
+            a fetch thread, build threads, the queue of fetched batches,
+            the built batches waiting to be handed to the caller
+    DOES:   iterating the Pipeline starts the threads and yields
+            buildFunc(item) for every item in every batch, in order.
+            An exception in the fetch or build stage is raised to the caller.
+            If the caller stops iterating (or raises), the threads stop
+            after the batch they are on.
+    """
+    def __init__(self, batches,     # iterable of lists of items (e.g., rcds)
+                buildFunc,          # function(item) -> result,
+                                    #  must be thread safe
+                numThreads=NUM_THREADS,     # num of build threads
+                maxBatches=QUEUE_BATCHES,   # max num of batches in flight
+                ):
+        self.batches = batches
+        self.buildFunc = buildFunc
+        self.numThreads = max(numThreads, 1)
+        self.slots = threading.Semaphore(max(maxBatches, 1))
+        self.fetched = queue.Queue()    # (batch num, batch) to build
+        self.built = {}                 # {batch num: list of results}
+        self.cond = threading.Condition()   # guards built, numBatches, error
+        self.numBatches = None          # total num of batches once fetched
+        self.error = None               # 1st exception from a thread
+        self.stopped = False
+    #----------------------
+
+    def fetch(self):
+        """ Fetch thread: queue each batch, waiting for a free slot """
+        numBatches = 0
+        try:
+            for batch in self.batches:
+                while not self.slots.acquire(timeout=0.1):
+                    if self.stopped: return
+                if self.stopped: return
+                self.fetched.put( (numBatches, batch) )
+                numBatches += 1
+        except BaseException as e:
+            self.setError(e)
+        finally:
+            try:
+                closeIterator(self.batches)     # e.g., release a db cursor
+            except BaseException as e:
+                self.setError(e)
+            with self.cond:
+                self.numBatches = numBatches
+                self.cond.notify_all()
+            for i in range(self.numThreads):
+                self.fetched.put(_DONE)
+    #----------------------
+
+    def build(self):
+        """ Build thread: build results for queued batches until done """
+        buildFunc = self.buildFunc
+        while True:
+            item = self.fetched.get()
+            if item is _DONE or self.stopped: return
+            batchNum, batch = item
+            try:
+                results = [ buildFunc(x) for x in batch ]
+            except BaseException as e:
+                self.setError(e)
+                return
+            with self.cond:
+                self.built[batchNum] = results
+                self.cond.notify_all()
+    #----------------------
+
+    def setError(self, e):
+        with self.cond:
+            if self.error is None: self.error = e
+            self.cond.notify_all()
+    #----------------------
+
+    def __iter__(self):
+        threads = [ threading.Thread(target=self.fetch, daemon=True) ] + \
+                  [ threading.Thread(target=self.build, daemon=True) \
+                                            for i in range(self.numThreads) ]
+        for t in threads: t.start()
+        batchNum = 0
+        try:
+            while True:
+                with self.cond:
+                    while batchNum not in self.built and self.error is None \
+                            and (self.numBatches is None or \
+                                                batchNum < self.numBatches):
+                        self.cond.wait()
+                    if self.error is not None: raise self.error
+                    if batchNum not in self.built: break    # all done
+                    results = self.built.pop(batchNum)
+                self.slots.release()
+                for result in results:
+                    yield result
+                batchNum += 1
+        finally:
+            self.stopped = True
+            for t in threads: t.join()
+    #----------------------
+# end class Pipeline ------------------------
+
+def doAutomatedTests():
+
+    sys.stdout.write("Running automated unit tests...\n")
+    unittest.main(argv=[sys.argv[0], '-v'],)
+
+class MyTests(unittest.TestCase):
+    def slowSquare(self, x):
+        time.sleep(random.random() / 1000)
+        return x * x
+
+    def test_iterBatches(self):
+        self.assertEqual(list(iterBatches(range(5), 2)), [[0,1], [2,3], [4]])
+        self.assertEqual(list(iterBatches([], 2)), [])
+
+    def test_order(self):
+        pipeline = Pipeline(iterBatches(range(200), 7), self.slowSquare,
+                                                    numThreads=4, maxBatches=2)
+        self.assertEqual(list(pipeline), [ x * x for x in range(200) ])
+        self.assertEqual(list(Pipeline([], self.slowSquare)), [])
+
+    def test_buildError(self):
+        def build(x):
+            if x == 42: raise ValueError('bad item')
+            return x
+        pipeline = Pipeline(iterBatches(range(100), 5), build, numThreads=3)
+        with self.assertRaises(ValueError):
+            list(pipeline)
+
+    def test_fetchError(self):
+        def batches():
+            yield [1, 2]
+            raise KeyError('db gone')
+        with self.assertRaises(KeyError):
+            list(Pipeline(batches(), self.slowSquare))
+
+    def test_earlyStop(self):
+        fetched = []
+        closed = []
+        def items():
+            try:
+                for i in range(10000):
+                    fetched.append(i)
+                    yield i
+            finally:
+                closed.append(True)
+        results = iter(Pipeline(iterBatches(items(), 10), self.slowSquare,
+                                                    numThreads=2, maxBatches=3))
+        self.assertEqual(next(results), 0)
+        time.sleep(0.2)
+        # backpressure: no more than maxBatches in flight, + 1 being queued
+        self.assertLessEqual(len(fetched), 10 * (3 + 2))
+        closeIterator(results)
+        self.assertEqual(closed, [True])
+# end class MyTests ------------------------
+
+if __name__ == "__main__":
+    doAutomatedTests()
@@ -0,0 +1,1159 @@
+#!/usr/bin/env python3
+#
+# Library of helpers for reading/writing sample files
+#  (files of sample records as written by SampleSet.write())
+#
+# A sample file is a header (meta data + field names) followed by sample
+#  records. Each record is the sample's fields joined by the sample's fieldSep
+#  and terminated by its recordEnd.
+#
+# A sample file written by SampleStreamWriter can have an index sidecar file
+#  giving the byte offset of each record, so IndexedSampleFile can read
+#  records by ID or _refs_key w/o parsing the records before them.
+#
+# ShardedSampleWriter writes samples to a set of shard sample files of bounded
+#  size plus a JSON manifest w/ each shard's sample count, ID range and
+#  checksum, so shards can be processed (and copied/retried) independently.
+#
+# CheckpointedSampleWriter writes a sample file that a later run can resume
+#  if this one dies: it periodically commits what it has written, w/ the
+#  _refs_key of the last sample written as a high-water mark.
+#
+# LazySampleFile memory maps a sample file (or streams a compressed one) and
+#  only parses a record's fields when they are asked for, for fast scans
+#  over big sample files.
+#
+# Sample files can be compressed, chosen by file name extension:
+#   .gz     gzip (python gzip module)
+#   .zst    zstd (needs the zstandard package), compressed w/ multiple threads
+#  openSampleFile() opens sample files of any of these (or uncompressed)
+#  as text files that (de)compress as they are written/read.
+#
+import os
+import io
+import sys
+import gzip
+import mmap
+import json
+import shutil
+import hashlib
+import tempfile
+import unittest
+try:
+    import zstandard        # only needed for .zst sample files
+except ImportError:
+    zstandard = None
+#-----------------------------------
+
+GZIP_LEVEL   = 6            # gzip compression level
+ZSTD_LEVEL   = 3            # zstd compression level
+ZSTD_THREADS = -1           # num of zstd compression threads, -1 = num of cpus
+
+def openSampleFile(fileName,    # pathname, '.gz' or '.zst' to compress
+    mode='r',                   # 'r' or 'w' (or 'rb' for a binary file)
+    threads=ZSTD_THREADS,       # num of zstd compression threads for 'w'
+    ):
+    """ Return an open text file for reading/writing a sample file,
+        compressed/decompressed as it is written/read if fileName ends in
+        .gz or .zst
+    """
+    if fileName.endswith('.gz'):
+        if 'b' not in mode: mode += 't'
+        return gzip.open(fileName, mode, compresslevel=GZIP_LEVEL)
+
+    if fileName.endswith('.zst'):
+        if zstandard is None:
+            raise ImportError("zstandard is needed for '%s'" % fileName)
+        if mode.startswith('w'):
+            compressor = zstandard.ZstdCompressor(level=ZSTD_LEVEL,
+                                                            threads=threads)
+            stream = compressor.stream_writer(open(fileName, 'wb'))
+        else:
+            decompressor = zstandard.ZstdDecompressor()
+            stream = decompressor.stream_reader(open(fileName, 'rb'),
+                                                    read_across_frames=True)
+        if 'b' in mode: return stream
+        return io.TextIOWrapper(stream)
+
+    return open(fileName, mode)
+#-----------------------------------
+
+def readSampleSet(sampleSet,    # (empty) SampleSet to read the samples into
+    fileName,                   # sample file pathname, may be compressed
+    ):
+    """ Read a (possibly compressed) sample file into sampleSet.
+        Return sampleSet
+    """
+    with openSampleFile(fileName, 'r') as fp:
+        sampleSet.read(fp)
+    return sampleSet
+#-----------------------------------
+
+def writeSampleSet(sampleSet,   # SampleSet to write
+    fileName,                   # sample file pathname, '.gz'/'.zst' compress
+    ):
+    """ Write sampleSet to a (possibly compressed) sample file """
+    with openSampleFile(fileName, 'w') as fp:
+        sampleSet.write(fp)
+    return sampleSet
+#-----------------------------------
+
+def sample2Text(sample):
+    """ Return the text of a sample as a sample file record
+        (w/o the record ending)
+    """
+    return sample.getFieldSep().join( \
+                            [ sample.getField(fn) for fn in sample.fieldNames ])
+#-----------------------------------
+
+READ_CHUNK_SIZE = 4 * 1024 * 1024     # num of chars to read at a time
+
+def iterRecords(fp,         # open file of sample records (no header)
+    recordEnd,              # record ending str
+    chunkSize=READ_CHUNK_SIZE,
+    ):
+    """ Generator: yield the text of each record in fp (w/o the record ending)
+        reading fp a chunk at a time.
+    """
+    leftOver = ''
+    while True:
+        chunk = fp.read(chunkSize)
+        if not chunk: break
+        records = (leftOver + chunk).split(recordEnd)
+        leftOver = records.pop()
+        for record in records:
+            yield record
+    if leftOver.strip():
+        yield leftOver
+#-----------------------------------
+
+INDEX_EXT        = '.idx'       # index sidecar file = sample file + INDEX_EXT
+INDEX_KEY_FIELDS = ['ID', '_refs_key']  # sample fields a record is found by
+INDEX_FIELDNAMES = INDEX_KEY_FIELDS + ['offset', 'length']
+
+def getIndexFileName(sampleFileName):
+    return sampleFileName + INDEX_EXT
+#-----------------------------------
+
+def getByteLength(text):
+    if text.isascii(): return len(text)
+    return len(text.encode('utf-8'))
+#-----------------------------------
+
+class SampleStreamWriter (object):
+    """
+    IS:     a writer that outputs samples to a sample file as they are built
+            instead of collecting them all in a SampleSet first.
+    HAS:    output file, SampleSet meta data, count of samples written,
+            optional index file
+    DOES:   writes the file header by writing an empty SampleSet (so it is the
+            same header SampleSet.write() produces), then writes each sample
+            record as it is given.
+            If given an index file, writes an index line for each record:
+                ID, _refs_key, byte offset of the record in the sample file,
+                byte length of the record (w/o its record ending)
+            (the index needs an uncompressed sample file we can tell() on)
+    """
+    def __init__(self, outFile,     # file pathname (may be .gz/.zst) or
+                                    #  open file (e.g., stdout)
+                sampleSet,          # (empty) SampleSet w/ meta items set
+                indexFile=None,     # index file pathname or open file
+                appending=False,    # T/F outFile already has the header
+                ):
+        if type(outFile) == type(''):
+            self.fp = openSampleFile(outFile, 'w')
+            self.closeFile = True
+        else:
+            self.fp = outFile
+            self.closeFile = False
+
+        self.indexFp = None
+        self.closeIndexFile = False
+        if type(indexFile) == type(''):
+            self.indexFp = open(indexFile, 'w')
+            self.closeIndexFile = True
+        elif indexFile:
+            self.indexFp = indexFile
+
+        self.sampleSet = sampleSet
+        self.numSamples = 0
+        self.headerWritten = appending
+        self.offset = 0             # byte offset of the next record
+    #----------------------
+
+    def writeHeader(self):
+        self.sampleSet.write(self.fp)
+        self.headerWritten = True
+        if self.indexFp:
+            self.fp.flush()
+            self.offset = self.fp.tell()
+            self.indexFp.write('\t'.join(INDEX_FIELDNAMES) + '\n')
+        return self
+    #----------------------
+
+    def writeSample(self, sample):
+        if not self.headerWritten: self.writeHeader()
+        text = sample2Text(sample)
+        self.fp.write(text + sample.getRecordEnd())
+        if self.indexFp:
+            self.writeIndexLine([ sample.getField(fn) \
+                                    for fn in INDEX_KEY_FIELDS ], text,
+                                    sample.getRecordEnd())
+        self.numSamples += 1
+        return self
+    #----------------------
+
+    def writeRecord(self, text,     # record text (w/o the record ending)
+                    recordEnd,
+                    keys=None,      # list of the record's INDEX_KEY_FIELDS,
+                                    #  needed if writing an index
+                    ):
+        """ Write a sample record that is already text, e.g., a record
+            read from another sample file, w/o building its sample.
+        """
+        if not self.headerWritten: self.writeHeader()
+        self.fp.write(text + recordEnd)
+        if self.indexFp:
+            self.writeIndexLine(keys, text, recordEnd)
+        self.numSamples += 1
+        return self
+    #----------------------
+
+    def writeIndexLine(self, keys,  # list of the record's INDEX_KEY_FIELDS
+                        text,       # the record text
+                        recordEnd,
+                        ):
+        length = getByteLength(text)
+        self.indexFp.write('\t'.join(keys + [str(self.offset), str(length)]) \
+                                                                    + '\n')
+        self.offset += length + getByteLength(recordEnd)
+    #----------------------
+
+    def writeRecordsFile(self, fileName,    # file of sample records
+                        numSamples,         # num of records in the file
+                        sampleObjType=None, # sample python class, needed if
+                                            #  writing an index
+                        ):
+        """ Append a file of sample records (no header) that was written
+            elsewhere, e.g., by a worker process.
+        """
+        if not self.headerWritten: self.writeHeader()
+        with open(fileName, 'r', newline='') as fp:     # keep any '\r's
+            if not self.indexFp:
+                shutil.copyfileobj(fp, self.fp)
+            else:
+                recordEnd = sampleObjType.getRecordEnd()
+                fieldSep  = sampleObjType.getFieldSep()
+                keyIndexes = [ sampleObjType.fieldNames.index(fn) \
+                                                for fn in INDEX_KEY_FIELDS ]
+                for text in iterRecords(fp, recordEnd):
+                    self.fp.write(text + recordEnd)
+                    fields = text.split(fieldSep)
+                    self.writeIndexLine([ fields[i] for i in keyIndexes ],
+                                                            text, recordEnd)
+        self.numSamples += numSamples
+        return self
+    #----------------------
+
+    def getNumSamples(self): return self.numSamples
+
+    def close(self):
+        if not self.headerWritten: self.writeHeader()
+        self.fp.flush()
+        if self.closeFile: self.fp.close()
+        if self.closeIndexFile: self.indexFp.close()
+    #----------------------
+# end class SampleStreamWriter ------------------------
+
+class IndexedSampleFile (object):
+    """
+    IS:     a random access reader of an (uncompressed) sample file
+    HAS:    the sample file, its index (see SampleStreamWriter)
+    DOES:   gets samples by ID or _refs_key by seeking straight to their
+            records, w/o reading the records before them.
+    """
+    def __init__(self, fileName,    # sample file pathname
+                sampleObjType,      # sample python class of the samples
+                indexFile=None,     # index file, default fileName + INDEX_EXT
+                ):
+        self.fileName = fileName
+        self.sampleObjType = sampleObjType
+        self.fieldSep = sampleObjType.getFieldSep()
+        self.fp = open(fileName, 'rb')
+
+        # {ID or _refs_key: (offset, length)}
+        self.locations = {}
+        with open(indexFile or getIndexFileName(fileName), 'r') as fp:
+            fp.readline()                                   # header line
+            for line in fp:
+                ID, refKey, offset, length = line.rstrip('\n').split('\t')
+                location = (int(offset), int(length))
+                self.locations[ID] = location
+                self.locations[refKey] = location
+    #----------------------
+
+    def has(self, key): return key in self.locations
+
+    def getRecordText(self, key,    # ID or _refs_key
+        ):
+        """ Return the text of the key's record or None if not in the file """
+        location = self.locations.get(str(key))
+        if location is None: return None
+        offset, length = location
+        self.fp.seek(offset)
+        return self.fp.read(length).decode('utf-8')
+    #----------------------
+
+    def getSample(self, key,        # ID or _refs_key
+        ):
+        """ Return the key's sample or None if it is not in the file """
+        text = self.getRecordText(key)
+        if text is None: return None
+        return self.text2Sample(text)
+    #----------------------
+
+    def text2Sample(self, text):
+        sample = self.sampleObjType()
+        return sample.setFields(dict(zip(sample.fieldNames,
+                                                    text.split(self.fieldSep))))
+    #----------------------
+
+    def getSamples(self, keys,      # list of IDs and/or _refs_keys
+        ):
+        """ Return list of the keys' samples in the order of keys,
+            None for keys not in the file.
+            Records are read in file order to keep seeks short.
+        """
+        found = [ str(k) for k in keys if str(k) in self.locations ]
+        samples = {}
+        for key in sorted(set(found), key=lambda k: self.locations[k][0]):
+            samples[key] = self.getSample(key)
+        return [ samples.get(str(k)) for k in keys ]
+    #----------------------
+
+    def iterSamples(self, keys,     # iterable of IDs and/or _refs_keys
+        ):
+        """ Generator: yield the sample for each key that is in the file """
+        for key in keys:
+            sample = self.getSample(key)
+            if sample is not None:
+                yield sample
+    #----------------------
+
+    def close(self):
+        self.fp.close()
+    #----------------------
+# end class IndexedSampleFile ------------------------
+
+SHARD_NUM_FORMAT = '%04d'       # shard num in shard file names
+MANIFEST_EXT     = '.manifest.json'
+
+SAMPLE_FILE_EXTS = ['.txt']            # known sample file extensions
+COMPRESS_EXTS    = ['.gz', '.zst']      # and compression extensions
+
+def splitSampleFileExts(fileName):
+    """ Return (name, exts): exts is the known sample file and compression
+        extensions at the end of fileName (maybe ''),
+        e.g., refs.v2.txt.gz -> (refs.v2, .txt.gz)
+    """
+    name, exts = fileName, ''
+    for knownExts in [COMPRESS_EXTS, SAMPLE_FILE_EXTS]:
+        base, ext = os.path.splitext(name)
+        if ext in knownExts:
+            name, exts = base, ext + exts
+    return name, exts
+#-----------------------------------
+
+def getShardFileName(fileName,  # sample file pathname the shards are for
+    shardNum,
+    ):
+    """ Return the name of a shard file: the shard num is inserted before the
+        sample file extensions, e.g., selected.txt.gz -> selected.0003.txt.gz
+    """
+    name, exts = splitSampleFileExts(fileName)
+    return name + '.' + SHARD_NUM_FORMAT % shardNum + exts
+#-----------------------------------
+
+def getManifestFileName(fileName):
+    return splitSampleFileExts(fileName)[0] + MANIFEST_EXT
+#-----------------------------------
+
+def getFileChecksum(fileName):
+    """ Return the sha256 hex digest of the bytes in a file """
+    checksum = hashlib.sha256()
+    with open(fileName, 'rb') as fp:
+        for block in iter(lambda: fp.read(1024 * 1024), b''):
+            checksum.update(block)
+    return checksum.hexdigest()
+#-----------------------------------
+
+class ShardedSampleWriter (object):
+    """
+    IS:     a writer that outputs samples to a set of shard sample files
+    HAS:    max samples and/or max bytes per shard, the current shard's
+            SampleStreamWriter, info about each shard written
+    DOES:   same write methods as SampleStreamWriter. Each shard is a
+            complete sample file (w/ header). A new shard is started when
+            the current one reaches max samples or max (uncompressed) bytes.
+            close() writes the manifest (see getManifestFileName()):
+              meta items, total samples, and for each shard: file name,
+              num of samples, bytes, file bytes, sha256 of the file,
+              first/last ID, min/max _refs_key (if the samples have them)
+    """
+    def __init__(self, fileName,    # sample file pathname the shards are for
+                                    #  (may be .gz/.zst)
+                sampleSet,          # (empty) SampleSet w/ meta items set
+                maxSamples=0,       # max samples per shard, 0 = no max
+                maxBytes=0,         # max bytes per shard, 0 = no max
+                metaItems={},       # {meta item: value} for the manifest
+                ):
+        self.fileName = fileName
+        self.sampleSet = sampleSet
+        self.maxSamples = maxSamples
+        self.maxBytes = maxBytes
+        self.metaItems = metaItems
+        self.shards = []            # info dict for each finished shard
+        self.writer = None          # SampleStreamWriter for current shard
+        self.numSamples = 0
+        self.closed = False
+    #----------------------
+
+    def startShard(self):
+        shardFileName = getShardFileName(self.fileName, len(self.shards))
+        self.writer = SampleStreamWriter(shardFileName, self.sampleSet)
+        self.writer.writeHeader()
+        self.shard = { 'file'       : os.path.basename(shardFileName),
+                       'numSamples' : 0,
+                       'bytes'      : 0,
+                       'firstID'    : None,
+                       'lastID'     : None,
+                       'minRefsKey' : None,
+                       'maxRefsKey' : None,
+                     }
+        self.shardFileName = shardFileName
+    #----------------------
+
+    def endShard(self):
+        self.writer.close()
+        self.shard['fileBytes'] = os.path.getsize(self.shardFileName)
+        self.shard['sha256'] = getFileChecksum(self.shardFileName)
+        self.shards.append(self.shard)
+        self.writer = None
+    #----------------------
+
+    def writeSample(self, sample):
+        keys = [ sample.getField(fn) if fn in sample.fieldNames else None \
+                                                for fn in INDEX_KEY_FIELDS ]
+        return self.writeRecord(sample2Text(sample), sample.getRecordEnd(),
+                                                                        keys)
+    #----------------------
+
+    def writeRecord(self, text,     # record text (w/o the record ending)
+                    recordEnd,
+                    keys=None,      # [ID, _refs_key] of the record (or None)
+                    ):
+        if self.writer is None: self.startShard()
+        self.writer.writeRecord(text, recordEnd)
+
+        shard = self.shard
+        ID, refKey = keys or [None, None]
+        shard['numSamples'] += 1
+        shard['bytes'] += getByteLength(text) + getByteLength(recordEnd)
+        if shard['firstID'] is None: shard['firstID'] = ID
+        shard['lastID'] = ID
+        if refKey is not None:
+            refKey = int(refKey)
+            if shard['minRefsKey'] is None or refKey < shard['minRefsKey']:
+                shard['minRefsKey'] = refKey
+            if shard['maxRefsKey'] is None or refKey > shard['maxRefsKey']:
+                shard['maxRefsKey'] = refKey
+        self.numSamples += 1
+
+        if (self.maxSamples and shard['numSamples'] >= self.maxSamples) or \
+           (self.maxBytes and shard['bytes'] >= self.maxBytes):
+            self.endShard()
+        return self
+    #----------------------
+
+    def writeRecordsFile(self, fileName,    # file of sample records
+                        numSamples,         # num of records in the file
+                        sampleObjType,      # sample python class
+                        ):
+        """ Append a file of sample records (no header) that was written
+            elsewhere, e.g., by a worker process.
+        """
+        recordEnd = sampleObjType.getRecordEnd()
+        fieldSep  = sampleObjType.getFieldSep()
+        keyIndexes = [ sampleObjType.fieldNames.index(fn) \
+                            if fn in sampleObjType.fieldNames else None \
+                                                for fn in INDEX_KEY_FIELDS ]
+        with open(fileName, 'r', newline='') as fp:     # keep any '\r's
+            for text in iterRecords(fp, recordEnd):
+                fields = text.split(fieldSep)
+                keys = [ fields[i] if i is not None else None \
+                                                        for i in keyIndexes ]
+                self.writeRecord(text, recordEnd, keys)
+        return self
+    #----------------------
+
+    def getNumSamples(self): return self.numSamples
+    def getShards(self): return self.shards
+
+    def close(self):
+        if self.closed: return
+        if self.writer is not None or not self.shards:  # at least 1 shard
+            if self.writer is None: self.startShard()
+            self.endShard()
+
+        manifest = { 'meta'       : self.metaItems,
+                     'numSamples' : self.numSamples,
+                     'numShards'  : len(self.shards),
+                     'shards'     : self.shards,
+                   }
+        manifestFileName = getManifestFileName(self.fileName)
+        tmpFileName = manifestFileName + '.tmp'
+        with open(tmpFileName, 'w') as fp:
+            json.dump(manifest, fp, indent=2)
+            fp.write('\n')
+        os.replace(tmpFileName, manifestFileName)
+        self.closed = True
+    #----------------------
+# end class ShardedSampleWriter ------------------------
+
+CHECKPOINT_EXT = '.ckpt'        # checkpoint file = sample file + CHECKPOINT_EXT
+PARTIAL_EXT    = '.partial'     # file being written = sample file + PARTIAL_EXT
+
+def getCheckpointFileName(fileName): return fileName + CHECKPOINT_EXT
+def getPartialFileName(fileName): return fileName + PARTIAL_EXT
+
+def readCheckpoint(fileName,    # sample file pathname
+    ):
+    """ Return the checkpoint dict for the (partial) sample file or None if
+        there is no checkpoint (or no partial file to resume)
+    """
+    checkpointFileName = getCheckpointFileName(fileName)
+    if not os.path.exists(checkpointFileName) or \
+                            not os.path.exists(getPartialFileName(fileName)):
+        return None
+    with open(checkpointFileName, 'r') as fp:
+        return json.load(fp)
+#-----------------------------------
+
+class CheckpointedSampleWriter (object):
+    """
+    IS:     a writer of a sample file that can be resumed if the run dies
+    HAS:    the partial file being written (see getPartialFileName()),
+            its checkpoint file (see getCheckpointFileName()),
+            the _refs_key high-water mark of the last checkpoint
+    DOES:   writes samples to the partial file (via a SampleStreamWriter).
+            checkpoint(refKey, state): commits the samples written so far.
+              Syncs the partial file to disk, then (atomically) writes the
+              checkpoint:
+                highWaterRefsKey - every sample w/ _refs_key <= this is in
+                                    the partial file (None if not given)
+                numSamples, fileBytes - num of samples and bytes committed
+                job, meta - the run's parameters and the file's meta items
+                state - anything else (json-able) the caller needs to resume
+            If resuming and there is a checkpoint for the same job, the
+              partial file is truncated to its committed bytes (dropping
+              samples written after the last checkpoint) and new samples are
+              appended to it. getResumeKey() is the high-water mark to
+              continue after, getResumeState() the caller's state.
+            close(): commits and renames the partial file to the sample
+              file and removes the checkpoint.
+            discard(): removes the partial file and checkpoint, leaving the
+              sample file as it was.
+            Samples must be written in _refs_key order (or the caller resumes
+              by the num of samples, see getNumSamples()).
+            The sample file cannot be compressed (we truncate it by bytes).
+    """
+    def __init__(self, fileName,    # sample file pathname (not compressed)
+                sampleSet,          # (empty) SampleSet w/ meta items set
+                metaItems={},       # {meta item: value} for the checkpoint
+                job={},             # {name: value} the run's parameters.
+                                    #  Only resume a checkpoint w/ the same
+                resume=False,       # T/F resume from the file's checkpoint
+                ):
+        self.fileName = fileName
+        self.partialFileName = getPartialFileName(fileName)
+        self.checkpointFileName = getCheckpointFileName(fileName)
+        self.job = job
+        self.metaItems = metaItems
+        self.highWater = None       # _refs_key of the last checkpoint
+        self.state = {}             # caller's state at the last checkpoint
+        self.closed = False
+
+        checkpoint = None
+        if resume:
+            checkpoint = readCheckpoint(fileName)
+            if checkpoint and checkpoint['job'] != job:
+                raise ValueError("checkpoint '%s' is for a different job: %s" \
+                                % (self.checkpointFileName, checkpoint['job']))
+        if checkpoint:
+            os.truncate(self.partialFileName, checkpoint['fileBytes'])
+            self.fp = open(self.partialFileName, 'a')
+            self.writer = SampleStreamWriter(self.fp, sampleSet, appending=True)
+            self.highWater = checkpoint['highWaterRefsKey']
+            self.numCommitted = checkpoint['numSamples']
+            self.metaItems = checkpoint['meta']
+            self.state = checkpoint.get('state', {})
+        else:
+            if os.path.exists(self.checkpointFileName):     # stale
+                os.remove(self.checkpointFileName)
+            self.fp = open(self.partialFileName, 'w')
+            self.writer = SampleStreamWriter(self.fp, sampleSet)
+            self.writer.writeHeader()
+            self.numCommitted = 0
+    #----------------------
+
+    def getResumeKey(self):
+        """ Return the _refs_key high-water mark to resume after, None if
+            we are starting from scratch
+        """
+        return self.highWater
+    #----------------------
+
+    def getResumeState(self):
+        """ Return the state given to the checkpoint we are resuming from,
+            {} if we are starting from scratch
+        """
+        return self.state
+    #----------------------
+
+    def writeSample(self, sample):
+        self.writer.writeSample(sample)
+        return self
+    #----------------------
+
+    def writeRecord(self, text,     # record text (w/o the record ending)
+                    recordEnd,
+                    ):
+        self.writer.writeRecord(text, recordEnd)
+        return self
+    #----------------------
+
+    def checkpoint(self, refKey=None,   # _refs_key of the last sample written
+                    state={},           # {name: value} to resume w/
+        ):
+        """ Commit the samples written so far """
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        if refKey is not None: self.highWater = int(refKey)
+        self.state = state
+        checkpoint = { 'file'             : os.path.basename(self.fileName),
+                       'highWaterRefsKey' : self.highWater,
+                       'numSamples'       : self.getNumSamples(),
+                       'fileBytes'        : os.fstat(self.fp.fileno()).st_size,
+                       'job'              : self.job,
+                       'meta'             : self.metaItems,
+                       'state'            : self.state,
+                     }
+        tmpFileName = self.checkpointFileName + '.tmp'
+        with open(tmpFileName, 'w') as fp:
+            json.dump(checkpoint, fp, indent=2)
+            fp.write('\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmpFileName, self.checkpointFileName)
+        return self
+    #----------------------
+
+    def getNumSamples(self):
+        """ Return num of samples in the file (incl. those from a resumed run)
+        """
+        return self.numCommitted + self.writer.getNumSamples()
+    #----------------------
+
+    def close(self):
+        if self.closed: return
+        self.writer.close()
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+        os.replace(self.partialFileName, self.fileName)
+        if os.path.exists(self.checkpointFileName):
+            os.remove(self.checkpointFileName)
+        self.closed = True
+    #----------------------
+
+    def discard(self):
+        if self.closed: return
+        self.fp.close()
+        for fileName in [self.partialFileName, self.checkpointFileName]:
+            if os.path.exists(fileName): os.remove(fileName)
+        self.closed = True
+    #----------------------
+# end class CheckpointedSampleWriter ------------------------
+
+META_LINE_START = '#meta'    # start of the header's meta data line
+
+class LazySampleFile (object):
+    """
+    IS:     a lazy reader of a sample file
+    HAS:    the file memory mapped (or, if compressed, decompressed a chunk at
+            a time), its meta items and field names from its header
+    DOES:   iterates over the records, finding the record endings in the
+            mapped file (or chunk) w/o copying or parsing the records.
+            Each record is a LazySample that only parses its fields when
+            they are first asked for.
+            A compressed file is streamed: only a chunk (and the record
+            spanning its end) is in memory at once, so it can only be
+            iterated over once.
+            W/ tmpCopy, a tmp copy of the file (decompressed) is mapped
+            instead, so LazySamples can be kept w/o keeping the file in
+            memory, and the file itself can be overwritten while we read.
+            Assumes the header SampleSet.write() writes: an optional
+            '#meta key=value ...' line, then the field names, then the
+            record ending.
+    """
+    def __init__(self, fileName,    # sample file pathname, may be compressed
+                sampleObjType,      # sample python class of the samples
+                chunkSize=READ_CHUNK_SIZE,  # num of bytes to decompress at once
+                tmpCopy=False,      # T/F map a tmp copy of the file (in the
+                                    #  file's directory, removed on close)
+                ):
+        self.fileName = fileName
+        self.sampleObjType = sampleObjType
+        self.recordEnd = sampleObjType.getRecordEnd().encode('utf-8')
+        self.fieldSep  = sampleObjType.getFieldSep().encode('utf-8')
+        self.chunkSize = chunkSize
+
+        self.streaming = False
+        if tmpCopy:
+            dirName = os.path.dirname(os.path.abspath(fileName))
+            self.fp = tempfile.TemporaryFile(dir=dirName)   # no name to remove
+            with openSampleFile(fileName, 'rb') as fp:
+                shutil.copyfileobj(fp, self.fp, chunkSize)
+            self.fp.flush()
+        elif fileName.endswith(('.gz', '.zst')):    # cannot map, stream it
+            self.streaming = True
+            self.fp = openSampleFile(fileName, 'rb')
+            self.data = b''
+            while self.recordEnd not in self.data:  # read past the header
+                chunk = self.fp.read(chunkSize)
+                if not chunk: break
+                self.data += chunk
+        else:
+            self.fp = open(fileName, 'rb')
+
+        if self.streaming:
+            pass
+        elif os.fstat(self.fp.fileno()).st_size == 0:   # cannot map empty file
+            self.data = b''
+        else:
+            self.data = mmap.mmap(self.fp.fileno(), 0, access=mmap.ACCESS_READ)
+            if hasattr(mmap, 'MADV_SEQUENTIAL'):
+                self.data.madvise(mmap.MADV_SEQUENTIAL)
+        self.readHeader()
+    #----------------------
+
+    def readHeader(self):
+        """ Set the meta items, field names, and the offset of the 1st record
+        """
+        end = self.data.find(self.recordEnd)
+        if end == -1: end = len(self.data)
+        lines = self.data[:end].decode('utf-8').strip().split('\n')
+
+        self.metaItems = {}
+        for line in lines[:-1]:
+            if line.startswith(META_LINE_START):
+                for item in line[len(META_LINE_START):].split():
+                    key, eq, value = item.partition('=')
+                    self.metaItems[key] = value
+        self.fieldNames = lines[-1].split(self.fieldSep.decode('utf-8'))
+        self.lastFieldName = self.fieldNames[-1]
+        self.firstOffset = end + len(self.recordEnd)
+    #----------------------
+
+    def getMetaItem(self, key): return self.metaItems.get(key)
+    def getMetaItems(self): return self.metaItems
+    def getFieldNames(self): return self.fieldNames
+
+    def iterSamples(self):
+        """ Generator: yield a LazySample for each record in the file """
+        if self.streaming:
+            yield from self.iterStreamedSamples()
+            return
+        yield from self.iterDataSamples(self.data, self.firstOffset, True)
+    #----------------------
+
+    def iterDataSamples(self, data, # bytes or mmap of records
+                        offset,     # offset of the 1st record in data
+                        atEnd,      # T/F data ends at the end of the file
+                        ):
+        """ Generator: yield a LazySample for each record in data, and if not
+            atEnd, finally the offset of the (partial) record after them
+        """
+        recordEnd = self.recordEnd
+        endLen = len(recordEnd)
+        size = len(data)
+        while offset < size:
+            end = data.find(recordEnd, offset)
+            if end == -1:
+                if not atEnd: break             # rest is in the next chunk
+                end = size
+                if not data[offset:end].strip(): break  # trailing whitespace
+            yield LazySample(self, data, offset, end)
+            offset = end + endLen
+        if not atEnd:
+            yield offset
+    #----------------------
+
+    def iterStreamedSamples(self):
+        """ Generator: yield a LazySample for each record in the compressed
+            file, decompressing it a chunk at a time
+        """
+        data = self.data                # header chunk(s)
+        offset = self.firstOffset
+        self.data = None
+        while True:
+            chunk = self.fp.read(self.chunkSize)
+            atEnd = not chunk
+            if offset < len(data): data = data[offset:] + chunk
+            else: data = chunk
+            for item in self.iterDataSamples(data, 0, atEnd):
+                if isinstance(item, LazySample): yield item
+                else: offset = item
+            if atEnd: break
+    #----------------------
+
+    def __iter__(self): return self.iterSamples()
+
+    def close(self):
+        if isinstance(self.data, mmap.mmap): self.data.close()
+        if self.fp: self.fp.close()
+        self.fp = None
+        self.data = None
+    #----------------------
+# end class LazySampleFile ------------------------
+
+class LazySample (object):
+    """
+    IS:     a sample record in a LazySampleFile
+    HAS:    the file data (or chunk) the record is in, the record's start and
+            end offsets in it, its fields once they are parsed
+    DOES:   getField() parses the record on first access.
+            getFieldLength() of the last field (e.g., extractedText) w/o
+            parsing the record.
+            getSample() builds the full sample object.
+    """
+    __slots__ = ('lazyFile', 'data', 'start', 'end', 'fields')
+
+    def __init__(self, lazyFile, data, start, end):
+        self.lazyFile = lazyFile
+        self.data = data
+        self.start = start
+        self.end = end
+        self.fields = None
+    #----------------------
+
+    def getText(self):
+        """ Return the record text (w/o the record ending) """
+        return self.data[self.start:self.end].decode('utf-8')
+    #----------------------
+
+    def getFields(self):
+        """ Return {field name: value}, parsing the record if needed """
+        if self.fields is None:
+            values = self.getText().split(self.lazyFile.fieldSep.decode('utf-8'))
+            self.fields = dict(zip(self.lazyFile.fieldNames, values))
+        return self.fields
+    #----------------------
+
+    def getField(self, fieldName): return self.getFields()[fieldName]
+
+    def peekField(self, fieldName):
+        """ Return the value of a field w/o parsing (and keeping) the
+            record's fields, e.g., to get a key field of many records
+        """
+        if self.fields is not None: return self.fields[fieldName]
+        sep = self.lazyFile.fieldSep
+        start = self.start
+        for i in range(self.lazyFile.fieldNames.index(fieldName)):
+            start = self.data.find(sep, start, self.end) + len(sep)
+        end = self.data.find(sep, start, self.end)
+        if end == -1: end = self.end
+        return self.data[start:end].decode('utf-8')
+    #----------------------
+
+    def getFieldLength(self, fieldName):
+        """ Return the num of bytes (= chars for ascii) in the field.
+            For the last field, w/o parsing the record.
+        """
+        if self.fields is None and fieldName == self.lazyFile.lastFieldName:
+            sep = self.data.rfind(self.lazyFile.fieldSep, self.start, self.end)
+            return self.end - (sep + len(self.lazyFile.fieldSep))
+        return len(self.getField(fieldName))
+    #----------------------
+
+    def getSample(self):
+        """ Return the record as a sample object """
+        return self.lazyFile.sampleObjType().setFields(self.getFields())
+    #----------------------
+# end class LazySample ------------------------
+
+def doAutomatedTests():
+
+    sys.stdout.write("Running automated unit tests...\n")
+    unittest.main(argv=[sys.argv[0], '-v'],)
+
+class MyTests(unittest.TestCase):
+    class TestSample (object):
+        """ just enough of a sample class for LazySampleFile """
+        @staticmethod
+        def getRecordEnd(): return ';;\n'
+        @staticmethod
+        def getFieldSep(): return '|'
+        def setFields(self, fields):
+            self.fields = fields
+            return self
+
+    class KeyedSample (TestSample):
+        """ a TestSample w/ the key fields, for the writers """
+        fieldNames = ['_refs_key', 'ID', 'journal', 'extractedText']
+        def __init__(self, fields={}):
+            self.fields = fields
+        def getField(self, fieldName): return self.fields[fieldName]
+
+    class TestSampleSet (object):
+        """ just enough of a SampleSet to write a KeyedSample file header """
+        def write(self, fp):
+            fp.write('#meta host=dev\n_refs_key|ID|journal|extractedText;;\n')
+
+    header = '#meta host=dev db=mgd\nID|journal|extractedText;;\n'
+    records = [ 'MGI:1|J Biol|some text',
+                'MGI:2||',                              # empty fields
+                'MGI:3|Cell|caf\u00e9 \u00b5m ;\n; x',   # multi-byte chars
+                'MGI:4|Nature|' + 'long text ' * 50,
+              ]
+
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def writeFile(self, baseName, text):
+        fileName = os.path.join(self.tmpDir, baseName)
+        with openSampleFile(fileName, 'w') as fp: fp.write(text)
+        return fileName
+
+    def readFile(self, fileName, **kwargs):
+        """ Return (meta items, list of record texts) via LazySampleFile """
+        lazyFile = LazySampleFile(fileName, self.TestSample, **kwargs)
+        texts = [ s.getText() for s in lazyFile ]
+        metaItems = lazyFile.getMetaItems()
+        lazyFile.close()
+        return metaItems, texts
+
+    def test_iterStreamedSamples(self):
+        text = self.header + ''.join([ r + ';;\n' for r in self.records ])
+        expected = self.readFile(self.writeFile('s.txt', text))
+        self.assertEqual(expected, ({'host': 'dev', 'db': 'mgd'}, self.records))
+
+        # record endings and chars split across chunks (and the header)
+        gzFile = self.writeFile('s.txt.gz', text)
+        for chunkSize in [1, 2, 3, 5, 7, 64, READ_CHUNK_SIZE]:
+            self.assertEqual(self.readFile(gzFile, chunkSize=chunkSize),
+                                                                    expected)
+        self.assertEqual(self.readFile(gzFile, chunkSize=2, tmpCopy=True),
+                                                                    expected)
+
+    def test_iterStreamedSamples_ends(self):
+        # no records, or trailing whitespace after the last record ending
+        for records in ['', '\n', 'MGI:1|J|t;;\n\n']:
+            text = self.header + records
+            expected = self.readFile(self.writeFile('e.txt', text))
+            gzFile = self.writeFile('e.txt.gz', text)
+            for chunkSize in [1, 4, READ_CHUNK_SIZE]:
+                self.assertEqual(self.readFile(gzFile, chunkSize=chunkSize),
+                                                                    expected)
+
+    def test_lazySample(self):
+        fileName = self.writeFile('l.txt.gz',
+                    self.header + ''.join([ r + ';;\n' for r in self.records ]))
+        lazyFile = LazySampleFile(fileName, self.TestSample, chunkSize=3)
+        samples = list(lazyFile)
+        self.assertEqual(samples[2].peekField('journal'), 'Cell')
+        self.assertEqual(samples[1].getFieldLength('extractedText'), 0)
+        self.assertEqual(samples[3].getFieldLength('extractedText'), 500)
+        self.assertEqual(samples[0].getSample().fields, {'ID': 'MGI:1',
+                            'journal': 'J Biol', 'extractedText': 'some text'})
+        lazyFile.close()
+
+    def getFileText(self):
+        """ Return the text of a sample file of the records """
+        return self.header + ''.join([ r + ';;\n' for r in self.records ])
+
+    def checkRoundTrip(self, ext, magic):
+        """ Write and read back a sample file w/ openSampleFile() """
+        text = self.getFileText()
+        fileName = self.writeFile('o.txt' + ext, text)
+        with open(fileName, 'rb') as fp:                # compressed?
+            self.assertEqual(fp.read(len(magic)), magic)
+        with openSampleFile(fileName, 'r') as fp:
+            self.assertEqual(fp.read(), text)
+        with openSampleFile(fileName, 'rb') as fp:
+            self.assertEqual(fp.read(), text.encode('utf-8'))
+        self.assertEqual(self.readFile(fileName),
+                                ({'host': 'dev', 'db': 'mgd'}, self.records))
+
+    def test_openSampleFile(self):
+        self.checkRoundTrip('', self.header[:5].encode('utf-8'))
+        self.checkRoundTrip('.gz', b'\x1f\x8b')
+
+    @unittest.skipIf(zstandard is None, "zstandard is not installed")
+    def test_openSampleFile_zst(self):
+        self.checkRoundTrip('.zst', b'\x28\xb5\x2f\xfd')
+
+    @unittest.skipIf(zstandard is not None, "zstandard is installed")
+    def test_openSampleFile_noZstandard(self):
+        fileName = os.path.join(self.tmpDir, 'z.txt.zst')
+        self.assertRaises(ImportError, openSampleFile, fileName, 'w')
+
+    def getKeyedSamples(self, num):
+        """ Return list of KeyedSamples, w/ multi-byte chars so byte offsets
+            are not char offsets
+        """
+        return [ self.KeyedSample({ '_refs_key' : str(100 + i),
+                                    'ID'        : 'MGI:%d' % i,
+                                    'journal'   : ['Cell', 'caf\u00e9'][i % 2],
+                                    'extractedText' : '\u00b5m %d ' % i * i,
+                                  }) for i in range(num) ]
+
+    def test_indexedSampleFile(self):
+        samples = self.getKeyedSamples(6)
+        fileName = os.path.join(self.tmpDir, 'i.txt')
+        writer = SampleStreamWriter(fileName, self.TestSampleSet(),
+                                        indexFile=getIndexFileName(fileName))
+        for sample in samples[:4]:
+            writer.writeSample(sample)
+        writer.writeRecord(sample2Text(samples[4]), ';;\n',
+                                                    keys=['MGI:4', '104'])
+        # records written elsewhere, e.g., by a worker process
+        recordsFileName = os.path.join(self.tmpDir, 'records')
+        with open(recordsFileName, 'w') as fp:
+            fp.write(sample2Text(samples[5]) + ';;\n')
+        writer.writeRecordsFile(recordsFileName, 1, self.KeyedSample)
+        writer.close()
+        self.assertEqual(writer.getNumSamples(), 6)
+
+        with open(getIndexFileName(fileName), 'r') as fp:
+            lines = fp.read().splitlines()
+        self.assertEqual(lines[0], '\t'.join(INDEX_FIELDNAMES))
+        self.assertEqual(len(lines), 7)
+
+        indexedFile = IndexedSampleFile(fileName, self.KeyedSample)
+        for i, sample in enumerate(samples):
+            self.assertEqual(indexedFile.getRecordText('MGI:%d' % i),
+                                                        sample2Text(sample))
+            self.assertEqual(indexedFile.getSample(100 + i).fields,
+                                                        sample.fields)
+        self.assertTrue(indexedFile.has('MGI:3'))
+        self.assertFalse(indexedFile.has('MGI:99'))
+        self.assertIsNone(indexedFile.getSample('MGI:99'))
+
+        found = indexedFile.getSamples(['MGI:5', 'MGI:99', 101, 'MGI:5'])
+        self.assertIsNone(found[1])
+        self.assertEqual([ s.fields for s in found if s ],
+                        [ samples[5].fields, samples[1].fields,
+                                                        samples[5].fields ])
+        self.assertEqual([ s.getField('ID') for s in \
+                            indexedFile.iterSamples(['MGI:2', 'x', '100']) ],
+                        ['MGI:2', 'MGI:0'])
+        indexedFile.close()
+
+        # the sample file itself is the same as w/o an index
+        self.assertEqual(self.readFile(fileName)[1],
+                                        [ sample2Text(s) for s in samples ])
+
+    def test_splitSampleFileExts(self):
+        for fileName, expected in [
+                    ('refs.v2.txt.gz',  ('refs.v2', '.txt.gz')),
+                    ('refs.txt.zst',    ('refs', '.txt.zst')),
+                    ('refs.txt',        ('refs', '.txt')),
+                    ('refs.gz',         ('refs', '.gz')),
+                    ('refs.tsv',        ('refs.tsv', '')),
+                    ('refs',            ('refs', '')),
+                    ('dir.txt/refs',    ('dir.txt/refs', '')),
+                    ]:
+            self.assertEqual(splitSampleFileExts(fileName), expected)
+        self.assertEqual(getShardFileName('dir/selected.txt.gz', 3),
+                                                'dir/selected.0003.txt.gz')
+        self.assertEqual(getManifestFileName('dir/selected.txt.gz'),
+                                                'dir/selected.manifest.json')
+
+    def writeShards(self, baseName, samples, **kwargs):
+        """ Write samples w/ a ShardedSampleWriter.
+            Return (manifest, list of the shards' record texts lists)
+        """
+        fileName = os.path.join(self.tmpDir, baseName)
+        writer = ShardedSampleWriter(fileName, self.TestSampleSet(),
+                                        metaItems={'db': 'mgd'}, **kwargs)
+        for sample in samples:
+            writer.writeSample(sample)
+        writer.close()
+        writer.close()                                  # no-op
+        self.assertEqual(writer.getNumSamples(), len(samples))
+
+        with open(getManifestFileName(fileName), 'r') as fp:
+            manifest = json.load(fp)
+        self.assertEqual(manifest['shards'], writer.getShards())
+        self.assertEqual(manifest['meta'], {'db': 'mgd'})
+        self.assertEqual(manifest['numSamples'], len(samples))
+        self.assertEqual(manifest['numShards'], len(manifest['shards']))
+
+        shardTexts = []
+        for i, shard in enumerate(manifest['shards']):
+            shardFileName = getShardFileName(fileName, i)
+            self.assertEqual(shard['file'], os.path.basename(shardFileName))
+            with open(shardFileName, 'rb') as fp:
+                data = fp.read()
+            self.assertEqual(shard['fileBytes'], len(data))
+            self.assertEqual(shard['sha256'], hashlib.sha256(data).hexdigest())
+            texts = self.readFile(shardFileName)[1]
+            self.assertEqual(shard['numSamples'], len(texts))
+            shardTexts.append(texts)
+        self.assertFalse(os.path.exists(getShardFileName(fileName,
+                                                len(manifest['shards']))))
+        return manifest, shardTexts
+
+    def test_shardedSampleWriter_maxSamples(self):
+        samples = self.getKeyedSamples(5)
+        manifest, shardTexts = self.writeShards('s.txt', samples,
+                                                                maxSamples=2)
+        texts = [ sample2Text(s) for s in samples ]
+        self.assertEqual(shardTexts, [texts[0:2], texts[2:4], texts[4:5]])
+        shard = manifest['shards'][1]
+        self.assertEqual((shard['firstID'], shard['lastID']),
+                                                        ('MGI:2', 'MGI:3'))
+        self.assertEqual((shard['minRefsKey'], shard['maxRefsKey']), (102, 103))
+
+    def test_shardedSampleWriter_maxBytes(self):
+        samples = self.getKeyedSamples(8)
+        texts = [ sample2Text(s) for s in samples ]
+        recordBytes = [ len((t + ';;\n').encode('utf-8')) for t in texts ]
+        maxBytes = recordBytes[0] + recordBytes[1]
+        manifest, shardTexts = self.writeShards('s.txt.gz', samples,
+                                                            maxBytes=maxBytes)
+        self.assertGreater(len(shardTexts), 2)
+        self.assertEqual(sum(shardTexts, []), texts)    # all, in order
+        self.assertEqual(shardTexts[0], texts[:2])
+
+        start = 0
+        for shard in manifest['shards']:                # uncompressed bytes
+            end = start + shard['numSamples']
+            self.assertEqual(shard['bytes'], sum(recordBytes[start:end]))
+            if end < len(texts):        # rolled over at the record that
+                self.assertGreaterEqual(shard['bytes'], maxBytes)  # hit max
+                self.assertLess(shard['bytes'] - recordBytes[end-1], maxBytes)
+            start = end
+
+    def test_shardedSampleWriter_empty(self):
+        manifest, shardTexts = self.writeShards('s.txt', [], maxSamples=2)
+        self.assertEqual(shardTexts, [[]])              # 1 shard, just header
+        self.assertIsNone(manifest['shards'][0]['firstID'])
+# end class MyTests ------------------------
+
+if __name__ == "__main__":
+    doAutomatedTests()
@@ -10,31 +10,41 @@
 
   Outputs:      Delimited file to specified output file.
                 See MGIReference.Sample for output format
+                Optional per PDF extraction metrics file (--metrics),
+                see pdfTextLib.ExtractionMetrics
 '''
 import sys
 import os
 import time
 import argparse
-import subprocess
 import unittest
-import db
-import Pdfpath
 #import extractedTextSplitter
 import MGIReference as sampleLib
-from utilsLib import removeNonAscii
+import sampleFileLib
+import textCleanLib
+import textCacheLib
+import pdfTextLib
 
 #-----------------------------------
 
 sampleObjType = sampleLib.MGIReference
+# the samples we parse and write: compact records w/ the same fields
+compactObjType = sampleLib.CompactMGIReference
 
 # for the Sample output file
 RECORDEND    = sampleObjType.getRecordEnd()
 FIELDSEP     = sampleObjType.getFieldSep()
 
+# to remove delimiters and non-ascii chars from text fields
+textCleaner  = textCleanLib.TextCleaner([RECORDEND, FIELDSEP])
+
 MINTEXTLENGTH = 500     # skip refs with extracted text shorter than this
 
 LONGTIME = 60           # num of seconds. If a pdf extraction takes longer
                         #   than this, report it.
+TIMEOUT  = 300          # default num of seconds before a pdf extraction is
+                        #   killed and put on the retry queue
+CHECKPOINT_EVERY = 100  # default num of samples written between checkpoints
 #-----------------------------------
 
 def getArgs():
@@ -47,7 +57,8 @@ def getArgs():
 #        help='get samples, IDs from stdin, or just run automated tests')
 
     parser.add_argument('sampleFile', action='store', 
-        help='the sample file to read and update.')
+        help='the sample file to read and update. ' +
+            'Compressed if it ends in .gz or .zst')
 
 #    parser.add_argument('--frompdf', dest='fromPDF', action='store_true',
 #        required=False,
@@ -61,10 +72,69 @@ def getArgs():
 #        type=int, required=False, default=None,
 #        help="only include the 1st n chars of text fields (for debugging)")
 
+    parser.add_argument('-j', '--jobs', dest='jobs',
+        required=False, type=int, default=1,
+        help="num of PDFs to extract text from at once. Default 1")
+
+    parser.add_argument('--timeout', dest='timeout',
+        required=False, type=int, default=TIMEOUT,
+        help="kill a PDF extraction that takes longer than n seconds and " +
+            "retry it at the end. 0 for no timeout. Default %d" % TIMEOUT)
+
+    parser.add_argument('--retrytimeout', dest='retryTimeout',
+        required=False, type=int, default=None,
+        help="timeout in seconds for the retries of extractions that " +
+            "timed out. 0 to not retry them. Default 3 x --timeout")
+
+    parser.add_argument('--cache', dest='cacheFile', action='store',
+        required=False, default=None, metavar='CACHEFILE',
+        help="local cache of text extracted from PDFs. Only run the " +
+            "extractor for PDFs not in the cache or that (or the " +
+            "extractor) have changed since they were cached")
+
+    parser.add_argument('--cachesize', dest='cacheMBytes',
+        type=int, required=False, default=textCacheLib.DEFAULT_MAX_MBYTES,
+        help="max size of the text cache in MB, least recently used " +
+            "text is evicted. Default %d" % textCacheLib.DEFAULT_MAX_MBYTES)
+
+    parser.add_argument('--metrics', dest='metricsFile', action='store',
+        required=False, default=None, metavar='METRICSFILE',
+        help="write per PDF extraction metrics (PDF bytes, pages, chars, " +
+            "wall time, status) for this run to this file. " +
+            "CSV, or JSON lines if it ends in .json or .jsonl. " +
+            "A resumed run adds to the file")
+
+    parser.add_argument('--slowest', dest='slowestN',
+        required=False, type=int, default=pdfTextLib.SLOWEST_N,
+        help="num of slowest extractions to list in the summary. " +
+            "Default %d" % pdfTextLib.SLOWEST_N)
+
+    parser.add_argument('--checkpointevery', dest='checkpointEvery',
+        required=False, type=int, default=CHECKPOINT_EVERY,
+        help="commit the updated samples to a partial file beside the " +
+            "sample file every n samples so --resume can pick up from " +
+            "there. 0 for no checkpoints. Only for uncompressed sample " +
+            "files. Default %d" % CHECKPOINT_EVERY)
+
+    parser.add_argument('--resume', dest='resume', action='store_true',
+        required=False,
+        help="resume from the last checkpoint of a run that died")
+
     parser.add_argument('-q', '--quiet', dest='verbose', action='store_false',
         required=False, help="skip helpful messages to stderr")
 
-    return parser.parse_args()
+    args = parser.parse_args()
+
+    if args.retryTimeout is None:
+        args.retryTimeout = 3 * args.timeout
+
+    if args.sampleFile.endswith(('.gz', '.zst')):   # cannot truncate it
+        if args.resume:
+            parser.error("--resume is not supported for compressed files")
+        args.checkpointEvery = 0
+    elif args.resume and not args.checkpointEvery:
+        parser.error("--resume needs --checkpointevery > 0")
+    return args
 #-----------------------------------
 
 args = getArgs()
@@ -74,101 +144,312 @@ args = getArgs()
 def main():
 
     startTime = time.time()
-
-    sampleSet = sampleLib.SampleSet(sampleObjType).read(args.sampleFile)
-
-    numAlready   = 0    # num of samples that already have extracted text
-    numAttempted = 0    # num of samples that we attempted to extracted text for
-    numExtracted = 0    # num of samples that we successfully extracted text for
-    numErrors    = 0    # num of samples with errors during text extraction
-
-    for sample in sampleSet.getSamples():
-        if len(sample.getField('extractedText')) > 0:
-            numAlready += 1
+    global pdfCache
+    if args.cacheFile:
+        pdfCache = pdfTextLib.PdfTextCache(args.cacheFile, args.cacheMBytes)
+
+    # read the samples lazily (streaming them if compressed), only parsing
+    #  the ones w/o extracted text, and write them (the others as is) to a
+    #  tmp file beside the sample file that replaces it when we are done.
+    lazyFile = sampleFileLib.LazySampleFile(args.sampleFile, compactObjType)
+    sampleSet = sampleLib.SampleSet(sampleObjType)
+    for key, value in lazyFile.getMetaItems().items():
+        sampleSet.setMetaItem(key, value)
+
+    writer, tmpFile = openWriter(sampleSet, lazyFile.getMetaItems())
+    checkpointing = tmpFile is None
+    numDone = writer.getNumSamples()    # num of samples done in a resumed run
+    state = writer.getResumeState() if checkpointing else {}
+    if numDone:
+        verbose("Resuming after the first %d samples\n" % numDone)
+
+    numAlready   = state.get('numAlready', 0)   # num of samples that already
+                                                #  have extracted text
+    numAttempted = state.get('numAttempted', 0) # num of samples that we
+                                                #  attempted to extract text for
+    numExtracted = state.get('numExtracted', 0) # num of samples that we
+                                                #  successfully extracted text for
+    numErrors    = state.get('numErrors', 0)    # num of samples with errors
+                                                #  during text extraction
+    numTimedOut  = state.get('numTimedOut', 0)  # num of samples whose 1st
+                                                #  extraction timed out
+    retryIDs     = state.get('retryIDs', [])    # MGI IDs of the samples that
+                                                #  timed out, to retry
+    retryTexts   = {}   # {MGI ID: text} for the retries that worked
+    metrics = pdfTextLib.ExtractionMetrics(args.metricsFile, args.slowestN,
+                                    append=bool(state))     # resumed run
+
+    def getState():
+        """ Return the counts etc. to save in a checkpoint """
+        return { 'numAlready'   : numAlready,
+                 'numAttempted' : numAttempted,
+                 'numExtracted' : numExtracted,
+                 'numErrors'    : numErrors,
+                 'numTimedOut'  : numTimedOut,
+                 'retryIDs'     : retryIDs,
+               }
+
+    def iterToExtract():
+        """ Generator: yield ((lazySample, T/F it already has text), MGI ID or
+            None if we do not need to extract its text) for the samples in
+            file order, skipping the ones done in a resumed run
+        """
+        numToExtract = numAttempted
+        for i, lazySample in enumerate(lazyFile.iterSamples()):
+            if i < numDone:
+                continue
+            if args.limit and numToExtract == args.limit:   # copy the rest
+                yield (lazySample, False), None
+            elif lazySample.getFieldLength('extractedText') > 0:
+                yield (lazySample, True), None
+            else:
+                mgiID = lazySample.getField('ID')
+                numToExtract += 1
+                verbose("Extracting text for %s\n" % mgiID)
+                yield (lazySample, False), mgiID
+
+    # extract up to args.jobs PDFs at once, write the samples in file order
+    for (lazySample, already), result in pdfTextLib.iterOrderedExtractions( \
+                        iterToExtract(), extractText, args.jobs):
+        if result is None:
+            if already: numAlready += 1
+            writer.writeRecord(lazySample.getText(), RECORDEND)
         else:
+            sample = lazySample.getSample()
             mgiID = sample.getField('ID')
+            text, error, elapsedTime, timedOut, pdfMetrics = result
+            pdfMetrics['journal'] = sample.getField('journal')
+            metrics.add(pdfMetrics)
             numAttempted += 1
-            verbose("Extracting text for %s\n" % mgiID)
-
-            pdfStart = time.time()
-            text, error = getText4Ref_fromPDF(mgiID)
-            elapsedTime = time.time() - pdfStart
 
             if elapsedTime > LONGTIME:
                 verbose("%s extraction took %8.3f seconds\n" \
                                                     % (mgiID, elapsedTime) )
-            if error:
+            if timedOut:
+                verbose("Timed out extracting text for %s:\n%s" % \
+                                                                (mgiID, error))
+                numTimedOut += 1
+                if args.retryTimeout:
+                    retryIDs.append(mgiID)
+                else:
+                    numErrors += 1
+            elif error:
                 verbose("Error extracting text for  %s:\n%s" % (mgiID, error))
                 numErrors += 1
             else:
-                text = cleanUpTextField(text)
                 sample.setField('extractedText', text)
                 numExtracted += 1
-        if numAttempted == args.limit: break
+            writer.writeSample(sample)
+
+        if checkpointing and \
+                        writer.getNumSamples() % args.checkpointEvery == 0:
+            writer.checkpoint(state=getState())
+
+    lazyFile.close()
+    numSamples = writer.getNumSamples()
 
-    sampleSet.write(args.sampleFile)
-    verbose('\n')
-    verbose("wrote %d samples to '%s'\n" % (sampleSet.getNumSamples(),
-                                            args.sampleFile))
+    # commit all the samples (and the retryIDs) before the retries, so if
+    #  we die during them, a resumed run just does the retries
+    if checkpointing:
+        writer.checkpoint(state=getState())
+        tmpFile = sampleFileLib.getPartialFileName(args.sampleFile)
+    else:
+        writer.close()
+
+    # retry the extractions that timed out w/ the longer timeout
+    if retryIDs:
+        retryTexts = retryTimedOut(retryIDs, metrics)
+        numExtracted += len(retryTexts)
+        numErrors += len(retryIDs) - len(retryTexts)
+
+    # replace the sample file w/ the tmp file (if anything changed),
+    #  filling in the retried texts as we copy it
+    changed = numExtracted > 0
+    if retryTexts:
+        fillInTexts(tmpFile, args.sampleFile, sampleSet, retryTexts)
+        if checkpointing: writer.discard()
+        else: os.remove(tmpFile)
+    elif checkpointing:
+        if changed: writer.close()
+        else: writer.discard()
+    else:
+        if changed: os.replace(tmpFile, args.sampleFile)
+        else: os.remove(tmpFile)
+
+    if changed:
+        indexFile = sampleFileLib.getIndexFileName(args.sampleFile)
+        if os.path.exists(indexFile):       # its record offsets are now wrong
+            os.remove(indexFile)
+            verbose("removed out of date index '%s'\n" % indexFile)
+        verbose('\n')
+        verbose("wrote %d samples to '%s'\n" % (numSamples, args.sampleFile))
+    else:                                   # nothing changed, keep the file
+        verbose('\n')
+        verbose("no new text, left '%s' as is\n" % args.sampleFile)
     verbose("Samples seen with text already: %d\n" % numAlready)
     verbose("Samples with new text added: %d\n" % numExtracted)
     verbose("Samples with text extraction errors: %d\n" % numErrors)
+    verbose("Samples whose text extraction timed out: %d " % numTimedOut +
+                                "(%d got text on retry)\n" % len(retryTexts))
+    metrics.close()
+    if metrics.numAdded:
+        verbose(metrics.getSummary())
+    if pdfCache:
+        verbose(pdfCache.getStats())
+        pdfCache.close()
     verbose("%8.3f seconds\n\n" %  (time.time()-startTime))
 #-----------------------------------
 
-def getText4Ref_fromPDF(mgiID):
-    """ Return (text, error)
-        text = extracted text (string) from the PDF.
-            for the specified MGI ID
-        error = None or an error message if the text could not be extracted.
+def openWriter(sampleSet,       # (empty) SampleSet w/ the file's meta items
+    metaItems,                  # {meta item: value} the file's meta items
+    ):
+    """ Return (writer, tmp file name) for writing the updated sample file.
+        For an uncompressed sample file, if we are checkpointing: a
+            sampleFileLib.CheckpointedSampleWriter (resumed if args.resume),
+            tmp file name None (it is the writer's partial file).
+        Else a sampleFileLib.SampleStreamWriter and its tmp file name.
     """
-    PDF_STORAGE_BASE_PATH = '/data/littriage'
-    prefix, numeric = mgiID.split(':')
-    filePath = os.path.join(Pdfpath.getPdfpath(PDF_STORAGE_BASE_PATH,mgiID),
-                                                            numeric + '.pdf')
-    text, error = extractTextFromPdf(filePath)
+    if args.checkpointEvery:
+        job = getCheckpointJob()
+        writer = sampleFileLib.CheckpointedSampleWriter(args.sampleFile,
+                        sampleSet, metaItems, job, args.resume)
+        return writer, None
+
+    dirName, baseName = os.path.split(args.sampleFile)
+    tmpFile = os.path.join(dirName, '.tmp.' + baseName)  # keep .gz/.zst
+    return sampleFileLib.SampleStreamWriter(tmpFile, sampleSet), tmpFile
+#-----------------------------------
 
-    return text, error
+def getCheckpointJob():
+    """ Return {name: value} identifying this run for its checkpoints.
+        A checkpoint is only resumed for the same sample file (unchanged
+        since the checkpoint) and limit.
+    """
+    stat = os.stat(args.sampleFile)
+    return { 'sampleFile' : os.path.abspath(args.sampleFile),
+             'fileBytes'  : stat.st_size,
+             'fileMtime'  : stat.st_mtime_ns,
+             'limit'      : args.limit,
+           }
 #-----------------------------------
 
-def extractTextFromPdf(pdfPathName):
-    """ Return (text, error)
-        text = the extracted text from the PDF,
-        error = None or an error message if the text could not be extracted.
+def retryTimedOut(retryIDs,     # MGI IDs whose extractions timed out
+    metrics,                    # pdfTextLib.ExtractionMetrics to add to
+    ):
+    """ Retry extracting text for retryIDs w/ args.retryTimeout.
+        Return {MGI ID: text} for the ones that worked
     """
-    ## Get full text from PDF
-    LITPARSER             = '/usr/local/mgi/live/mgiutils/litparser'
-    executable = os.path.join(LITPARSER, 'pdfGetFullText.sh')
+    verbose("Retrying %d extractions that timed out, timeout %d seconds\n" \
+                                        % (len(retryIDs), args.retryTimeout))
+    retryTexts = {}
+    items = [ (mgiID, mgiID) for mgiID in retryIDs ]
+    for mgiID, result in pdfTextLib.iterOrderedExtractions(items,
+                        lambda mgiID: extractText(mgiID, args.retryTimeout),
+                        args.jobs):
+        text, error, elapsedTime, timedOut, pdfMetrics = result
+        pdfMetrics['attempt'] = 2
+        metrics.add(pdfMetrics)
+        if error:
+            verbose("Retry failed for %s:\n%s" % (mgiID, error))
+        else:
+            verbose("Retry of %s took %8.3f seconds\n" % (mgiID, elapsedTime))
+            retryTexts[mgiID] = text
+    return retryTexts
+#-----------------------------------
 
-    cmd = [executable, pdfPathName]
-    cmdText = ' '.join(cmd)
-    
-    completedProcess = subprocess.run(cmd, capture_output=True, text=True)
+def fillInTexts(inFileName,     # sample file to copy
+    outFileName,                # sample file to write
+    sampleSet,                  # (empty) SampleSet w/ the file's meta items
+    texts,                      # {MGI ID: extracted text} to fill in
+    ):
+    """ Copy inFileName to outFileName, setting the extracted text of the
+        samples that are in texts.
+        (writes a tmp file that replaces outFileName when it is complete)
+    """
+    dirName, baseName = os.path.split(outFileName)
+    tmpFile = os.path.join(dirName, '.fill.' + baseName) # keep .gz/.zst
+    lazyFile = sampleFileLib.LazySampleFile(inFileName, compactObjType)
+    try:
+        writer = sampleFileLib.SampleStreamWriter(tmpFile, sampleSet)
+        for lazySample in lazyFile.iterSamples():
+            text = None
+            if lazySample.getFieldLength('extractedText') == 0:
+                text = texts.get(lazySample.getField('ID'))
+            if text is None:
+                writer.writeRecord(lazySample.getText(), RECORDEND)
+            else:
+                sample = lazySample.getSample()
+                sample.setField('extractedText', text)
+                writer.writeSample(sample)
+        writer.close()
+        os.replace(tmpFile, outFileName)
+    finally:
+        lazyFile.close()
+        if os.path.exists(tmpFile): os.remove(tmpFile)
+#-----------------------------------
 
-    if completedProcess.returncode != 0:
-        text = ''
-        error = "pdftotext error: %d\n%s\n%s\n%s\n" % \
-                        (completedProcess.returncode, cmdText,
-                            completedProcess.stderr, completedProcess.stdout)
-    else:
-        text = completedProcess.stdout
-        error = None
+def extractText(mgiID,
+    timeout=None,       # seconds, default args.timeout
+    ):
+    """ Return (text, error, elapsed seconds, T/F timed out, metrics)
+            for the MGI ID's PDF, text cleaned up,
+            metrics = {fieldname: value} for pdfTextLib.ExtractionMetrics
+                        (journal not set, attempt 1)
+        (runs in the extraction pool's threads)
+    """
+    if timeout is None: timeout = args.timeout
+    startTime = time.time()
+    timedOut = False
+    info = {}
+    try:
+        text, error = getText4Ref_fromPDF(mgiID, timeout or None, info)
+    except pdfTextLib.PdfTimeoutError as e:
+        text, error = '', str(e)
+        timedOut = True
+    elapsedTime = time.time() - startTime
+    numPages = 0
+    if not error:
+        numPages = pdfTextLib.countPages(text)
+        text = cleanUpTextField(text)
+
+    if timedOut:                status = 'timeout'
+    elif error:                 status = 'error'
+    elif info.get('cached'):    status = 'cached'
+    else:                       status = 'ok'
+    metrics = { 'mgiID'    : mgiID,
+                'journal'  : None,
+                'attempt'  : 1,
+                'status'   : status,
+                'exitCode' : info.get('exitCode'),
+                'pdfBytes' : info.get('pdfBytes'),
+                'numPages' : numPages,
+                'numChars' : len(text),
+                'wallTime' : round(elapsedTime, 3),
+              }
+    return text, error, elapsedTime, timedOut, metrics
+#-----------------------------------
+
+pdfCache = None         # pdfTextLib.PdfTextCache if we are using one
 
-    return text, error
+def getText4Ref_fromPDF(mgiID,
+    timeout=None,       # seconds to wait for the extraction, None = no max
+    info=None,          # dict for pdfTextLib.getPdfText() to fill in, or None
+    ):
+    """ Return (text, error)
+        text = extracted text (string) from the PDF.
+            for the specified MGI ID
+        error = None or an error message if the text could not be extracted.
+        From the PDF text cache if it has the text for the PDF.
+        Raise pdfTextLib.PdfTimeoutError if it takes longer than timeout.
+    """
+    return pdfTextLib.getPdfText(mgiID, timeout, pdfCache, info)
 #-----------------------------------
 
 def cleanUpTextField(text):
 
     if text == None:
         text = ''
-    text = removeNonAscii(cleanDelimiters(text))
-    return text
-#-----------------------------------
-
-def cleanDelimiters(text):
-    """ remove RECORDEND and FIELDSEPs from text (replace w/ ' ')
-    """
-    return text.replace(RECORDEND,' ').replace(FIELDSEP,' ')
+    return textCleaner.clean(text)
 #-----------------------------------
 
 def verbose(text):
@@ -17,13 +17,14 @@ import sys
 import os
 import time
 import argparse
-import subprocess
 import unittest
 import db
-import Pdfpath
 import extractedTextSplitter
 import GXDrefSample as SampleLib
-from utilsLib import removeNonAscii
+import textCleanLib
+import dbExtractLib
+import textCacheLib
+import pdfTextLib
 
 #-----------------------------------
 
@@ -33,6 +34,9 @@ sampleObjType = SampleLib.ClassifiedRefSample
 RECORDEND    = sampleObjType.getRecordEnd()
 FIELDSEP     = sampleObjType.getFieldSep()
 
+# to remove delimiters and non-ascii chars from text fields
+textCleaner  = textCleanLib.TextCleaner([RECORDEND, FIELDSEP, '\r'])
+
 MINTEXTLENGTH = 200      # skip refs with extracted text shorter than this
 #-----------------------------------
 
@@ -60,6 +64,18 @@ def getArgs():
         type=int, required=False, default=None,
         help="only include the 1st n chars of text fields (for debugging)")
 
+    parser.add_argument('--cache', dest='cacheFile', action='store',
+        required=False, default=None, metavar='CACHEFILE',
+        help="local cache of extracted text. Only get text from the db " +
+            "for refs not in the cache or whose text has changed. " +
+            "W/ --frompdf, only run the PDF text extractor for PDFs not " +
+            "in the cache or that (or the extractor) have changed")
+
+    parser.add_argument('--cachesize', dest='cacheMBytes',
+        type=int, required=False, default=textCacheLib.DEFAULT_MAX_MBYTES,
+        help="max size of the text cache in MB, least recently used " +
+            "text is evicted. Default %d" % textCacheLib.DEFAULT_MAX_MBYTES)
+
     parser.add_argument('-q', '--quiet', dest='verbose', action='store_false',
         required=False, help="skip helpful messages to stderr")
 
@@ -245,11 +261,16 @@ def doSamples(sql):
     for sql in sqlList:
         results = db.sql(sql, 'auto')
 
+        tokens = {}     # {_refs_key: text cache token}, all in one query
+        if textCache and not args.fromPDF and results:
+            tokens = getTextTokens([ r['_refs_key'] for r in results ])
+
         # Create sample records and add to SampleSet
         for i,r in enumerate(results):
             if i % 200 == 0: verbose("..%d\n" % i)
             if not args.fromPDF:        # get from db
-                text = getText4Ref_fromDB(r['_refs_key'])
+                refKey = r['_refs_key']
+                text = getText4Ref_fromDB(refKey, tokens.get(int(refKey), ''))
             else:                       # extract text from PDF
                 mgiID = r['ID']      # we need an MGI ID to find the PDF
                 if not mgiID.startswith('MGI:'):
@@ -332,14 +353,10 @@ def getText4Ref_fromPDF(mgiID):
     """ Return (text, error)
         text = extracted text (string) - in lower case - from the PDF.
             for the specified MGI ID, omitting the refs and supp data sections
+            (the PDF's text comes from the PDF text cache if it has it)
         error = None or an error message if the text could not be extracted.
     """
-    PDF_STORAGE_BASE_PATH = '/data/littriage'
-    prefix, numeric = mgiID.split(':')
-    filePath = os.path.join(Pdfpath.getPdfpath(PDF_STORAGE_BASE_PATH,mgiID),
-                                                            numeric + '.pdf')
-
-    text, error = extractTextFromPdf(filePath)
+    text, error = pdfTextLib.getPdfText(mgiID, cache=pdfCache)
 
     ## Split the text and get all but the reference and supp data sections
     (body, refs, manuFigures, starMethods, suppData) = \
@@ -349,37 +366,35 @@ def getText4Ref_fromPDF(mgiID):
     return text.lower(), error
 #-----------------------------------
 
-def extractTextFromPdf(pdfPathName):
-    """ Return (text, error)
-        text = the extracted text from the PDF,
-        error = None or an error message if the text could not be extracted.
-    """
-    ## Get full text from PDF
-    LITPARSER             = '/usr/local/mgi/live/mgiutils/litparser'
-    executable = os.path.join(LITPARSER, 'pdfGetFullText.sh')
-
-    cmd = [executable, pdfPathName]
-    cmdText = ' '.join(cmd)
-    
-    completedProcess = subprocess.run(cmd, capture_output=True, text=True)
-
-    if completedProcess.returncode != 0:
-        text = ''
-        error = "pdftotext error: %d\n%s\n%s\n%s\n" % \
-                        (completedProcess.returncode, cmdText,
-                            completedProcess.stderr, completedProcess.stdout)
-    else:
-        text = completedProcess.stdout
-        error = None
+CACHE_SECTION = 'gxd2ary'    # text cache section key for the lower cased
+                             #  text w/o the reference and supp sections
+# the sections the text is from: all but the reference and supp sections
+CACHE_SECTION_WHERE = 'and d._extractedtext_key not in (48804491, 48804492)'
+textCache = None             # textCacheLib.TextCache if we are using one
+pdfCache  = None             # pdfTextLib.PdfTextCache if we are using one
 
-    return text, error
+def getTextTokens(refKeys,  # list of _refs_keys
+    ):
+    """ Return {_refs_key: text cache change token} for the refs' text,
+        getting them all in one query
+    """
+    return dbExtractLib.getTextTokens(db,
+                        ','.join([ str(k) for k in refKeys ]),
+                        CACHE_SECTION_WHERE)
 #-----------------------------------
 
-def getText4Ref_fromDB(refKey):
+def getText4Ref_fromDB(refKey,
+    token='',       # text cache change token for the ref, see getTextTokens()
+    ):
     """ Return extracted text (string) - in lower case -
-        from the DB.
+        from the DB (or the text cache if it is there and up to date)
         for the specified _refs_key
     """
+    if textCache:
+        text = textCache.get(refKey, CACHE_SECTION, token)
+        if text is not None:
+            return text
+
     # sql to get extracted text, omitting reference and supplemental sections
     extractedSql = '''
         select distinct lower(d.extractedText) as extractedText
@@ -390,8 +405,12 @@ def getText4Ref_fromDB(refKey):
     '''
     results = db.sql(extractedSql % (refKey), 'auto')
     textparts = [ r['extractedtext'] for r in results]
+    text = ''.join(textparts)
 
-    return ''.join(textparts)
+    if textCache:
+        textCache.put(refKey, CACHE_SECTION, token, text)
+        textCache.commit()
+    return text
 #-----------------------------------
 
 def cleanUpTextField(text):
@@ -402,15 +421,7 @@ def cleanUpTextField(text):
     if args.maxTextLength:	# handy for debugging
         text = text[:args.maxTextLength]
 
-    text = removeNonAscii(cleanDelimiters(text))
-    text = text.replace('\r', ' ')
-    return text
-#-----------------------------------
-
-def cleanDelimiters(text):
-    """ remove RECORDEND and FIELDSEPs from text (replace w/ ' ')
-    """
-    return text.replace(RECORDEND,' ').replace(FIELDSEP,' ')
+    return textCleaner.clean(text)
 #-----------------------------------
 
 def verbose(text):
@@ -447,6 +458,12 @@ def main():
     db.set_sqlUser    ("mgd_public")
     db.set_sqlPassword("mgdpub")
 
+    global textCache, pdfCache
+    if args.cacheFile and args.fromPDF:
+        pdfCache = pdfTextLib.PdfTextCache(args.cacheFile, args.cacheMBytes)
+    elif args.cacheFile:
+        textCache = textCacheLib.TextCache(args.cacheFile, args.cacheMBytes)
+
     if   args.option == 'test':    doAutomatedTests()
     elif args.option == 'routed':           doSamples(SQL_routed)
     elif args.option == 'notRoutedKeep':    doSamples(SQL_notRoutedKeep)
@@ -465,6 +482,12 @@ def main():
         doSamples(sqlList)
     else: sys.stderr.write("invalid option: '%s'\n" % args.option)
 
+    if textCache:
+        verbose(textCache.getStats())
+        textCache.close()
+    if pdfCache:
+        verbose(pdfCache.getStats())
+        pdfCache.close()
     exit(0)
 #-----------------------------------
 if __name__ == "__main__":
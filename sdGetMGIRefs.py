@@ -6,8 +6,9 @@
             replacing non-ascii chars with ' '
             replacing FIELDSEP and RECORDSEP chars in the doc text w/ ' '
 
-  Outputs:      Delimited file to stdout
-                MLtextTools Sample File of MGIReference objects.
+  Outputs:      Delimited file to stdout (or to files given via -o)
+                MLtextTools Sample File of MGIReference objects
+                and/or '|' delimited table of reference metadata.
 '''
 #-----------------------------------
 import sys
@@ -16,17 +17,29 @@ import string
 import re
 import time
 import argparse
+import shutil
+import tempfile
+import multiprocessing
 import db
 import MGIReference
-from utilsLib import removeNonAscii
-import ExtractedTextSet
+import textCleanLib
+import dbExtractLib
+import sampleFileLib
+import textCacheLib
+import columnarLib
+import pipelineLib
 #-----------------------------------
 
 sampleObjType = MGIReference.MGIReference
+# the samples we build and write: compact records w/ the same fields
+compactObjType = MGIReference.CompactMGIReference
 
 # for the Sample output file
 RECORDEND    = sampleObjType.getRecordEnd()
 FIELDSEP     = sampleObjType.getFieldSep()
+
+# to remove delimiters and non-ascii chars from text fields
+textCleaner  = textCleanLib.TextCleaner([RECORDEND, FIELDSEP])
 #-----------------------------------
 
 def getArgs():
@@ -39,17 +52,126 @@ def getArgs():
         help="just run automated test code")
 
     parser.add_argument('option', action='store', default='counts',
-        choices=['selected', 'rejected', 'older', 'counts'],
-        help='which subset of training samples to get or "counts" (default)')
+        choices=['selected', 'rejected', 'older', 'counts', 'all'],
+        help='which subset of training samples to get or "counts" ' +
+            '(default) or "all" to write counts to stdout and every subset ' +
+            'to its own files in one db session')
+
+    parser.add_argument('-o', '--output', dest='outputs', action='append',
+        required=False, default=None, metavar='FORMAT[=FILE]',
+        help="Output format: samplefile, table, or parquet. Add =FILE to " +
+            "write it to FILE instead of stdout (parquet needs a FILE, it " +
+            "also writes a .text.parquet file). A samplefile FILE ending in " +
+            ".gz or .zst is compressed. Repeat to write several " +
+            "formats from one run. Default is samplefile. For 'all', FILE " +
+            "must have a %%s for the subset name (default %%s.txt, " +
+            "%%s.tbl.txt, %%s.parquet), and default formats are samplefile " +
+            "and table")
+
+    parser.add_argument('--index', dest='index', action='store_true',
+        required=False,
+        help="also write an index file (FILE.idx) for the samplefile " +
+            "output giving each sample's ID, _refs_key, byte offset and " +
+            "length. Needs an uncompressed samplefile FILE")
+
+    parser.add_argument('--shardsize', dest='shardSize',
+        type=int, required=False, default=0,
+        help="write the samplefile FILE as shards of at most n samples " +
+            "(e.g., sel.txt -> sel.0000.txt, sel.0001.txt, ...) plus a " +
+            "manifest (sel.manifest.json) of their counts, ID ranges and " +
+            "checksums")
+
+    parser.add_argument('--shardmbytes', dest='shardMBytes',
+        type=int, required=False, default=0,
+        help="write the samplefile FILE as shards of at most n MB " +
+            "(uncompressed), plus a manifest")
+
+    parser.add_argument('--checkpoint', dest='checkpoint', action='store_true',
+        required=False,
+        help="write the samplefile FILE as FILE.partial, committing it " +
+            "(FILE.ckpt) every --batchsize references so a run that dies " +
+            "can be continued w/ --resume. Renamed to FILE when done. " +
+            "Needs one uncompressed samplefile FILE output")
+
+    parser.add_argument('--resume', dest='resume', action='store_true',
+        required=False,
+        help="continue a --checkpoint run from its last checkpoint: only " +
+            "get refs w/ _refs_key above its high-water mark and append " +
+            "them to FILE.partial. (refs added to the db w/ lower keys " +
+            "since the checkpoint are not picked up)")
+
+    parser.add_argument('--update', dest='updateFile', action='store',
+        required=False, default=None, metavar='SAMPLEFILE',
+        help="incremental update of an existing sample file: only get " +
+            "refs from the db that are new or changed since it was " +
+            "written, reuse its other samples. For 'all', SAMPLEFILE " +
+            "must have a %%s for the subset name")
+
+    parser.add_argument('--stream', dest='stream', action='store_true',
+        required=False,
+        help="read and write references a batch at a time through a " +
+            "server-side cursor instead of building the whole SampleSet")
+
+    parser.add_argument('--batchsize', dest='batchSize',
+        type=int, required=False, default=dbExtractLib.BATCH_SIZE,
+        help="num of references per batch when streaming. Default %d" % \
+                                                    dbExtractLib.BATCH_SIZE)
 
-    parser.add_argument('-o', '--output', dest='output',
-        choices=['samplefile', 'table'], default='samplefile',
-        help="Output format. Default is samplefile")
+    parser.add_argument('--workers', dest='workers',
+        type=int, required=False, default=1,
+        help="num of worker processes (each w/ its own db connection) to " +
+            "fetch extracted text and build samples in parallel. Default 1")
+
+    parser.add_argument('--buildthreads', dest='buildThreads',
+        type=int, required=False, default=0,
+        help="pipeline the run: num of threads building samples while " +
+            "another thread fetches references and text from the db and the " +
+            "main thread writes them. Default 0: fetch, build and write " +
+            "one after another. The threads share one CPU (the GIL): " +
+            "this overlaps db waits and writing w/ building, more build " +
+            "threads do not build faster")
+
+    parser.add_argument('--cache', dest='cacheFile', action='store',
+        required=False, default=None, metavar='CACHEFILE',
+        help="local cache of extracted text. Only get text from the db " +
+            "for refs not in the cache or whose text has changed")
+
+    parser.add_argument('--cachesize', dest='cacheMBytes',
+        type=int, required=False, default=textCacheLib.DEFAULT_MAX_MBYTES,
+        help="max size of the text cache in MB, least recently used " +
+            "text is evicted. Default %d" % textCacheLib.DEFAULT_MAX_MBYTES)
+
+    parser.add_argument('--copytext', dest='copyText', action='store_true',
+        required=False,
+        help="get extracted text in one binary COPY ... TO STDOUT stream " +
+            "on a separate db connection instead of a query per page. " +
+            "Needs psycopg2. Cannot be used w/ --cache")
+
+    parser.add_argument('--checkcopytext', dest='checkCopyText',
+        action='store_true', required=False,
+        help="--copytext, but first check the COPY gets the same text as " +
+            "the queries for the refs, stop w/ an error if it does not. " +
+            "Run this against a new db/schema before relying on --copytext")
+
+    parser.add_argument('--pagesize', dest='pageSize',
+        type=int, required=False, default=dbExtractLib.PAGE_SIZE,
+        help="num of references per page when fetching extracted text. " +
+            "Default %d" % dbExtractLib.PAGE_SIZE)
 
     parser.add_argument('--textlength', dest='maxTextLength',
         type=int, required=False, default=None,
         help="only include the 1st n chars of text fields (for debugging)")
 
+    parser.add_argument('--profile', dest='profileFile', action='store',
+        required=False, default=None, metavar='REPORTFILE',
+        help="profile every db.sql() stmt (time, rows, bytes) and write " +
+            "a JSON report to REPORTFILE")
+
+    parser.add_argument('--explain', dest='explain', action='store_true',
+        required=False,
+        help="w/ --profile, also capture explain (analyze, buffers) " +
+            "plans for each tmp table build")
+
     parser.add_argument('-q', '--quiet', dest='verbose', action='store_false',
         required=False, help="skip helpful messages to stderr")
 
@@ -67,6 +189,52 @@ def getArgs():
 
     args =  parser.parse_args()
 
+    if args.option == 'all':
+        args.outputs = parseOutputs(parser, args.outputs or ALL_OUTPUTS,
+                                                                allSubsets=True)
+    else:
+        args.outputs = parseOutputs(parser, args.outputs or ['samplefile'])
+
+    if args.updateFile and args.option == 'all' \
+                                    and args.updateFile.count('%s') != 1:
+        parser.error("--update file needs one %s for the subset name")
+
+    if args.index:
+        sampleFiles = [ fn for fmt, fn in args.outputs if fmt == 'samplefile' ]
+        if not sampleFiles or sampleFiles[0] == '-' \
+                        or sampleFiles[0].endswith(('.gz', '.zst')):
+            parser.error("--index needs an uncompressed samplefile FILE")
+
+    if args.shardSize or args.shardMBytes:
+        sampleFiles = [ fn for fmt, fn in args.outputs if fmt == 'samplefile' ]
+        if not sampleFiles or sampleFiles[0] == '-':
+            parser.error("sharding needs a samplefile FILE")
+        if args.index:
+            parser.error("--index cannot be used w/ shards")
+
+    if args.resume:
+        args.checkpoint = True
+    if args.checkpoint:
+        if args.option == 'all':
+            parser.error("--checkpoint cannot be used w/ 'all'")
+        if len(args.outputs) != 1 or args.outputs[0][0] != 'samplefile' \
+                        or args.outputs[0][1] == '-' \
+                        or args.outputs[0][1].endswith(('.gz', '.zst')):
+            parser.error("--checkpoint needs one uncompressed samplefile " +
+                                                                "FILE output")
+        if args.index or args.shardSize or args.shardMBytes \
+                                or args.updateFile or args.workers > 1:
+            parser.error("--checkpoint cannot be used w/ --index, shards, " +
+                                                    "--update, or --workers")
+
+    if args.checkCopyText:
+        args.copyText = True
+    if args.copyText and args.cacheFile:
+        parser.error("--copytext cannot be used w/ --cache")
+
+    if args.workers > 1 and (args.stream or args.updateFile):
+        parser.error("--workers cannot be used w/ --stream or --update")
+
     if args.server == 'adhoc':
         args.host = 'mgi-adhoc.jax.org'
         args.db = 'mgd'
@@ -86,11 +254,53 @@ def getArgs():
     return args
 #-----------------------------------
 
+OUTPUT_FORMATS = ['samplefile', 'table', 'parquet']
+ALL_OUTPUTS    = ['samplefile', 'table']    # default formats for 'all'
+SAMPLE_OUTPUTS = ['samplefile', 'parquet']  # formats w/ the samples' text
+
+# default output file names for 'all', %s is replaced by the subset name
+DEFAULT_FILES = {'samplefile': '%s.txt', 'table': '%s.tbl.txt',
+                                                    'parquet': '%s.parquet'}
+
+def parseOutputs(parser, outputOpts,
+    allSubsets=False,       # T/F the outputs are for the 'all' option
+    ):
+    '''
+    Return list of (output format, file name) from the -o option values.
+    File name is '-' for stdout. At most one output can go to stdout.
+    For allSubsets, each subset is written to its own files, so file names
+        are patterns with a '%s' for the subset name.
+    '''
+    outputs = []
+    for opt in outputOpts:
+        fmt, sep, fileName = opt.partition('=')
+        if fmt not in OUTPUT_FORMATS:
+            parser.error("invalid output format '%s', choose from %s" % \
+                                            (fmt, ', '.join(OUTPUT_FORMATS)))
+        if fmt in [ f for f, fn in outputs ]:
+            parser.error("output format '%s' given more than once" % fmt)
+        if allSubsets:
+            fileName = fileName or DEFAULT_FILES[fmt]
+            if fileName.count('%s') != 1:
+                parser.error("output file '%s' needs one %%s for the " \
+                                                "subset name" % fileName)
+        if fmt == 'parquet' and not fileName:
+            parser.error("parquet output needs a file: -o parquet=FILE")
+        outputs.append( (fmt, fileName or '-') )
+
+    if len([ fn for f, fn in outputs if fn == '-' ]) > 1:
+        parser.error("only one output format can be written to stdout")
+    return outputs
+#-----------------------------------
+
 args = getArgs()
 
 ####################
 # SQL fragments used to build up queries
 #    We build the queries in the following steps:
+#    0) A tmp table mapping each _refs_key to its MGI ID, PMID, and DOID
+#        (dbExtractLib.BUILD_REFIDS_TABLE) that the other queries join to
+#        instead of joining acc_accession once per ID type
 #    1) A tmp OMIT_TABLE of references to omit from the training set because
 #        their ground truth may be questionable
 #    2) a tmp BASE_TABLE of all refs NOT in the OMIT_TABLE and build an
@@ -99,8 +309,9 @@ args = getArgs()
 #        criteria for the specific training sample option
 #    4) using the final tmp table,
 #        do a "select *" to get the basic reference data
-#        use ExtractedTextSet.getExtractedTextSetForTable() to get their
-#            extracted text
+#        get their extracted text a page of refs at a time
+#            (dbExtractLib.iterExtractedText(), or iterCopiedText() for
+#            --copytext) and merge it onto the reference data
 #        do select count(*) to get data set counts.
 ####################
 START_DATE = "11/01/2019"      # earliest date for refs w/ cur pdftotext version
@@ -110,6 +321,39 @@ OLD_START_DATE = "01/01/2000"  # earliest date to get older refs from
 #LIT_TRIAGE_DATE = "10/31/2017" # when we switched to new lit triage
 #END_DATE = "12/31/2019"                 # last date to get training data from
 
+#----------------
+# SQL predicates shared by the tmp table SQL below and COUNTS_SQL, so the
+#  counts always match the samples we would extract.
+PM2GENE_INDEXED_PRED = '''bs._status_key = 31576673 and bs._group_key = 31576666
+                    and bs._createdby_key = 1571 /* index for GO by pm2geneload */'''
+GOA_CREATED_PRED = 'r._createdby_key = 1575 /* created by littriage_goa */'
+NOT_CURATED_PRED = '''(     /* not selected/rejected by any group other than GO */
+                bsv.ap_status in    ('New', 'Not Routed', 'Routed')
+            and bsv.gxd_status in   ('New', 'Not Routed', 'Routed')
+            and bsv.tumor_status in ('New', 'Not Routed', 'Routed')
+            and bsv.qtl_status in   ('New', 'Not Routed', 'Routed')
+            and bsv.pro_status in   ('New', 'Not Routed', 'Routed')
+            )'''
+DISCARD_PRED = 'wr._relevance_key = 70594666 /* discard */'
+MICE_IN_REFS_PRED = 'bt._tag_key = 49170000 /* MGI:Mice_in_references_only */'
+NO_TEXT_PRED = '''(
+            bwd.haspdf = 0
+            or bwd.extractedtext is null
+            or length(bwd.extractedtext) < 500
+            )'''
+SELECTED_PRED = '''(   bsv.ap_status in ('Chosen', 'Indexed', 'Full-coded')
+     or bsv.go_status in ('Chosen', 'Indexed', 'Full-coded')
+     or bsv.gxd_status in ('Chosen', 'Indexed', 'Full-coded')
+     or bsv.qtl_status in ('Chosen', 'Indexed', 'Full-coded')
+     or bsv.tumor_status in ('Chosen', 'Indexed', 'Full-coded')
+     or bsv.pro_status in ('Chosen', 'Indexed', 'Full-coded')
+    )'''
+REJECTED_PRED = '''wr._relevance_key = 70594666        /* discard */
+    and wr._createdby_key != 1617       /* relevance_classifier */'''
+OLDER_PRED = '''(   bsv.gxd_status   in ('Chosen', 'Indexed', 'Full-coded')
+     or bsv.tumor_status in ('Chosen', 'Indexed', 'Full-coded', 'Rejected')
+    )'''
+PEER_REVIEWED_PRED = 'r._referencetype_key = 31576687 /* Peer Reviewed Article */'
 #----------------
 OMIT_TEXT = "Omitted refs\n" + \
     "\tGOA loaded or only pm2gene indexed or MGI:Mice_in_references_only.\n" + \
@@ -136,7 +380,7 @@ BUILD_OMIT_TABLE = [ \
 '''
     create temporary table tmp_omit
     as
-    select distinct r._refs_key, mgi.accid ID
+    select distinct r._refs_key, ids.mgiid ID
     from bib_refs r join bib_workflow_status bs
         on (r._refs_key = bs._refs_key and bs.iscurrent=1 )
         join bib_status_view bsv on (r._refs_key = bsv._refs_key)
@@ -145,40 +389,30 @@ BUILD_OMIT_TABLE = [ \
                                                 and wr.iscurrent=1)
         join bib_workflow_data bwd on (r._refs_key = bwd._refs_key
                             and bwd._extractedtext_key = 48804490) -- "body"
-        join acc_accession mgi on (r._refs_key = mgi._object_key
-                        and mgi._mgitype_key = 1 and mgi._logicaldb_key = 1
-                        and mgi.prefixpart = 'MGI:' and mgi.preferred = 1)
+        join %s ids on (r._refs_key = ids._refs_key
+                                            and ids.mgiid is not null)
     where 
     r.creation_date >= '%s'
     and
     (
-        (   (   (bs._status_key = 31576673 and bs._group_key = 31576666 and 
-                    bs._createdby_key = 1571 -- index for GO by pm2geneload
+        (   (   (%s
                 )
-                or r._createdby_key = 1575 -- created by littriage_goa
-            )
-            and           -- not selected/rejected by any other group
-            (
-                bsv.ap_status in    ('New', 'Not Routed', 'Routed')
-            and bsv.gxd_status in   ('New', 'Not Routed', 'Routed')
-            and bsv.tumor_status in ('New', 'Not Routed', 'Routed')
-            and bsv.qtl_status in   ('New', 'Not Routed', 'Routed')
-            and bsv.pro_status in   ('New', 'Not Routed', 'Routed')
+                or %s
             )
+            and
+            %s
         )
         or
         (
-            wr._relevance_key = 70594666        -- discard
-            and bt._tag_key = 49170000          -- MGI:Mice_in_references_only
+            %s
+            and %s
         )
         or
-        (
-            bwd.haspdf = 0
-            or bwd.extractedtext is null
-            or length(bwd.extractedtext) < 500
-        )
+        %s
     )
-''' % (OLD_START_DATE),
+''' % (dbExtractLib.REFIDS_TMP_TBL, OLD_START_DATE, PM2GENE_INDEXED_PRED,
+        GOA_CREATED_PRED, NOT_CURATED_PRED, DISCARD_PRED, MICE_IN_REFS_PRED,
+        NO_TEXT_PRED),
 '''
     create index tmp_idx1 on tmp_omit(_refs_key)
 ''',
@@ -194,9 +428,9 @@ SELECTED_REFS_SQL = [ \
     as
     select distinct
         r._refs_key,
-        mgid.accid ID,
-        pmid.accid PMID,
-        doid.accid DOID,
+        ids.mgiid ID,
+        ids.pmid PMID,
+        ids.doid DOID,
         to_char(r.creation_date, 'MM/DD/YYYY') as "creationDate",
         rcreator.login as "createdBy",
         r.date as "pubDate",
@@ -222,32 +456,19 @@ SELECTED_REFS_SQL = [ \
         join voc_term suppTerm on (bwd._supplemental_key = suppTerm._term_key)
         join voc_term rt on (wr._relevance_key = rt._term_key)
         join voc_term typeTerm on (r._referencetype_key = typeTerm._term_key)
-        join acc_accession mgid on
-            (mgid._object_key = r._refs_key
-             and mgid._mgitype_key = 1 and mgid._logicaldb_key = 1 -- MGI ID
-             and mgid.prefixpart = 'MGI:' and mgid.preferred = 1)
-        left join acc_accession pmid on
-                                -- left joins since some papers don't seem
-                                --  to have their pmid and doi in the db
-            (pmid._object_key = r._refs_key and pmid._logicaldb_key=29 -- pubmed
-             and pmid._mgitype_key=1 and pmid.preferred=1 )
-        left join acc_accession doid on
-            (doid._object_key = r._refs_key and doid._logicaldb_key=65 -- DOID
-             and doid._mgitype_key=1 and doid.preferred=1 )
+        join %s ids on (r._refs_key = ids._refs_key
+                        and ids.mgiid is not null)  -- some papers don't seem
+                                --  to have their pmid and doi in the db, so
+                                --  only require the MGI ID
         join mgi_user rcreator on (r._createdby_key = rcreator._user_key)
         join mgi_user reluser on (wr._createdby_key = reluser._user_key)
     where -- Selected
-    (   bsv.ap_status in ('Chosen', 'Indexed', 'Full-coded')
-     or bsv.go_status in ('Chosen', 'Indexed', 'Full-coded')
-     or bsv.gxd_status in ('Chosen', 'Indexed', 'Full-coded')
-     or bsv.qtl_status in ('Chosen', 'Indexed', 'Full-coded')
-     or bsv.tumor_status in ('Chosen', 'Indexed', 'Full-coded')
-     or bsv.pro_status in ('Chosen', 'Indexed', 'Full-coded')
-    )
+    %s
     and not exists (select 1 from tmp_omit t where t._refs_key = r._refs_key)
-    and r._referencetype_key = 31576687     -- Peer Reviewed Article
+    and %s
     and r.creation_date > '%s'
-''' % (SELECTED_TMP_TBL, START_DATE),
+''' % (SELECTED_TMP_TBL, dbExtractLib.REFIDS_TMP_TBL, SELECTED_PRED,
+                                            PEER_REVIEWED_PRED, START_DATE),
 
 '''create index tmp_idx_%s on %s(_refs_key)''' % \
                                         (SELECTED_TMP_TBL, SELECTED_TMP_TBL),
@@ -264,9 +485,9 @@ OLDREFS_SQL = [ \
     as
     select distinct
         r._refs_key,
-        mgid.accid ID,
-        pmid.accid PMID,
-        doid.accid DOID,
+        ids.mgiid ID,
+        ids.pmid PMID,
+        ids.doid DOID,
         to_char(r.creation_date, 'MM/DD/YYYY') as "creationDate",
         rcreator.login as "createdBy",
         r.date as "pubDate",
@@ -292,29 +513,20 @@ OLDREFS_SQL = [ \
         join voc_term suppTerm on (bwd._supplemental_key = suppTerm._term_key)
         join voc_term rt on (wr._relevance_key = rt._term_key)
         join voc_term typeTerm on (r._referencetype_key = typeTerm._term_key)
-        join acc_accession mgid on
-            (mgid._object_key = r._refs_key
-             and mgid._mgitype_key = 1 and mgid._logicaldb_key = 1 -- MGI ID
-             and mgid.prefixpart = 'MGI:' and mgid.preferred = 1)
-        left join acc_accession pmid on
-                                -- left joins since some papers don't seem
-                                --  to have their pmid and doi in the db
-            (pmid._object_key = r._refs_key and pmid._logicaldb_key=29 -- pubmed
-             and pmid._mgitype_key=1 and pmid.preferred=1 )
-        left join acc_accession doid on
-            (doid._object_key = r._refs_key and doid._logicaldb_key=65 -- DOID
-             and doid._mgitype_key=1 and doid.preferred=1 )
+        join %s ids on (r._refs_key = ids._refs_key
+                        and ids.mgiid is not null)  -- some papers don't seem
+                                --  to have their pmid and doi in the db, so
+                                --  only require the MGI ID
         join mgi_user rcreator on (r._createdby_key = rcreator._user_key)
         join mgi_user reluser on (wr._createdby_key = reluser._user_key)
     where -- Selected by GXD/Tumor or rejected by Tumor
-    (   bsv.gxd_status   in ('Chosen', 'Indexed', 'Full-coded')
-     or bsv.tumor_status in ('Chosen', 'Indexed', 'Full-coded', 'Rejected')
-    )
+    %s
     and not exists (select 1 from tmp_omit t where t._refs_key = r._refs_key)
-    and r._referencetype_key = 31576687     -- Peer Reviewed Article
+    and %s
     and r.creation_date >= '%s'
     and r.creation_date < '%s'
-''' % (OLDREFS_TMP_TBL, OLD_START_DATE, START_DATE),
+''' % (OLDREFS_TMP_TBL, dbExtractLib.REFIDS_TMP_TBL, OLDER_PRED,
+                            PEER_REVIEWED_PRED, OLD_START_DATE, START_DATE),
 
 '''create index tmp_idx_%s on %s(_refs_key)''' % \
                                         (OLDREFS_TMP_TBL, OLDREFS_TMP_TBL),
@@ -325,15 +537,14 @@ REJECTED_TEXT = "Peer Reviewed Papers manually discarded\n" + \
     "\tCreated >= %s" % START_DATE
 REJECTED_TMP_TBL = 'tmp_rejected'
 REJECTED_REFS_SQL = [ \
-'''     -- Step 1:  get all fields into tmp_rejects1 except pmid and doi
-        -- seems joining in acc tbl multiple times kills the query performance
-    create temporary table tmp_rejects1
+'''
+    create temporary table %s
     as
     select distinct
         r._refs_key,
-        mgid.accid ID,
---        pmid.accid PMID,
---        doid.accid DOID,
+        ids.mgiid ID,
+        ids.pmid PMID,
+        ids.doid DOID,
         to_char(r.creation_date, 'MM/DD/YYYY') as "creationDate",
         rcreator.login as "createdBy",
         r.date as "pubDate",
@@ -359,41 +570,139 @@ REJECTED_REFS_SQL = [ \
         join voc_term suppTerm on (bwd._supplemental_key = suppTerm._term_key)
         join voc_term rt on (wr._relevance_key = rt._term_key)
         join voc_term typeTerm on (r._referencetype_key = typeTerm._term_key)
-        join acc_accession mgid on
-            (mgid._object_key = r._refs_key
-             and mgid._mgitype_key = 1 and mgid._logicaldb_key = 1 -- MGI ID
-             and mgid.prefixpart = 'MGI:' and mgid.preferred = 1)
+        join %s ids on (r._refs_key = ids._refs_key
+                        and ids.mgiid is not null)  -- some papers don't seem
+                                --  to have their pmid and doi in the db, so
+                                --  only require the MGI ID
         join mgi_user rcreator on (r._createdby_key = rcreator._user_key)
         join mgi_user reluser on (wr._createdby_key = reluser._user_key)
     where -- Rejected
     not exists (select 1 from tmp_omit t where t._refs_key = r._refs_key)
-    and wr._relevance_key = 70594666        -- discard
-    and wr._createdby_key != 1617       -- relevance_classifier
-    and r._referencetype_key = 31576687     -- Peer Reviewed Article
+    and %s
+    and %s
     and r.creation_date > '%s'
-''' % (START_DATE),
-
-'''  -- Step 2:  join in pmid and doi into the final tmp table
-    create temporary table %s
-    as
-    select t1.*, 
-        pmid.accid PMID,
-        doid.accid DOID
-    from tmp_rejects1 t1        -- left joins since some papers don't seem
-                                --  to have their pmid and doi in the db
-        left join acc_accession pmid on
-            (pmid._object_key = t1._refs_key and pmid._logicaldb_key=29 --pubmed
-             and pmid._mgitype_key=1 and pmid.preferred=1 )
-        left join acc_accession doid on
-            (doid._object_key = t1._refs_key and doid._logicaldb_key=65 -- DOID
-             and doid._mgitype_key=1 and doid.preferred=1 )
-''' % (REJECTED_TMP_TBL),
+''' % (REJECTED_TMP_TBL, dbExtractLib.REFIDS_TMP_TBL, REJECTED_PRED,
+                                            PEER_REVIEWED_PRED, START_DATE),
 
 '''create index tmp_idx_%s on %s(_refs_key)''' % \
                                         (REJECTED_TMP_TBL, REJECTED_TMP_TBL),
 ]
 #----------------
 
+# The reference subsets we can retrieve, in the order "all" retrieves them.
+# subset option -> (description, SQL to build its tmp table, tmp table name,
+#                   T/F get its extracted text from the db)
+SUBSET_NAMES = ['selected', 'rejected', 'older']
+SUBSETS = {
+    'selected': (SELECTED_TEXT, SELECTED_REFS_SQL, SELECTED_TMP_TBL, True),
+    'rejected': (REJECTED_TEXT, REJECTED_REFS_SQL, REJECTED_TMP_TBL, True),
+    'older'   : (OLDREFS_TEXT,  OLDREFS_SQL,       OLDREFS_TMP_TBL,  False),
+                            # older refs have extText from older
+                            # pdftotext version in the db.
+    }
+SELECT_COUNT_SQL = 'select count(distinct _refs_key) as num from %s\n'
+#-----------------------------------
+
+# All the counts in one scan: flag each ref w/ the omit and subset predicates
+#  above (one bool_or per ref, so multiple joined rows count once) and
+#  count the flags. No tmp tables but the ref ID map (like the subset
+#  queries, it joins that instead of acc_accession), no journal/title/abstract.
+# The lookup tables the subset queries inner join are left joined here,
+#  and are required only by the subset flags, like the subset queries.
+# A flag is NULL if its predicate is NULL for all the ref's rows (e.g., a
+#  NULL status). Like the tmp tables (where only true predicates select a
+#  row), NULL counts as false: a ref w/ a NULL isOmit is not in tmp_omit,
+#  so it is not omitted ("is not true").
+COUNTS_SQL = '''
+    select
+        count(*) filter (where isOmit) as "omit",
+        count(*) filter (where isOmit is not true and isSelected) as "selected",
+        count(*) filter (where isOmit is not true and isRejected) as "rejected",
+        count(*) filter (where isOmit is not true and isOlder) as "older"
+    from (
+        select r._refs_key,
+        bool_or(                                        -- omit
+            exists (select 1 from bib_workflow_status bs
+                    where bs._refs_key = r._refs_key and bs.iscurrent = 1)
+            and
+            (
+            (   (   exists (select 1 from bib_workflow_status bs
+                        where bs._refs_key = r._refs_key and bs.iscurrent = 1
+                        and %(pm2gene)s)
+                    or %(goaCreated)s
+                )
+                and
+                %(notCurated)s
+            )
+            or
+            (
+                %(discard)s
+                and exists (select 1 from bib_workflow_tag bt
+                    where bt._refs_key = r._refs_key
+                    and %(miceInRefs)s)
+            )
+            or
+            %(noText)s
+            )
+        ) as isOmit,
+        bool_or(                                        -- selected
+            %(selected)s
+            and %(lookups)s
+            and %(peerReviewed)s
+            and r.creation_date > '%(startDate)s'
+        ) as isSelected,
+        bool_or(                                        -- rejected
+            %(rejected)s
+            and %(lookups)s
+            and %(peerReviewed)s
+            and r.creation_date > '%(startDate)s'
+        ) as isRejected,
+        bool_or(                                        -- older
+            %(older)s
+            and %(lookups)s
+            and %(peerReviewed)s
+            and r.creation_date >= '%(oldStartDate)s'
+            and r.creation_date < '%(startDate)s'
+        ) as isOlder
+        from bib_refs r
+            join bib_status_view bsv on (r._refs_key = bsv._refs_key)
+            join bib_workflow_relevance wr on (r._refs_key = wr._refs_key
+                                                    and wr.iscurrent=1)
+            join bib_workflow_data bwd on (r._refs_key = bwd._refs_key
+                                and bwd._extractedtext_key = 48804490) -- "body"
+            join %(refIds)s ids on (r._refs_key = ids._refs_key
+                                            and ids.mgiid is not null)
+            left join voc_term suppTerm on
+                                    (bwd._supplemental_key = suppTerm._term_key)
+            left join voc_term rt on (wr._relevance_key = rt._term_key)
+            left join voc_term typeTerm on
+                                    (r._referencetype_key = typeTerm._term_key)
+            left join mgi_user rcreator on
+                                    (r._createdby_key = rcreator._user_key)
+            left join mgi_user reluser on
+                                    (wr._createdby_key = reluser._user_key)
+        where r.creation_date >= '%(oldStartDate)s'
+        group by r._refs_key
+    ) refs
+''' % { 'pm2gene'      : PM2GENE_INDEXED_PRED,
+        'goaCreated'   : GOA_CREATED_PRED,
+        'notCurated'   : NOT_CURATED_PRED,
+        'discard'      : DISCARD_PRED,
+        'miceInRefs'   : MICE_IN_REFS_PRED,
+        'noText'       : NO_TEXT_PRED,
+        'selected'     : SELECTED_PRED,
+        'rejected'     : REJECTED_PRED,
+        'older'        : OLDER_PRED,
+        'peerReviewed' : PEER_REVIEWED_PRED,
+        'lookups'      : '''suppTerm._term_key is not null
+            and rt._term_key is not null and typeTerm._term_key is not null
+            and rcreator._user_key is not null
+            and reluser._user_key is not null /* the subset SQL inner joins */''',
+        'refIds'       : dbExtractLib.REFIDS_TMP_TBL,
+        'startDate'    : START_DATE,
+        'oldStartDate' : OLD_START_DATE,
+      }
+
 def doCounts():
     '''
     Get counts of sample records from db and write them to stdout
@@ -401,27 +710,25 @@ def doCounts():
     verbose("%s\nGetting dataset counts\n" % time.ctime())
 
     startTime = time.time()
-    sys.stdout.write(time.ctime() + '\n')
-    sys.stdout.write("Hitting database %s %s as mgd_public\n" % \
-                                                    (args.host, args.db))
-
-    selectCountSQL = 'select count(distinct _refs_key) as num from %s\n'
-
-    db.sql(BUILD_OMIT_TABLE, 'auto')
-    doCount(OMIT_TEXT, [selectCountSQL % "tmp_omit"])
-
-    db.sql(SELECTED_REFS_SQL, 'auto')
-    doCount(SELECTED_TEXT, [selectCountSQL % SELECTED_TMP_TBL])
+    writeCountsHeader()
 
-    db.sql(REJECTED_REFS_SQL, 'auto')
-    doCount(REJECTED_TEXT, [selectCountSQL % REJECTED_TMP_TBL])
+    db.sql(dbExtractLib.BUILD_REFIDS_TABLE, 'auto')
+    counts = db.sql(COUNTS_SQL, 'auto')[0]
+    sys.stdout.write("%7d\t%s\n" % (counts['omit'], OMIT_TEXT))
 
-    db.sql(OLDREFS_SQL, 'auto')
-    doCount(OLDREFS_TEXT, [selectCountSQL % OLDREFS_TMP_TBL])
+    for subset in SUBSET_NAMES:
+        label, tmpTableSQL, tmpTableName, getExtractedText = SUBSETS[subset]
+        sys.stdout.write("%7d\t%s\n" % (counts[subset], label))
 
     verbose("Total time: %8.3f seconds\n\n" % (time.time()-startTime))
 #-----------------------------------
 
+def writeCountsHeader():
+    sys.stdout.write(time.ctime() + '\n')
+    sys.stdout.write("Hitting database %s %s as mgd_public\n" % \
+                                                    (args.host, args.db))
+#-----------------------------------
+
 def doCount(label, q  # list of sql stmts. last one being 'select count as num'
     ):
     results = db.sql(q, 'auto')
@@ -434,12 +741,27 @@ def main():
 ####################
     db.set_sqlServer  (args.host)
     db.set_sqlDatabase(args.db)
-    db.set_sqlUser    ("mgd_public")
-    db.set_sqlPassword("mgdpub")
+    db.set_sqlUser    (dbExtractLib.DB_USER)
+    db.set_sqlPassword(dbExtractLib.DB_PASSWORD)
+
+    global textCache
+    if args.cacheFile:
+        textCache = openTextCache()
+    if args.profileFile:
+        profiler = dbExtractLib.SqlProfiler(db, explain=args.explain).install()
 
     if args.option == 'counts': doCounts()
+    elif args.option == 'all':  doAll()
     else: doSamples()
 
+    if args.profileFile:
+        profiler.writeReport(args.profileFile, getProfileMeta())
+        verbose("wrote SQL profile to '%s'\n" % args.profileFile)
+
+    if textCache:
+        verbose(textCache.getStats())
+        textCache.close()
+
 #-----------------------------------
 
 def doSamples():
@@ -450,115 +772,593 @@ def doSamples():
     verbose("Hitting database %s %s as mgd_public\n" % (args.host, args.db))
     startTime = time.time()
 
-    # build the omit tmpTable - references to not retrieve
+    buildOmitTable()
+    doSubset(args.option)
+    verbose("Total time: %8.3f seconds\n\n" % (time.time()-startTime))
+#-----------------------------------
+
+def doAll():
+    '''
+    Retrieve every subset in one db session:
+        build the omit tmpTable once, then build each subset's tmpTable on
+        the same connection and write the subset to its own output files.
+    Write the subset counts to stdout and per-phase timings to stderr.
+    '''
+    verbose("%s\nRetrieving all reference sets: %s\n" % \
+                                    (time.ctime(), ', '.join(SUBSET_NAMES)))
+    verbose("Hitting database %s %s as mgd_public\n" % (args.host, args.db))
+    startTime = time.time()
+    writeCountsHeader()
+
+    buildOmitTable()
+    doCount(OMIT_TEXT, [SELECT_COUNT_SQL % "tmp_omit"])
+
+    for subset in SUBSET_NAMES:
+        doSubset(subset)
+        doCount(SUBSETS[subset][0], [SELECT_COUNT_SQL % SUBSETS[subset][2]])
+
+    verbose("Phase timings:\n")
+    for phase, seconds in phaseTimes:
+        verbose("%8.3f seconds\t%s\n" % (seconds, phase))
+    verbose("Total time: %8.3f seconds\n\n" % (time.time()-startTime))
+#-----------------------------------
+
+phaseTimes = []         # [(phase description, elapsed seconds), ...]
+
+def endPhase(phase, startTime):
+    ''' Record and report the elapsed time for a phase started at startTime
+    '''
+    elapsed = time.time() - startTime
+    phaseTimes.append( (phase, elapsed) )
+    verbose("%s time: %8.3f seconds\n\n" % (phase, elapsed))
+#-----------------------------------
+
+def buildOmitTable():
+    ''' build the ref ID map tmpTable and
+        the omit tmpTable - references to not retrieve
+    '''
+    verbose("Building ref ID map table\n")
+    startTime = time.time()
+    db.sql(dbExtractLib.BUILD_REFIDS_TABLE, 'auto')
+    endPhase("ref ID map table", startTime)
+
     verbose("Building OMIT table\n")
+    startTime = time.time()
     db.sql(BUILD_OMIT_TABLE, 'auto')
-    verbose("SQL time: %8.3f seconds\n\n" % (time.time()-startTime))
-
-    # which subset to retrieve
-    if args.option == "selected":
-        tmpTableSQL  = SELECTED_REFS_SQL
-        tmpTableName = SELECTED_TMP_TBL
-        getExtractedText = True
-    elif args.option == "rejected":
-        tmpTableSQL  = REJECTED_REFS_SQL
-        tmpTableName = REJECTED_TMP_TBL
-        getExtractedText = True
-    elif args.option == "older":
-        tmpTableSQL  = OLDREFS_SQL
-        tmpTableName = OLDREFS_TMP_TBL
-        getExtractedText = False        # older refs have extText from older
-                                        # pdftotext version in the db.
-    else:
-        sys.stderr.write("Invalid subset option '%s'\n" % args.option)
-        exit(5)
+    endPhase("OMIT table", startTime)
+#-----------------------------------
+
+def doSubset(subset,        # subset option name, key in SUBSETS
+    ):
+    '''
+    Build the tmpTable for the subset and write the subset to the outputs.
+    Assumes the ref ID map and omit tmpTables have been built.
+    '''
+    label, tmpTableSQL, tmpTableName, getExtractedText = SUBSETS[subset]
+    writeSampleFile = len([ fmt for fmt, fn in args.outputs \
+                                            if fmt in SAMPLE_OUTPUTS ]) > 0
+    if not writeSampleFile:
+        getExtractedText = False
+    if args.option == 'all': fileSubset = subset  # fill in output file names
+    else: fileSubset = None
 
     # build the tmpTable w/ the refs to retrieve
     verbose("Building %s table\n" % tmpTableName)
-    tmpTableStart = time.time()
+    startTime = time.time()
     db.sql(tmpTableSQL, 'auto')  # populate tmp tbl w/ desired references
-    verbose("SQL time: %8.3f seconds\n\n" % (time.time()-tmpTableStart))
-
-    # get the SQL result set from the tmpTable
-    refRcds = db.sql(['select * from %s' % tmpTableName], 'auto')[-1]
-    verbose("%d references retrieved\n" % (len(refRcds)))
-    verbose("Total SQL time: %8.3f seconds\n\n" % (time.time()-startTime))
-
-    if args.output == 'table':          # output table format
-        fieldNames = [  '_refs_key',
-                        'ID',
-                        'PMID',
-                        'DOID',
-                        'creationDate',
-                        'createdBy',
-                        'pubDate',
-                        'pubYear',
-                        'refType',
-                        'isReview',
-                        'relevance',
-                        'relevanceBy',
-                        'suppStatus',
-                        'apStatus',
-                        'gxdStatus', 
-                        'goStatus', 
-                        'tumorStatus', 
-                        'qtlStatus',
-                        'proStatus',
-                        'journal',
-                        #'title',
-                        #'abstract',
-                        #'extractedText',
-                    ]
-        line = '|'.join(fieldNames) + '\n'
-        sys.stdout.write(line)
+    endPhase("%s table" % tmpTableName, startTime)
+
+    # for an incremental update, get the samples we don't need to refetch.
+    #  (must read the update file before we open/truncate the output files)
+    oldSamples = {}
+    updateLazyFile = None
+    if args.updateFile and writeSampleFile:
+        startTime = time.time()
+        updateFile = args.updateFile
+        if fileSubset: updateFile = updateFile.replace('%s', fileSubset)
+        updateLazyFile, oldSamples = getUnchangedSamples(updateFile,
+                                                                tmpTableName)
+        endPhase("%s find unchanged samples" % subset, startTime)
+
+    outputs = openOutputs(fileSubset)
+    if args.checkpoint:
+        resumeAfter(outputs['samplefile'], tmpTableName)
+    startTime = time.time()
+    if args.stream:     # read the tmpTable through a server-side cursor
+        verbose("streaming references in batches of %d\n" % args.batchSize)
+        query = 'select * from %s order by _refs_key' % tmpTableName
+        refBatches = dbExtractLib.iterCursorBatches(db, query, args.batchSize)
+    else:               # get the whole SQL result set from the tmpTable
+        refRcds = db.sql(['select * from %s order by _refs_key' % \
+                                                    tmpTableName], 'auto')[-1]
+        verbose("%d references retrieved\n" % (len(refRcds)))
+        refBatches = [refRcds]
+
+    if args.workers > 1:
+        writeOutputsParallel(refRcds, outputs, getExtractedText)
+    else:
+        writeOutputs(refBatches, outputs, getExtractedText, tmpTableName,
+                                                                    oldSamples)
+    closeOutputs(outputs)
+    if updateLazyFile: updateLazyFile.close()
+    endPhase("%s retrieve and write" % subset, startTime)
+#-----------------------------------
+
+def resumeAfter(sampleWriter,   # CheckpointedSampleWriter
+    tmpTableName,               # tmp table holding the refs
+    ):
+    '''
+    If sampleWriter is resuming from a checkpoint, delete the refs it already
+        has (_refs_key <= its high-water mark) from the tmp table so we only
+        get the rest.
+    '''
+    highWater = sampleWriter.getResumeKey()
+    if highWater is None:
+        if args.resume: verbose("No checkpoint found, starting from scratch\n")
+        return
+    db.sql('delete from %s where _refs_key <= %d' % (tmpTableName, highWater),
+                                                                        'auto')
+    verbose("Resuming after _refs_key %d, %d samples already written\n" % \
+                                    (highWater, sampleWriter.getNumSamples()))
+#-----------------------------------
+
+# fields written for the 'table' output format
+TABLE_FIELDNAMES = [
+                '_refs_key',
+                'ID',
+                'PMID',
+                'DOID',
+                'creationDate',
+                'createdBy',
+                'pubDate',
+                'pubYear',
+                'refType',
+                'isReview',
+                'relevance',
+                'relevanceBy',
+                'suppStatus',
+                'apStatus',
+                'gxdStatus', 
+                'goStatus', 
+                'tumorStatus', 
+                'qtlStatus',
+                'proStatus',
+                'journal',
+                #'title',
+                #'abstract',
+                #'extractedText',
+                ]
+TEXTKEYS_TMP_TBL = 'tmp_textkeys'   # tmp tbl of _refs_keys to get text for
+
+def writeOutputs(refBatches,    # iterable of lists of ref records
+    outputs,                    # {output format: open file}
+    getExtractedText,           # T/F get extracted text for the refs
+    tmpTableName,               # tmp table holding the refs
+    oldSamples=None,            # {_refs_key: LazySample} to write as is,
+                                #   w/o getting their text from the db
+    ):
+    '''
+    Write every requested output format in one pass over the ref records.
+    The ref records must be in _refs_key order. Their extracted text is
+        fetched a page at a time and merged onto them as we go.
+    If we are streaming, refBatches yields one batch at a time, so only one
+        batch of references (and one page of text) is in memory at once.
+    W/ args.buildThreads, the refs and text are fetched in a pipelineLib
+        fetch thread and their samples are built in its build threads while
+        we write, so the db calls must all happen in the fetch thread.
+    '''
+    verbose("constructing and writing %s:\n" % ', '.join(outputs.keys()))
+    if oldSamples is None: oldSamples = {}
+
+    tableFp = outputs.get('table')
+    if tableFp:
+        tableFp.write('|'.join(TABLE_FIELDNAMES) + '\n')
+
+    sampleWriter = getSampleWriter(outputs)
+    columnarWriter = outputs.get('parquet')
+
+    refRcds = ( r for refRcds in refBatches for r in refRcds )
+    if getExtractedText:
+        refRcds = joinExtText(refRcds, tmpTableName, oldSamples)
+
+    buildSamples = sampleWriter is not None or columnarWriter is not None
+    def buildSample(r):
+        ''' Return (r, its sample or None if we are not writing samples) '''
+        sample = None
+        if buildSamples:
+            # parse an unchanged sample now, and drop it (its text) when done
+            lazySample = oldSamples.pop(str(r['_refs_key']), None)
+            if lazySample:
+                sample = lazySample.getSample()
+            else:
+                sample = sqlRecord2ClassifiedSample(r)
+        return r, sample
+
+    if args.buildThreads > 0:   # fetch, build, write concurrently
+        verbose("pipelined w/ %d build threads\n" % args.buildThreads)
+        results = iter(pipelineLib.Pipeline( \
+                        pipelineLib.iterBatches(refRcds, args.pageSize),
+                        buildSample, args.buildThreads))
+    else:
+        results = map(buildSample, refRcds)
+
+    numRefs = 0
+    lastKey = None
+    checkpointDue = False   # checkpoint once we are past lastKey's rows,
+                            #  the tmp table can have >1 row per _refs_key
+    try:
+        for r, sample in results:
+            if checkpointDue and r['_refs_key'] != lastKey:
+                sampleWriter.checkpoint(lastKey)
+                checkpointDue = False
+            if tableFp:
+                fields = [ str(r[fn]) for fn in TABLE_FIELDNAMES ]
+                tableFp.write('|'.join(fields) + '\n')
+            if sampleWriter:   sampleWriter.writeSample(sample)
+            if columnarWriter: columnarWriter.writeSample(sample)
+            lastKey = r['_refs_key']
+            numRefs += 1
+            if numRefs % args.batchSize == 0:
+                if args.checkpoint: checkpointDue = True
+                if args.stream: verbose("..%d\n" % numRefs)
+    finally:    # if we stop early: stop the pipeline's threads, then
+                #  release the streaming cursor now, not at garbage collection
+        pipelineLib.closeIterator(results)
+        pipelineLib.closeIterator(refRcds)      # and the text fetch
+        pipelineLib.closeIterator(refBatches)
+
+    if sampleWriter:
+        sampleWriter.close()
+    verbose("wrote %d references\n" % numRefs)
+#-----------------------------------
+
+PART_TMP_TBL = 'tmp_partition'  # tmp tbl of a worker's partition's _refs_keys
+# spawned workers import this module afresh (w/ our sys.argv, so the same
+#  args) and so open their own db and cache connections
+WORKER_CONTEXT = multiprocessing.get_context('spawn')
+# fields a worker needs from the ref records to build samples
+WORKER_FIELDNAMES = TABLE_FIELDNAMES + ['title', 'abstract']
+
+def writeOutputsParallel(refRcds,   # list of ref records in _refs_key order
+    outputs,                    # {output format: open file}
+    getExtractedText,           # T/F get extracted text for the refs
+    ):
+    '''
+    Write the outputs, using args.workers processes to build the samples.
+    The refs are partitioned into contiguous _refs_key ranges. Each worker
+        gets the text for its partition on its own db connection, builds
+        its samples, and writes them to a partition file.
+    The workers are new (spawned) processes, so they share no db or cache
+        connections w/ us, and they open a db connection only to get text.
+    Consistency: all the workers read the text from one snapshot, exported
+        from a transaction of our own, so every partition sees the same db
+        state for the text. That snapshot is taken after the refs were
+        selected (on the db module's connection, which holds the tmp
+        tables and cannot import a snapshot), so it is not the refs'
+        snapshot: text changed in between is read as of the snapshot, and a ref
+        whose text was deleted in between fails w/ "No extracted text".
+    The partition files are appended in key order, so the sample file is
+        the same regardless of the num of workers.
+    '''
+    verbose("constructing and writing %s w/ %d workers:\n" % \
+                                    (', '.join(outputs.keys()), args.workers))
+    tableFp = outputs.get('table')
+    if tableFp:                 # table needs no text, write it here
+        tableFp.write('|'.join(TABLE_FIELDNAMES) + '\n')
         for r in refRcds:
-            fields = [ str(r[fn]) for fn in fieldNames ]
-            line = '|'.join(fields) + '\n'
-            sys.stdout.write(line)
+            fields = [ str(r[fn]) for fn in TABLE_FIELDNAMES ]
+            tableFp.write('|'.join(fields) + '\n')
 
-    elif args.output == 'samplefile':   # output sample file format
+    if 'samplefile' in outputs or 'parquet' in outputs:
+        # workers get plain records, the db module's may not pickle
+        rcds = [ dbExtractLib.Record([ (fn, r[fn]) for fn in WORKER_FIELDNAMES ])
+                                                            for r in refRcds ]
+        parts = dbExtractLib.partitionRcds(rcds, args.workers)
 
-        # get their extracted text and join it to refRcds
+        tmpDir = tempfile.mkdtemp(prefix='sdGetMGIRefs.')
+        try:
+            snapConn = None
+            snapshotId = None
+            try:
+                if getExtractedText:
+                    snapConn = dbExtractLib.PgConnection(args.host, args.db,
+                                dbExtractLib.DB_USER, dbExtractLib.DB_PASSWORD)
+                    snapshotId = snapConn.exportSnapshot()
+                tasks = [ (i, part, snapshotId,
+                            os.path.join(tmpDir, 'part%d' % i),
+                            getExtractedText) for i, part in enumerate(parts) ]
+                # spawn, not fork: the workers must not inherit (and share)
+                #  the db module's connection or the text cache's
+                with WORKER_CONTEXT.Pool(args.workers) as pool:
+                    results = pool.starmap(writePartition, tasks)
+            finally:
+                if snapConn: snapConn.close()
+
+            sampleWriter = getSampleWriter(outputs)
+            columnarWriter = outputs.get('parquet')
+            for partFileName, numSamples in results:
+                if sampleWriter:
+                    sampleWriter.writeRecordsFile(partFileName, numSamples,
+                                                                sampleObjType)
+                if columnarWriter:
+                    with open(partFileName, 'r', newline='') as fp:
+                        for record in sampleFileLib.iterRecords(fp, RECORDEND):
+                            columnarWriter.writeFields(record.split(FIELDSEP))
+                os.remove(partFileName)
+            if sampleWriter:
+                sampleWriter.close()
+        finally:
+            shutil.rmtree(tmpDir, ignore_errors=True)   # w/ any partial files
+    verbose("wrote %d references\n" % len(refRcds))
+#-----------------------------------
+
+def writePartition(partNum,     # partition number, for messages
+    rcds,                       # ref records for the partition, in key order
+    snapshotId,                 # db snapshot to read the text from
+    partFileName,               # file to write the sample records to
+    getExtractedText,           # T/F get extracted text for the refs
+    ):
+    '''
+    Worker process: get extracted text for the partition's refs on a new
+        db connection using snapshotId, build their samples and write the
+        sample records to partFileName.
+    W/o getExtractedText, it needs no db connection.
+    Return (partFileName, num of samples written)
+    '''
+    startTime = time.time()
+    conn = None
+    partCache = None
+    try:
         if getExtractedText:
-            verbose("Getting extracted text\n")
-            startTime = time.time()
-            extTextSet = ExtractedTextSet.getExtractedTextSetForTable(db,
-                                                                tmpTableName)
-            extTextSet.joinRefs2ExtText(refRcds, allowNoText=False)
-            verbose("%8.3f seconds\n\n" % (time.time()-startTime))
+            conn = dbExtractLib.PgConnection(args.host, args.db,
+                                dbExtractLib.DB_USER, dbExtractLib.DB_PASSWORD)
+            conn.useSnapshot(snapshotId)
+            if args.cacheFile:
+                partCache = openTextCache()
+            dbExtractLib.buildKeyTable(conn, PART_TMP_TBL,
+                                            [ r['_refs_key'] for r in rcds ])
+            if args.checkCopyText:
+                dbExtractLib.checkCopyExtractedText(conn, PART_TMP_TBL,
+                                            args.pageSize, allowNoText=False)
+            if args.copyText:
+                textPairs = dbExtractLib.iterCopyExtractedText(conn,
+                            PART_TMP_TBL, args.pageSize, allowNoText=False)
+            else:
+                textPairs = dbExtractLib.iterExtractedText(conn, PART_TMP_TBL,
+                            args.pageSize, allowNoText=False, cache=partCache)
+            rcds = dbExtractLib.mergeRefs2ExtText(rcds, textPairs)
 
-        # build Sample objects and put them in SampleSet
-        outputSampleSet = MGIReference.SampleSet(sampleObjType=sampleObjType)
-        startTime = time.time()
-        verbose("constructing and writing samples:\n")
-        for r in refRcds:
-            sample = sqlRecord2ClassifiedSample(r)
-            outputSampleSet.addSample(sample)
+        numSamples = 0
+        with open(partFileName, 'w') as fp:
+            for r in rcds:
+                sample = sqlRecord2ClassifiedSample(r)
+                fp.write(sampleFileLib.sample2Text(sample) + RECORDEND)
+                numSamples += 1
+    finally:
+        if conn: conn.close()
+        if partCache:
+            verbose("partition %d: %s" % (partNum, partCache.getStats()))
+            partCache.close()
+    verbose("partition %d: %d samples, %8.3f seconds\n" % \
+                                (partNum, numSamples, time.time()-startTime))
+    return partFileName, numSamples
+#-----------------------------------
 
-        # write SampleSet
-        writeSamples(outputSampleSet)
-        verbose("wrote %d samples:\n" % outputSampleSet.getNumSamples())
-        verbose("%8.3f seconds\n\n" %  (time.time()-startTime))
+def joinExtText(refRcds,        # iterable of ref records in _refs_key order
+    tmpTableName,               # tmp table holding the refs
+    oldSamples,                 # {_refs_key: LazySample} refs that need no text
+    ):
+    '''
+    Generator: yield refRcds w/ their extracted text joined to them.
+    The text is fetched a page at a time in _refs_key order and merged onto
+        the refRcds, so the text for all the refs is never in memory at once.
+    Refs in oldSamples are passed through w/o getting their text.
+    '''
+    verbose("Getting extracted text\n")
+    textTableName = tmpTableName
+    needsText = None
+    newKeys = None
+    if oldSamples or args.copyText:
+        refKeys = db.sql('select _refs_key from %s' % tmpTableName, 'auto')
+        newKeys = [ r['_refs_key'] for r in refKeys ]
+    if oldSamples:      # just get text for refs not in oldSamples
+        newKeys = [ k for k in newKeys if str(k) not in oldSamples ]
+        dbExtractLib.buildKeyTable(db, TEXTKEYS_TMP_TBL, newKeys)
+        textTableName = TEXTKEYS_TMP_TBL
+        needsText = lambda r: str(r['_refs_key']) not in oldSamples
+
+    if args.copyText:
+        textPairs = dbExtractLib.iterCopiedText(args.host, args.db,
+                        dbExtractLib.DB_USER, dbExtractLib.DB_PASSWORD, newKeys,
+                        args.pageSize, allowNoText=False,
+                        checkText=args.checkCopyText)
     else:
-        sys.stderr.write("Invalid output option: '%s'\n" % args.output)
+        textPairs = dbExtractLib.iterExtractedText(db, textTableName,
+                            args.pageSize, allowNoText=False, cache=textCache)
+    return dbExtractLib.mergeRefs2ExtText(refRcds, textPairs, needsText)
+#-----------------------------------
+
+def getProfileMeta():
+    ''' Return dict of info about this run for the SQL profile report '''
+    return { 'script'  : os.path.basename(sys.argv[0]),
+             'argv'    : sys.argv[1:],
+             'host'    : args.host,
+             'db'      : args.db,
+             'time'    : time.strftime("%Y/%m/%d-%H:%M:%S"),
+             'phases'  : [ {'phase': p, 'seconds': round(sec, 3)} \
+                                                    for p, sec in phaseTimes ],
+           }
+#-----------------------------------
+
+textCache = None        # textCacheLib.TextCache if we are using one
+
+def openTextCache():
+    return textCacheLib.TextCache(args.cacheFile, args.cacheMBytes)
+#-----------------------------------
+
+# SQL to find refs in the tmp table that are in an existing sample file but
+#  whose db records have changed since the file was written.
+CHANGED_REFS_SQL = '''
+    select t._refs_key
+    from %(tmpTable)s t join %(oldKeysTable)s o on (t._refs_key = o._refs_key)
+    where exists (select 1 from bib_refs r
+                    where r._refs_key = t._refs_key
+                    and r.modification_date >= '%(since)s')
+    or exists (select 1 from bib_workflow_relevance wr
+                    where wr._refs_key = t._refs_key
+                    and wr.modification_date >= '%(since)s')
+    or exists (select 1 from bib_workflow_status bs
+                    where bs._refs_key = t._refs_key
+                    and bs.modification_date >= '%(since)s')
+    or exists (select 1 from bib_workflow_data bwd  -- text, supp status
+                    where bwd._refs_key = t._refs_key
+                    and bwd.modification_date >= '%(since)s')
+    or exists (select 1 from acc_accession a        -- MGI ID, PMID, DOI
+                    where a._object_key = t._refs_key
+                    and a._mgitype_key = 1
+                    and a.modification_date >= '%(since)s')
+'''
+OLDKEYS_TMP_TBL = 'tmp_oldkeys'
+META_TIME_FORMAT = "%Y/%m/%d-%H:%M:%S"  # format of the 'time' meta item
+UPDATE_SLACK = 24*60*60     # num of seconds before the update file's 'time'
+                            #  to look for changes. The 'time' is set after
+                            #  the tmp tables were built, so changes made
+                            #  while the file was being built could be missed
+
+def getUnchangedSamples(updateFile,     # existing sample file to update
+    tmpTableName,                       # tmp table holding the refs we want
+    ):
+    '''
+    For an incremental update:
+    Return (LazySampleFile, {_refs_key: LazySample}) for the samples in
+        updateFile whose db records have not changed since updateFile was
+        written (its 'time' meta item).
+    These can be written as is. The other refs in tmpTableName are new or
+        changed, so they need to be retrieved from the db.
+    Only the record offsets are kept, the samples are parsed when they are
+        written. The LazySampleFile maps a tmp copy of updateFile (so it can
+        be overwritten by the outputs), close it when done.
+    '''
+    verbose("Reading samples to update from '%s'\n" % updateFile)
+    lazyFile = sampleFileLib.LazySampleFile(updateFile, compactObjType,
+                                                                tmpCopy=True)
+
+    fileTime = lazyFile.getMetaItem('time')
+    if not fileTime:
+        sys.stderr.write("No 'time' meta item in '%s', cannot update it\n" % \
+                                                                    updateFile)
         exit(5)
-    return
+    since = time.mktime(time.strptime(fileTime, META_TIME_FORMAT)) \
+                                                                - UPDATE_SLACK
+    since = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(since))
+
+    samples = {}
+    for lazySample in lazyFile.iterSamples():
+        samples[lazySample.peekField('_refs_key')] = lazySample
+
+    dbExtractLib.buildKeyTable(db, OLDKEYS_TMP_TBL, samples.keys())
+    results = db.sql(CHANGED_REFS_SQL % {'tmpTable': tmpTableName,
+                                        'oldKeysTable': OLDKEYS_TMP_TBL,
+                                        'since': since}, 'auto')
+    changed = set([ str(r['_refs_key']) for r in results ])
+
+    unchanged = { k: s for k, s in samples.items() if k not in changed }
+    verbose("%d samples in '%s' (written %s), %d changed since %s\n" % \
+                        (len(samples), updateFile, fileTime, len(changed), since))
+    return lazyFile, unchanged
+#-----------------------------------
+
+def openOutputs(subset=None):
+    '''
+    Return dict {output format: open file} for the outputs in args.outputs
+        (a columnarLib.ColumnarWriter for parquet)
+        (a sampleFileLib.ShardedSampleWriter for samplefile if sharding)
+        (a sampleFileLib.CheckpointedSampleWriter for samplefile if
+            checkpointing)
+        plus 'index': open index file for the samplefile if args.index
+    If subset is given, it is filled into the '%s' in the file names.
+    '''
+    outputs = {}
+    for fmt, fileName in args.outputs:
+        if subset: fileName = fileName.replace('%s', subset)
+        if fmt == 'parquet':
+            outputs[fmt] = columnarLib.ColumnarWriter(fileName, sampleObjType,
+                                                                getMetaItems())
+        elif fileName == '-': outputs[fmt] = sys.stdout
+        elif fmt == 'samplefile' and isSharded():
+            sampleSet = MGIReference.SampleSet(sampleObjType=sampleObjType)
+            outputs[fmt] = sampleFileLib.ShardedSampleWriter(fileName,
+                        setMetaItems(sampleSet), args.shardSize,
+                        args.shardMBytes * 1024 * 1024, getMetaItems())
+        elif fmt == 'samplefile' and args.checkpoint:
+            sampleSet = MGIReference.SampleSet(sampleObjType=sampleObjType)
+            outputs[fmt] = sampleFileLib.CheckpointedSampleWriter(fileName,
+                        setMetaItems(sampleSet), getMetaItems(),
+                        getCheckpointJob(subset), args.resume)
+        elif fmt == 'samplefile':
+            outputs[fmt] = sampleFileLib.openSampleFile(fileName, 'w')
+            if args.index:
+                outputs['index'] = open( \
+                                sampleFileLib.getIndexFileName(fileName), 'w')
+        else:                 outputs[fmt] = open(fileName, 'w')
+    return outputs
 #-----------------------------------
 
-def writeSamples(sampleSet):
-    sampleSet.setMetaItem('host', args.host)
-    sampleSet.setMetaItem('db', args.db)
-    sampleSet.setMetaItem('time', time.strftime("%Y/%m/%d-%H:%M:%S"))
-    sampleSet.write(sys.stdout)
+def getSampleWriter(outputs):
+    '''
+    Return the writer for the samplefile output (None if there is none):
+        the ShardedSampleWriter if sharding, the CheckpointedSampleWriter if
+        checkpointing, else a SampleStreamWriter
+    '''
+    if 'samplefile' not in outputs: return None
+    if isSharded() or args.checkpoint: return outputs['samplefile']
+
+    sampleSet = MGIReference.SampleSet(sampleObjType=sampleObjType)
+    return sampleFileLib.SampleStreamWriter(outputs['samplefile'],
+                                setMetaItems(sampleSet), outputs.get('index'))
+#-----------------------------------
+
+def isSharded(): return args.shardSize > 0 or args.shardMBytes > 0
+
+def getCheckpointJob(subset=None):
+    ''' Return {name: value} of the parameters a checkpoint is resumed for
+    '''
+    return { 'option'       : subset or args.option,
+             'host'         : args.host,
+             'db'           : args.db,
+             'textLength'   : args.maxTextLength,
+           }
+#-----------------------------------
+
+def closeOutputs(outputs):
+    for fp in outputs.values():
+        if fp == sys.stdout: fp.flush()
+        else: fp.close()
+#-----------------------------------
+
+def getMetaItems():
+    """ Return {meta item: value} we put in every sample file we write"""
+    return { 'host': args.host,
+             'db'  : args.db,
+             'time': time.strftime("%Y/%m/%d-%H:%M:%S"),
+            }
+#-----------------------------------
+
+def setMetaItems(sampleSet):
+    """ Set the meta items we put in every sample file we write"""
+    for key, value in getMetaItems().items():
+        sampleSet.setMetaItem(key, value)
+    return sampleSet
 #-----------------------------------
 
 def sqlRecord2ClassifiedSample(r,		# sql Result record
     ):
     """
     Encapsulates knowledge of Sample.setFields() field names
+    Return a compactObjType record
     """
     newR = {}
-    newSample = sampleObjType()
+    newSample = compactObjType()
 
     newR['_refs_key']    = str(r['_refs_key'])
     newR['ID']           = str(r['ID'])
@@ -580,35 +1380,32 @@ def sqlRecord2ClassifiedSample(r,		# sql Result record
     newR['qtlStatus']    = str(r['qtlStatus'])
     newR['proStatus']    = str(r['proStatus'])
     newR['journal']      = str(r['journal'])
-    newR['title']        = cleanUpTextField(r, 'title')
-    newR['abstract']     = cleanUpTextField(r, 'abstract')
-    newR['extractedText'] = cleanUpTextField(r, 'ext_text')
+    newR['title'], newR['abstract'], newR['extractedText'] = \
+                cleanUpTextFields(r, ['title', 'abstract', 'ext_text'])
     if args.maxTextLength: newR['extractedText'] += '\n'
 
     return newSample.setFields(newR)
 #-----------------------------------
 
-def cleanUpTextField(rcd,
-                    textFieldName,
+def cleanUpTextFields(rcd,
+                    textFieldNames,     # list of text field names in rcd
     ):
-    # in case we omit this text field during debugging, check if defined
-    if rcd.has_key(textFieldName):      # 2to3 note: rcd is not a python dict,
+    """ Return list of the cleaned up text of the fields, cleaned as a batch
+    """
+    texts = []
+    for textFieldName in textFieldNames:
+        # in case we omit this text field during debugging, check if defined
+        if rcd.has_key(textFieldName):  # 2to3 note: rcd is not a python dict,
                                         #  it has a has_key() method
-        text = str(rcd[textFieldName])
-    else: text = ''
+            text = str(rcd[textFieldName])
+        else: text = ''
 
-    if args.maxTextLength:	# handy for debugging
-        text = text[:args.maxTextLength]
-        text = text.replace('\n', ' ')
+        if args.maxTextLength:	# handy for debugging
+            text = text[:args.maxTextLength]
+            text = text.replace('\n', ' ')
+        texts.append(text)
 
-    text = removeNonAscii(cleanDelimiters(text))
-    return text
-#-----------------------------------
-
-def cleanDelimiters(text):
-    """ remove RECORDEND and FIELDSEPs from text (replace w/ ' ')
-    """
-    return text.replace(RECORDEND,' ').replace(FIELDSEP,' ')
+    return textCleaner.cleanTexts(texts)
 #-----------------------------------
 
 def verbose(text):
@@ -6,7 +6,8 @@
             replacing non-ascii chars with ' '
             replacing FIELDSEP and RECORDSEP chars in the doc text w/ ' '
 
-  Outputs:      Delimited file to stdout
+  Outputs:      Delimited file to stdout (or to files given via
+                --shardfile or --checkpoint)
                 See sampleDataLib.ClassifiedSample for output format
 '''
 #-----------------------------------
@@ -18,8 +19,12 @@ import time
 import argparse
 import db
 import sampleDataLib
-from utilsLib import removeNonAscii
-import ExtractedTextSet
+import MGIReference
+import textCleanLib
+import dbExtractLib
+import textCacheLib
+import sampleFileLib
+import pipelineLib
 #-----------------------------------
 
 sampleObjType = sampleDataLib.PrimTriageClassifiedSample
@@ -28,6 +33,27 @@ sampleObjType = sampleDataLib.PrimTriageClassifiedSample
 outputSampleSet = sampleDataLib.ClassifiedSampleSet(sampleObjType=sampleObjType)
 RECORDEND    = sampleObjType.getRecordEnd()
 FIELDSEP     = sampleObjType.getFieldSep()
+
+class CompactPrimTriageSample (MGIReference.CompactSample):
+    """
+    IS:     a CompactSample of a PrimTriageClassifiedSample,
+            the samples we build and write
+    """
+    sampleObjType   = sampleObjType
+    fieldNames      = sampleObjType.fieldNames
+    textFieldNames  = ['title', 'abstract', 'extractedText']
+    vocabFieldNames = [ fn for fn in fieldNames if fn in \
+                        MGIReference.MGIReference.vocabFieldNames + \
+                        ['knownClassName', 'year'] ]
+    vocabFields     = frozenset(vocabFieldNames)
+    fieldSep        = FIELDSEP
+    recordEnd       = RECORDEND
+
+    __slots__ = fieldNames
+# end class CompactPrimTriageSample ------------------------
+
+# to remove delimiters and non-ascii chars from text fields
+textCleaner  = textCleanLib.TextCleaner([RECORDEND, FIELDSEP])
 #-----------------------------------
 
 def getArgs():
@@ -56,6 +82,82 @@ def getArgs():
         action='store_false', required=False,
         help="include all articles, default: skip review and non-peer reviewed")
 
+    parser.add_argument('--shardfile', dest='shardFile', action='store',
+        required=False, default=None, metavar='FILE',
+        help="write samples to shard files named from FILE (e.g., " +
+            "keep.txt -> keep.0000.txt, keep.0001.txt, ...) plus a manifest " +
+            "(keep.manifest.json) of their counts, ID ranges and " +
+            "checksums, instead of to stdout")
+
+    parser.add_argument('--shardsize', dest='shardSize',
+        type=int, required=False, default=0,
+        help="w/ --shardfile, max num of samples per shard. Default no max")
+
+    parser.add_argument('--shardmbytes', dest='shardMBytes',
+        type=int, required=False, default=0,
+        help="w/ --shardfile, max MB per shard (uncompressed). " +
+            "Default no max")
+
+    parser.add_argument('--checkpoint', dest='checkpointFile', action='store',
+        required=False, default=None, metavar='FILE',
+        help="write samples to FILE instead of to stdout. It is written as " +
+            "FILE.partial, committed (FILE.ckpt) every --batchsize " +
+            "references so a run that dies can be continued w/ --resume, " +
+            "and renamed to FILE when done. FILE cannot be compressed")
+
+    parser.add_argument('--resume', dest='resume', action='store_true',
+        required=False,
+        help="w/ --checkpoint, continue from FILE's last checkpoint: only " +
+            "get refs w/ _refs_key above its high-water mark and append " +
+            "them to FILE.partial. (refs added to the db w/ lower keys " +
+            "since the checkpoint are not picked up)")
+
+    parser.add_argument('--batchsize', dest='batchSize',
+        type=int, required=False, default=dbExtractLib.BATCH_SIZE,
+        help="w/ --checkpoint, num of references between checkpoints. " +
+            "Default %d" % dbExtractLib.BATCH_SIZE)
+
+    parser.add_argument('--buildthreads', dest='buildThreads',
+        type=int, required=False, default=0,
+        help="pipeline the run: num of threads building samples while " +
+            "another thread fetches extracted text from the db and the " +
+            "main thread writes them. Default 0: fetch, build and write " +
+            "one after another. The threads share one CPU (the GIL): " +
+            "this overlaps db waits and writing w/ building, more build " +
+            "threads do not build faster")
+
+    parser.add_argument('--copytext', dest='copyText', action='store_true',
+        required=False,
+        help="get extracted text in one binary COPY ... TO STDOUT stream " +
+            "on a separate db connection instead of a query per page. " +
+            "Needs psycopg2. Cannot be used w/ --cache")
+
+    parser.add_argument('--checkcopytext', dest='checkCopyText',
+        action='store_true', required=False,
+        help="--copytext, but first check the COPY gets the same text as " +
+            "the queries for the refs, stop w/ an error if it does not. " +
+            "Run this against a new db/schema before relying on --copytext")
+
+    parser.add_argument('--cache', dest='cacheFile', action='store',
+        required=False, default=None, metavar='CACHEFILE',
+        help="local cache of extracted text. Only get text from the db " +
+            "for refs not in the cache or whose text has changed")
+
+    parser.add_argument('--cachesize', dest='cacheMBytes',
+        type=int, required=False, default=textCacheLib.DEFAULT_MAX_MBYTES,
+        help="max size of the text cache in MB, least recently used " +
+            "text is evicted. Default %d" % textCacheLib.DEFAULT_MAX_MBYTES)
+
+    parser.add_argument('--profile', dest='profileFile', action='store',
+        required=False, default=None, metavar='REPORTFILE',
+        help="profile every db.sql() stmt (time, rows, bytes) and write " +
+            "a JSON report to REPORTFILE")
+
+    parser.add_argument('--explain', dest='explain', action='store_true',
+        required=False,
+        help="w/ --profile, also capture explain (analyze, buffers) " +
+            "plans for each tmp table build")
+
     parser.add_argument('-q', '--quiet', dest='verbose', action='store_false',
         required=False, help="skip helpful messages to stderr")
 
@@ -73,6 +175,18 @@ def getArgs():
 
     args =  parser.parse_args()
 
+    if args.checkCopyText:
+        args.copyText = True
+    if args.copyText and args.cacheFile:
+        parser.error("--copytext cannot be used w/ --cache")
+    if args.resume and not args.checkpointFile:
+        parser.error("--resume needs --checkpoint FILE")
+    if args.checkpointFile:
+        if args.shardFile:
+            parser.error("--checkpoint cannot be used w/ --shardfile")
+        if args.checkpointFile.endswith(('.gz', '.zst')):
+            parser.error("--checkpoint FILE cannot be compressed")
+
     if args.server == 'adhoc':
         args.host = 'mgi-adhoc.jax.org'
         args.db = 'mgd'
@@ -97,6 +211,9 @@ args = getArgs()
 ####################
 # SQL fragments used to build up queries
 #    We build the queries in the following steps:
+#    0) A tmp table mapping each _refs_key to its MGI ID, PMID, and DOID
+#        (dbExtractLib.BUILD_REFIDS_TABLE) that the omit and final tmp
+#        tables join to instead of joining acc_accession
 #    1) A tmp OMIT_TABLE of references to omit from the training set because
 #        their ground truth may be questionable
 #    2) a tmp BASE_TABLE of all refs NOT in the OMIT_TABLE and build an
@@ -105,8 +222,8 @@ args = getArgs()
 #        criteria for the specific training sample option
 #    4) using the final tmp table,
 #        do a "select *" to get the basic reference data
-#        use ExtractedTextSet.getExtractedTextSetForTable() to get their
-#            extracted text
+#        use dbExtractLib.iterExtractedText() to get their
+#            extracted text (via ExtractedTextSet), a page at a time
 #        do select count(*) to get data set counts.
 ####################
 LIT_TRIAGE_DATE = "10/31/2017"		# when we switched to new lit triage
@@ -134,16 +251,15 @@ BUILD_OMIT_TABLE = [ \
 '''
     create temporary table tmp_omit
     as
-    select r._refs_key, a.accid pubmed
+    select r._refs_key, ids.pmid pubmed
     from bib_refs r join bib_workflow_status bs
         on (r._refs_key = bs._refs_key and bs.iscurrent=1 )
         join bib_status_view bsv on (r._refs_key = bsv._refs_key)
         left join bib_workflow_tag bt on (r._refs_key = bt._refs_key)
         join bib_workflow_relevance wr on (r._refs_key = wr._refs_key
                                                 and wr.iscurrent=1)
-        join acc_accession a
-        on (a._object_key = r._refs_key and a._logicaldb_key=29 -- pubmed
-            and a._mgitype_key=1 )
+        join %s ids on (r._refs_key = ids._refs_key
+                                            and ids.pmid is not null)
     where 
         (   (   (bs._status_key = 31576673 and bs._group_key = 31576666 and 
                     bs._createdby_key = 1571 -- index for GO by pm2geneload
@@ -164,7 +280,7 @@ BUILD_OMIT_TABLE = [ \
             wr._relevance_key = 70594666        -- discard
             and bt._tag_key = 49170000          -- MGI:Mice_in_references_only
         )
-''' % (START_DATE),
+''' % (dbExtractLib.REFIDS_TMP_TBL, START_DATE),
 '''
     create index tmp_idx1 on tmp_omit(_refs_key)
 ''',
@@ -203,7 +319,7 @@ FINAL_TMP_TABLE_SQL =  \
         'ignore supp term' as supp_status,
         -- suppTerm.term as supp_status,
         r.journal, r.title, r.abstract,
-        a.accid pubmed,
+        ids.pmid pubmed,
         bsv.ap_status,
         bsv.gxd_status, 
         bsv.go_status, 
@@ -220,9 +336,8 @@ FINAL_TMP_TABLE_SQL =  \
                                                 and wr.iscurrent=1)
         join voc_term rt on (wr._relevance_key = rt._term_key)
         join voc_term typeTerm on (r._referencetype_key = typeTerm._term_key)
-        join acc_accession a on
-             (a._object_key = r._refs_key and a._logicaldb_key=29 -- pubmed
-              and a._mgitype_key=1 and a.preferred=1 )
+        join %s ids on (r._refs_key = ids._refs_key
+                                            and ids.pmid is not null)
 '''
 RESTRICT_REF_TYPE = \
 '''
@@ -303,6 +418,7 @@ def doCounts():
 
     selectCountSQL = 'select count(distinct _refs_key) as num from %s\n'
 
+    db.sql(dbExtractLib.BUILD_REFIDS_TABLE, 'auto')
     db.sql(BUILD_OMIT_TABLE, 'auto')
     db.sql(BUILD_BASE_TABLE, 'auto')
 
@@ -353,12 +469,14 @@ def buildFinalTmpTableSQL(queryKey):
     if args.restrictArticles: restrict = RESTRICT_REF_TYPE
     else: restrict = ''
 
-    if args.nResults > 0: limitSQL = "\nlimit %d\n" % args.nResults
+    if args.nResults > 0:       # same n refs each run (e.g., --resume)
+        limitSQL = "\norder by _refs_key\nlimit %d\n" % args.nResults
     else: limitSQL = ''
 
     finalTmpTableName = 'tmp_' + queryKey
 
-    finalTmpTableSQL = (FINAL_TMP_TABLE_SQL % finalTmpTableName) + \
+    finalTmpTableSQL = (FINAL_TMP_TABLE_SQL % \
+                        (finalTmpTableName, dbExtractLib.REFIDS_TMP_TBL)) + \
                         WHERE_CLAUSES[queryKey] + restrict + limitSQL
 
     buildIndexSQL = 'create index tmp_idx_%s on %s(_refs_key)' % \
@@ -372,13 +490,25 @@ def main():
 ####################
     db.set_sqlServer  (args.host)
     db.set_sqlDatabase(args.db)
-    db.set_sqlUser    ("mgd_public")
-    db.set_sqlPassword("mgdpub")
+    db.set_sqlUser    (dbExtractLib.DB_USER)
+    db.set_sqlPassword(dbExtractLib.DB_PASSWORD)
     startTime = time.time()
+    if args.profileFile:
+        profiler = dbExtractLib.SqlProfiler(db, explain=args.explain).install()
 
     if args.option == 'counts': doCounts()
     else: doSamples()
 
+    if args.profileFile:
+        profiler.writeReport(args.profileFile,
+                        { 'script'  : os.path.basename(sys.argv[0]),
+                          'argv'    : sys.argv[1:],
+                          'host'    : args.host,
+                          'db'      : args.db,
+                          'time'    : time.strftime("%Y/%m/%d-%H:%M:%S"),
+                        })
+        verbose("wrote SQL profile to '%s'\n" % args.profileFile)
+
     verbose("Total time: %8.3f seconds\n\n" % (time.time()-startTime))
 #-----------------------------------
 
@@ -392,6 +522,7 @@ def doSamples():
     startTime = time.time()
 
     # build initial tmp tables
+    db.sql(dbExtractLib.BUILD_REFIDS_TABLE, 'auto')
     db.sql(BUILD_OMIT_TABLE, 'auto')
     db.sql(BUILD_BASE_TABLE, 'auto')
 
@@ -399,55 +530,154 @@ def doSamples():
     tmpTableName, finalTmpTableSQL = buildFinalTmpTableSQL(args.option)
     db.sql(finalTmpTableSQL, 'auto')
 
-    # get the result set
-    refRcds = db.sql(['select * from %s' % tmpTableName], 'auto')[-1]
+    # open the checkpointed output file. If resuming, skip the refs it has
+    checkpointWriter = None
+    if args.checkpointFile:
+        checkpointWriter = openCheckpointWriter(tmpTableName)
+
+    # get the result set, in _refs_key order to merge the text onto
+    refRcds = db.sql(['select * from %s order by _refs_key' % tmpTableName],
+                                                                    'auto')[-1]
     verbose("%d references retrieved\n" % (len(refRcds)))
     verbose("SQL time: %8.3f seconds\n\n" % (time.time()-startTime))
 
-    # get their extracted text and join it to refRcds
-    verbose("Getting extracted text\n")
-    startTime = time.time()
-    extTextSet = ExtractedTextSet.getExtractedTextSetForTable(db, tmpTableName)
-    extTextSet.joinRefs2ExtText(refRcds, allowNoText=True)
-    verbose("%8.3f seconds\n\n" % (time.time()-startTime))
+    # get their extracted text a page at a time and merge it onto refRcds
+    textCache = None
+    if args.cacheFile:
+        textCache = textCacheLib.TextCache(args.cacheFile, args.cacheMBytes)
+    if args.copyText:
+        textPairs = dbExtractLib.iterCopiedText(args.host, args.db,
+                        dbExtractLib.DB_USER, dbExtractLib.DB_PASSWORD,
+                        [ r['_refs_key'] for r in refRcds ],
+                        allowNoText=True, checkText=args.checkCopyText)
+    else:
+        textPairs = dbExtractLib.iterExtractedText(db, tmpTableName,
+                                        allowNoText=True, cache=textCache)
 
-    # build Sample objects and write SampleSet
+    # build Sample objects and write SampleSet (or shards)
     global outputSampleSet
     startTime = time.time()
-    verbose("constructing and writing samples:\n")
-    for r in refRcds:
-        sample = sqlRecord2ClassifiedSample(r)
-        outputSampleSet.addSample(sample)
-
-    writeSamples(outputSampleSet)
-    verbose("wrote %d samples:\n" % outputSampleSet.getNumSamples())
+    verbose("getting extracted text, constructing and writing samples:\n")
+    shardWriter = None
+    stdoutWriter = None
+    if args.shardFile:
+        shardWriter = sampleFileLib.ShardedSampleWriter(args.shardFile,
+                        setMetaItems(outputSampleSet), args.shardSize,
+                        args.shardMBytes * 1024 * 1024, getMetaItems())
+    elif not checkpointWriter:      # write samples as they are built
+        stdoutWriter = sampleFileLib.SampleStreamWriter(sys.stdout,
+                                                setMetaItems(outputSampleSet))
+
+    # fetch text, build samples and write them concurrently (pipelined),
+    #  all db calls happen in the pipeline's fetch thread
+    refRcds = dbExtractLib.mergeRefs2ExtText(refRcds, textPairs)
+    buildSample = lambda r: (r['_refs_key'], sqlRecord2ClassifiedSample(r))
+    if args.buildThreads > 0:
+        results = iter(pipelineLib.Pipeline( \
+                    pipelineLib.iterBatches(refRcds, dbExtractLib.PAGE_SIZE),
+                    buildSample, args.buildThreads))
+    else:
+        results = map(buildSample, refRcds)
+
+    numRefs = 0
+    lastKey = None
+    checkpointDue = False   # checkpoint once we are past lastKey's rows,
+                            #  the tmp table can have >1 row per _refs_key
+    try:
+        for refKey, sample in results:
+            if checkpointDue and refKey != lastKey:
+                checkpointWriter.checkpoint(lastKey)
+                verbose("..%d\n" % numRefs)
+                checkpointDue = False
+            if shardWriter: shardWriter.writeSample(sample)
+            elif checkpointWriter: checkpointWriter.writeSample(sample)
+            else: stdoutWriter.writeSample(sample)
+            lastKey = refKey
+            numRefs += 1
+            if checkpointWriter and numRefs % args.batchSize == 0:
+                checkpointDue = True
+    finally:    # if we stop early: stop the pipeline's threads, then
+                #  release the text fetch (its COPY connection, ...) now
+        pipelineLib.closeIterator(results)
+        pipelineLib.closeIterator(refRcds)
+
+    if checkpointWriter:
+        checkpointWriter.close()
+        verbose("wrote %d samples to '%s'\n" % \
+                    (checkpointWriter.getNumSamples(), args.checkpointFile))
+    elif shardWriter:
+        shardWriter.close()
+        verbose("wrote %d samples to %d shards:\n" % \
+                (shardWriter.getNumSamples(), len(shardWriter.getShards())))
+    else:
+        stdoutWriter.close()
+        verbose("wrote %d samples:\n" % stdoutWriter.getNumSamples())
     verbose("%8.3f seconds\n\n" %  (time.time()-startTime))
+    if textCache:
+        verbose(textCache.getStats())
+        textCache.close()
     return
 #-----------------------------------
 
-def writeSamples(sampleSet):
-    sampleSet.setMetaItem('host', args.host)
-    sampleSet.setMetaItem('db', args.db)
-    sampleSet.setMetaItem('time', time.strftime("%Y/%m/%d-%H:%M:%S"))
-    sampleSet.write(sys.stdout)
+def openCheckpointWriter(tmpTableName,  # tmp table holding the refs
+    ):
+    '''
+    Return a CheckpointedSampleWriter for args.checkpointFile.
+    If it is resuming from a checkpoint, delete the refs it already has
+        (_refs_key <= its high-water mark) from the tmp table so we only
+        get the rest.
+    '''
+    job = { 'option'     : args.option,
+            'host'       : args.host,
+            'db'         : args.db,
+            'limit'      : args.nResults,
+            'restrict'   : args.restrictArticles,
+            'textLength' : args.maxTextLength,
+          }
+    writer = sampleFileLib.CheckpointedSampleWriter(args.checkpointFile,
+                                setMetaItems(outputSampleSet), getMetaItems(),
+                                job, args.resume)
+    highWater = writer.getResumeKey()
+    if highWater is None:
+        if args.resume: verbose("No checkpoint found, starting from scratch\n")
+    else:
+        db.sql('delete from %s where _refs_key <= %d' % \
+                                            (tmpTableName, highWater), 'auto')
+        verbose("Resuming after _refs_key %d, %d samples already written\n" \
+                                        % (highWater, writer.getNumSamples()))
+    return writer
+#-----------------------------------
+
+def getMetaItems():
+    """ Return {meta item: value} we put in every sample file we write"""
+    return { 'host': args.host,
+             'db'  : args.db,
+             'time': time.strftime("%Y/%m/%d-%H:%M:%S"),
+            }
+#-----------------------------------
+
+def setMetaItems(sampleSet):
+    for key, value in getMetaItems().items():
+        sampleSet.setMetaItem(key, value)
+    return sampleSet
 #-----------------------------------
 
 def sqlRecord2ClassifiedSample(r,		# sql Result record
     ):
     """
     Encapsulates knowledge of ClassifiedSample.setFields() field names
+    Return a CompactPrimTriageSample
     """
     newR = {}
-    newSample = sampleObjType()
+    newSample = CompactPrimTriageSample()
 
     newR['knownClassName']= str(r['knownClassName'])
     newR['ID']            = str(r['pubmed'])
     newR['creationDate']  = str(r['creation_date'])
     newR['year']          = str(r['year'])
     newR['journal']       = '_'.join(str(r['journal']).split(' '))
-    newR['title']         = cleanUpTextField(r, 'title')
-    newR['abstract']      = cleanUpTextField(r, 'abstract')
-    newR['extractedText'] = cleanUpTextField(r, 'ext_text')
+    newR['title'], newR['abstract'], newR['extractedText'] = \
+                cleanUpTextFields(r, ['title', 'abstract', 'ext_text'])
     if args.maxTextLength: newR['extractedText'] += '\n'
     newR['isReview']      = str(r['isreviewarticle'])
     newR['refType']       = str(r['ref_type'])
@@ -461,27 +691,25 @@ def sqlRecord2ClassifiedSample(r,		# sql Result record
     return newSample.setFields(newR)
 #-----------------------------------
 
-def cleanUpTextField(rcd,
-                    textFieldName,
+def cleanUpTextFields(rcd,
+                    textFieldNames,     # list of text field names in rcd
     ):
-    # in case we omit this text field during debugging, check if defined
-    if rcd.has_key(textFieldName):      # 2to3 note: rcd is not a python dict,
+    """ Return list of the cleaned up text of the fields, cleaned as a batch
+    """
+    texts = []
+    for textFieldName in textFieldNames:
+        # in case we omit this text field during debugging, check if defined
+        if rcd.has_key(textFieldName):  # 2to3 note: rcd is not a python dict,
                                         #  it has a has_key() method
-        text = str(rcd[textFieldName])
-    else: text = ''
+            text = str(rcd[textFieldName])
+        else: text = ''
 
-    if args.maxTextLength:	# handy for debugging
-        text = text[:args.maxTextLength]
-        text = text.replace('\n', ' ')
+        if args.maxTextLength:	# handy for debugging
+            text = text[:args.maxTextLength]
+            text = text.replace('\n', ' ')
+        texts.append(text)
 
-    text = removeNonAscii(cleanDelimiters(text))
-    return text
-#-----------------------------------
-
-def cleanDelimiters(text):
-    """ remove RECORDEND and FIELDSEPs from text (replace w/ ' ')
-    """
-    return text.replace(RECORDEND,' ').replace(FIELDSEP,' ')
+    return textCleaner.cleanTexts(texts)
 #-----------------------------------
 
 def verbose(text):
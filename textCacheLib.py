@@ -0,0 +1,284 @@
+#!/usr/bin/env python3
+#
+# Local on-disk cache of reference text, so reruns of the extraction scripts
+#  only pull text from the db for references whose text has changed.
+#
+# Entries are keyed by (_refs_key, section key). The section key names which
+#  text for the reference is cached (e.g., all extracted text sections as
+#  assembled by ExtractedTextSet, or just some sections).
+# Each entry also holds a change token: a string that is cheap to get from
+#  the db w/o reading the text itself (e.g., the sections' lengths and
+#  modification dates). An entry is only used if its token matches the
+#  token the db has now, otherwise it is stale and the text is refetched.
+#
+# The cache is a sqlite3 db file, text is stored zlib compressed.
+# When the cache grows past its max size (checked as entries are put), the
+#  least recently used entries are evicted. The db file uses incremental
+#  auto vacuum, so the pages they free are given back and the file shrinks.
+#
+# To run the automated unit tests:
+#   python textCacheLib.py
+#
+import sys
+import os
+import sqlite3
+import zlib
+import time
+import random
+import string
+import shutil
+import tempfile
+import unittest
+#-----------------------------------
+
+DEFAULT_MAX_MBYTES = 4000   # default max cache size
+EVICT_TO           = 0.9    # when evicting, shrink to this fraction of max
+
+CREATE_SQL = '''
+    create table if not exists textcache (
+        refs_key  integer not null,
+        section   text    not null,
+        token     text    not null,
+        text      blob    not null,
+        size      integer not null,     -- num of bytes in text blob
+        last_used real    not null,     -- time.time() of last get/put
+        primary key (refs_key, section)
+    )
+'''
+#-----------------------------------
+
+class TextCache (object):
+    """
+    IS:     an on-disk cache of text for references
+    HAS:    sqlite3 db file, max size, hit/miss counts
+    DOES:   get()/put() text by (_refs_key, section key, change token).
+            Keeps a running total of the text size as it puts, and evicts
+            least recently used entries when it is over max size.
+            Several processes can share one cache file (sqlite locking).
+    """
+    def __init__(self, fileName,        # sqlite db file (created if needed)
+                maxMBytes=DEFAULT_MAX_MBYTES,
+                ):
+        self.fileName = fileName
+        self.maxBytes = int(maxMBytes * 1024 * 1024)
+        # may be used from a pipeline's fetch thread (one thread at a time)
+        self.conn = sqlite3.connect(fileName, timeout=300,
+                                                    check_same_thread=False)
+        self.setAutoVacuum()
+        self.conn.execute(CREATE_SQL)
+        self.conn.commit()
+        self.totalBytes = self.getTotalBytes()  # running total of text sizes
+
+        self.numHits   = 0      # found w/ matching token
+        self.numMisses = 0      # not in the cache
+        self.numStale  = 0      # in the cache, but token did not match
+    #----------------------
+
+    def setAutoVacuum(self):
+        """ Set incremental auto vacuum. A new db just needs the pragma,
+            an existing db is only switched to it by a VACUUM (once).
+        """
+        if self.conn.execute('pragma auto_vacuum').fetchone()[0] == 2:
+            return                              # already incremental
+        self.conn.execute('pragma auto_vacuum = incremental')
+        numTables = self.conn.execute( \
+                    'select count(*) from sqlite_master').fetchone()[0]
+        if numTables:
+            self.conn.commit()
+            self.conn.execute('vacuum')
+    #----------------------
+
+    def getTotalBytes(self):
+        return self.conn.execute( \
+                    'select coalesce(sum(size), 0) from textcache').fetchone()[0]
+    #----------------------
+
+    def get(self, refKey, section, token):
+        """ Return the cached text or None if it is not cached or is stale
+        """
+        row = self.conn.execute( \
+                'select token, text from textcache ' + \
+                'where refs_key = ? and section = ?',
+                (int(refKey), section)).fetchone()
+        if row is None:
+            self.numMisses += 1
+            return None
+        if row[0] != token:
+            self.numStale += 1
+            return None
+
+        self.conn.execute( \
+                'update textcache set last_used = ? ' + \
+                'where refs_key = ? and section = ?',
+                (time.time(), int(refKey), section))
+        self.numHits += 1
+        return zlib.decompress(row[1]).decode('utf-8')
+    #----------------------
+
+    def put(self, refKey, section, token, text):
+        data = zlib.compress(text.encode('utf-8'), 1)
+        row = self.conn.execute( \
+                'select size from textcache where refs_key = ? and section = ?',
+                (int(refKey), section)).fetchone()
+        self.conn.execute( \
+                'insert or replace into textcache ' + \
+                '(refs_key, section, token, text, size, last_used) ' + \
+                'values (?, ?, ?, ?, ?, ?)',
+                (int(refKey), section, token, data, len(data), time.time()))
+        self.totalBytes += len(data) - (row[0] if row else 0)
+        if self.totalBytes > self.maxBytes:
+            self.evict()
+    #----------------------
+
+    def commit(self):
+        self.conn.commit()
+    #----------------------
+
+    def evict(self):
+        """ If the cache is bigger than maxBytes, delete least recently used
+            entries until it is down to EVICT_TO * maxBytes, and give their
+            pages back to the file system.
+            Return the num of entries deleted.
+        """
+        total = self.getTotalBytes()    # other processes may share the cache
+        self.totalBytes = total
+        if total <= self.maxBytes: return 0
+
+        toFree = total - int(self.maxBytes * EVICT_TO)
+        freed = 0
+        keys = []
+        for refKey, section, size in self.conn.execute( \
+                    'select refs_key, section, size from textcache ' + \
+                    'order by last_used'):
+            if freed >= toFree: break
+            keys.append( (refKey, section) )
+            freed += size
+        self.conn.executemany( \
+                    'delete from textcache where refs_key = ? and section = ?',
+                    keys)
+        self.conn.commit()
+        # the pragma frees a page per step, execute() only steps it once
+        self.conn.executescript('pragma incremental_vacuum;')
+        self.conn.commit()
+        self.totalBytes = total - freed
+        return len(keys)
+    #----------------------
+
+    def getStats(self):
+        return "text cache '%s': %d hits, %d misses, %d stale\n" % \
+                (self.fileName, self.numHits, self.numMisses, self.numStale)
+    #----------------------
+
+    def close(self):
+        self.conn.commit()
+        self.evict()
+        self.conn.close()
+    #----------------------
+# end class TextCache ------------------------
+
+def doAutomatedTests():
+
+    sys.stdout.write("Running automated unit tests...\n")
+    unittest.main(argv=[sys.argv[0], '-v'],)
+
+class MyTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpDir = tempfile.mkdtemp()
+        self.fileName = os.path.join(self.tmpDir, 'cache.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpDir)
+
+    def getText(self, seed, length):
+        """ Return random (so barely compressible) text """
+        rng = random.Random(seed)
+        return ''.join(rng.choice(string.ascii_letters) for i in range(length))
+
+    def getSize(self, text):
+        """ Return the num of bytes the cache stores for text """
+        return len(zlib.compress(text.encode('utf-8'), 1))
+
+    def test_getPut(self):
+        cache = TextCache(self.fileName)
+        self.assertIsNone(cache.get(1, 'all', 't1'))            # miss
+        cache.put(1, 'all', 't1', 'caf\u00e9 text')
+        cache.put('2', 'all', 't2', '')                 # str key, empty text
+        self.assertEqual(cache.get('1', 'all', 't1'), 'caf\u00e9 text')
+        self.assertEqual(cache.get(2, 'all', 't2'), '')
+        self.assertIsNone(cache.get(1, 'body', 't1'))   # other section
+        self.assertEqual((cache.numHits, cache.numMisses, cache.numStale),
+                                                                    (2, 2, 0))
+        cache.close()
+
+        cache = TextCache(self.fileName)                # persists
+        self.assertEqual(cache.get(1, 'all', 't1'), 'caf\u00e9 text')
+        cache.close()
+
+    def test_token(self):
+        cache = TextCache(self.fileName)
+        cache.put(1, 'all', 't1', 'old text')
+        self.assertIsNone(cache.get(1, 'all', 't2'))    # text has changed
+        self.assertEqual(cache.numStale, 1)
+
+        cache.put(1, 'all', 't2', 'new text')           # replaces the entry
+        self.assertEqual(cache.get(1, 'all', 't2'), 'new text')
+        self.assertIsNone(cache.get(1, 'all', 't1'))
+        self.assertEqual(cache.numStale, 2)
+        self.assertEqual(cache.totalBytes, cache.getTotalBytes())
+        self.assertEqual(cache.totalBytes, self.getSize('new text'))
+        cache.close()
+
+    def test_evict(self):
+        texts = [ self.getText(i, 20000) for i in range(4) ]
+        sizes = [ self.getSize(t) for t in texts ]
+        # room for 3 entries, evicting to 90% leaves room for 2
+        maxBytes = sum(sizes[:3]) + 100
+        cache = TextCache(self.fileName, maxMBytes=maxBytes/(1024*1024))
+
+        for i in range(3):
+            cache.put(i, 'all', 't', texts[i])
+            time.sleep(0.01)
+        self.assertEqual(cache.totalBytes, sum(sizes[:3]))
+        cache.get(0, 'all', 't')                        # now 1 is the LRU
+        time.sleep(0.01)
+
+        cache.put(3, 'all', 't', texts[3])              # over max, evicts
+        self.assertLessEqual(cache.totalBytes, maxBytes * EVICT_TO)
+        self.assertEqual(cache.totalBytes, cache.getTotalBytes())
+        self.assertEqual(cache.get(0, 'all', 't'), texts[0])
+        self.assertEqual(cache.get(3, 'all', 't'), texts[3])
+        self.assertIsNone(cache.get(1, 'all', 't'))
+        self.assertIsNone(cache.get(2, 'all', 't'))
+        self.assertEqual(cache.evict(), 0)              # under max
+        cache.close()
+
+    def test_incrementalVacuum(self):
+        texts = [ self.getText(i, 100000) for i in range(10) ]
+        cache = TextCache(self.fileName)
+        self.assertEqual( \
+                cache.conn.execute('pragma auto_vacuum').fetchone()[0], 2)
+        for i, text in enumerate(texts):
+            cache.put(i, 'all', 't', text)
+        cache.commit()
+        fullSize = os.path.getsize(self.fileName)
+
+        cache.maxBytes = sum([ self.getSize(t) for t in texts[:5] ])
+        self.assertGreater(cache.evict(), 0)
+        self.assertEqual( \
+                cache.conn.execute('pragma freelist_count').fetchone()[0], 0)
+        self.assertLess(os.path.getsize(self.fileName), fullSize * 0.6)
+        cache.close()
+
+    def test_autoVacuumExisting(self):
+        conn = sqlite3.connect(self.fileName)       # an old, non-incremental
+        conn.execute(CREATE_SQL)                    #  cache db
+        conn.commit()
+        conn.close()
+        cache = TextCache(self.fileName)
+        self.assertEqual( \
+                cache.conn.execute('pragma auto_vacuum').fetchone()[0], 2)
+        cache.close()
+# end class MyTests ------------------------
+
+if __name__ == "__main__":
+    doAutomatedTests()
@@ -0,0 +1,204 @@
+#!/usr/bin/env python3
+#
+# Library to clean up text fields before writing them to sample files,
+#  shared by the sample data extraction scripts
+#  (sdGetMGIRefs.py, sdGetRawPrimTriage.py, sdGetGXD2ary.py, sdGetExtText.py)
+#
+# Cleaning replaces the sample file delimiters (record ending, field sep)
+#  and any non-ascii chars w/ ' ' (one ' ' per char replaced, like
+#  utilsLib.removeNonAscii()). Optionally carriage returns too.
+#
+# This replaces the old chain:
+#   removeNonAscii(text.replace(RECORDEND,' ').replace(FIELDSEP,' '))
+#  that copied each text 3-4 times, removeNonAscii() being a python loop
+#  over every char. Here:
+#   - non-ascii chars are only looked for if the string has any
+#       (str.isascii() is free) and are replaced by the ascii codec w/ an
+#       error handler that returns ' 's, all in C
+#   - single char delimiters are all replaced in one str.translate() pass
+#       (fast for ascii strs)
+#   - multi char delimiters (';;') are replaced by str.replace(), which does
+#       not copy the str if the delimiter is not there
+#  So a typical ascii text is copied once.
+#
+# Run this module to benchmark it against the old chain:
+#   python textCleanLib.py [sampleFile]
+# or to run the automated unit tests:
+#   python textCleanLib.py --test
+#
+import sys
+import time
+import codecs
+import unittest
+#-----------------------------------
+
+ERROR_HANDLER = 'textCleanLib.space'    # codec error handler name
+
+def _nonAscii2Space(err):
+    """ codec error handler: replace each unencodable char w/ ' ' """
+    return (' ' * (err.end - err.start), err.end)
+
+codecs.register_error(ERROR_HANDLER, _nonAscii2Space)
+#-----------------------------------
+
+class TextCleaner (object):
+    """
+    IS:     a cleaner of text fields for a sample file
+    HAS:    list of delimiters to remove from text
+    DOES:   clean(text): replace the delimiters and non-ascii chars w/ ' '.
+            cleanTexts(texts): clean a batch of texts at once.
+    """
+    def __init__(self, delimiters,      # list of strs to replace w/ ' ',
+                                        #  e.g., [RECORDEND, FIELDSEP, '\r']
+                ):
+        self.delimiters = delimiters
+        self.charTable = str.maketrans( \
+                            { d: ' ' for d in delimiters if len(d) == 1 })
+        self.multiDelims = [ d for d in delimiters if len(d) > 1 ]
+    #----------------------
+
+    def clean(self, text):
+        """ Return text w/ the delimiters and non-ascii chars replaced w/ ' '
+            None is returned as ''.
+        """
+        if text is None: return ''
+        if not text.isascii():
+            text = text.encode('ascii', ERROR_HANDLER).decode('ascii')
+        for d in self.multiDelims:
+            text = text.replace(d, ' ')
+        return text.translate(self.charTable)
+    #----------------------
+
+    def cleanTexts(self, texts,         # list of texts (or None)
+        ):
+        """ Return list of the cleaned texts """
+        clean = self.clean
+        return [ clean(text) for text in texts ]
+    #----------------------
+# end class TextCleaner ------------------------
+
+def getOldChain(delimiters,     # list of delimiters, as for TextCleaner
+    ):
+    """ Return a function(text) that cleans text w/ the old replace/
+        removeNonAscii chain, that TextCleaner output must be the same as.
+    """
+    try:
+        from utilsLib import removeNonAscii
+    except ImportError:     # same as utilsLib.removeNonAscii()
+        def removeNonAscii(text):
+            return ''.join([ c if ord(c) < 128 else ' ' for c in text ])
+
+    def oldChain(text):
+        for d in delimiters:
+            if d != '\r': text = text.replace(d, ' ')
+        text = removeNonAscii(text)
+        if '\r' in delimiters: text = text.replace('\r', ' ')
+        return text
+    return oldChain
+#-----------------------------------
+
+def benchmark(texts,        # list of texts to clean
+            delimiters,     # list of delimiters for the TextCleaner
+            numReps=3,      # num of times to clean the texts w/ each method
+            ):
+    """ Time cleaning texts w/ TextCleaner vs. the old replace/removeNonAscii
+        chain. Write MB/s for each to stdout.
+    """
+    oldChain = getOldChain(delimiters)
+    cleaner = TextCleaner(delimiters)
+    mBytes = sum([ len(t) for t in texts ]) / (1024 * 1024)
+    sys.stdout.write("%d texts, %.1f MB (as chars), %d reps\n" % \
+                                                (len(texts), mBytes, numReps))
+    results = {}
+    for name, cleanTexts in [
+                ('old chain',   lambda texts: [ oldChain(t) for t in texts ]),
+                ('TextCleaner', cleaner.cleanTexts),
+                ]:
+        startTime = time.time()
+        for i in range(numReps):
+            results[name] = cleanTexts(texts)
+        elapsed = time.time() - startTime
+        sys.stdout.write("%-12s %8.3f seconds %8.1f MB/s\n" % \
+                                    (name, elapsed, mBytes*numReps/elapsed))
+    if results['old chain'] != results['TextCleaner']:
+        sys.stdout.write("ERROR: TextCleaner output differs from old chain\n")
+    else:
+        sys.stdout.write("outputs are identical\n")
+#-----------------------------------
+
+def getBenchmarkTexts(fileName=None):
+    """ Return list of texts to benchmark: the records of a sample file, or
+        generated texts about the size of article bodies, mostly ascii w/
+        sprinkled delimiters, non-ascii chars and carriage returns.
+    """
+    if fileName:
+        with open(fileName, 'r') as fp:
+            return fp.read().split(';;')
+    import random
+    random.seed(1)
+    words = ['mouse', 'gene', 'expression', 'embryo', 'Pax6', 'E14.5', 'the',
+                'of', 'and', 'in', 'mutant', 'allele', 'protein', 'cells']
+    odd   = ['|', ';;', '\r', 'α-actin', '°C', '–', 'µm']
+    texts = []
+    for i in range(200):
+        texts.append(' '.join([ random.choice(words) if random.random() < .98
+                                else random.choice(odd) for j in range(10000)]))
+    return texts
+#-----------------------------------
+
+def doAutomatedTests():
+
+    sys.stdout.write("Running automated unit tests...\n")
+    unittest.main(argv=[sys.argv[0], '-v'],)
+
+class MyTests(unittest.TestCase):
+    delimiters = [';;', '|', '\r']
+    texts = [ \
+        'plain ascii text',
+        '',
+        'field|sep and;;record end;;;and ;;; runs|||',
+        'carriage\r\nreturns\r',
+        'caf\u00e9 \u00b5m \u03b1-actin 37\u00b0C \u2013 done',  # 1-2 byte
+        'emoji \U0001F42D mouse, CJK \u5c0f\u9f20',     # 3-4 byte utf-8
+        'lone surrogate \udc80 from a bad decode',
+        '\u00e9;;\u00e9|\u00e9\r;\u00e9;',           # non-ascii by delims
+        ]
+
+    def test_clean(self):
+        cleaner = TextCleaner(self.delimiters)
+        self.assertEqual(cleaner.clean('a|b;;c\rd'), 'a b c d')
+        self.assertEqual(cleaner.clean('a;;;b'), 'a ;b')
+        self.assertEqual(cleaner.clean('\u03b1\U0001F42D-x'), '  -x')
+        self.assertEqual(cleaner.clean(None), '')
+
+    def test_sameAsOldChain(self):
+        cleaner = TextCleaner(self.delimiters)
+        oldChain = getOldChain(self.delimiters)
+        for text in self.texts:
+            cleaned = cleaner.clean(text)
+            self.assertEqual(cleaned, oldChain(text))
+            self.assertTrue(cleaned.isascii())
+        self.assertEqual(cleaner.cleanTexts(self.texts + [None]),
+                            [ oldChain(t) for t in self.texts ] + [''])
+
+    def test_keepCarriageReturns(self):
+        cleaner = TextCleaner([';;', '|'])
+        self.assertEqual(cleaner.clean('a\r\nb|\u00e9'), 'a\r\nb  ')
+        for text in self.texts:
+            self.assertEqual(cleaner.clean(text),
+                                        getOldChain([';;', '|'])(text))
+
+    def test_errorHandler(self):
+        self.assertEqual('x\u00e9\U0001F42Dy'.encode('ascii', ERROR_HANDLER),
+                                                                    b'x  y')
+        self.assertEqual('\udc80'.encode('ascii', ERROR_HANDLER), b' ')
+        self.assertEqual(codecs.lookup_error(ERROR_HANDLER), _nonAscii2Space)
+# end class MyTests ------------------------
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] == '--test':
+        doAutomatedTests()
+    else:
+        if len(sys.argv) > 1: fileName = sys.argv[1]
+        else: fileName = None
+        benchmark(getBenchmarkTexts(fileName), [';;', '|', '\r'])